@@ -3,9 +3,11 @@ import sys
 from argparse import ArgumentParser
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
 
 from core.logger import init_logger, info, error
+from core.summarizer.ticket_queue import FAIR, SCHEDULING_POLICIES
 
 
 __all__ = ["Args", "parse_args"]
@@ -15,6 +17,19 @@ __all__ = ["Args", "parse_args"]
 class Args:
     target_dir: Path
     DEBUG: bool
+    no_cache: bool
+    reprocess_all: bool
+    no_local_step1: bool
+    step1_batch: int
+    route: bool
+    hedge: bool
+    scheduling: str
+    metrics_port: Optional[int]
+    exit_when_done: bool
+    llm_record: Optional[Path]
+    llm_replay: Optional[Path]
+    work_queue: Optional[Path]
+    summarizer_procs: int
 
 
 def parse_args(base_dir: Path) -> Args:
@@ -22,8 +37,74 @@ def parse_args(base_dir: Path) -> Args:
     parser = ArgumentParser()
     parser.add_argument("-d", "--target_dir", required=True, type=Path, help="Directory to watch for new files")
     parser.add_argument("--DEBUG", default=False, action="store_true")
+    parser.add_argument("--no_cache", default=False, action="store_true", help="Do not use completion cache")
+    parser.add_argument(
+        "--reprocess_all", default=False, action="store_true",
+        help="Process all PDFs in target dir, including already processed and unchanged ones"
+    )
+    parser.add_argument(
+        "--no_local_step1", default=False, action="store_true",
+        help="Send every page to the model in step1, even if its section is clear from the text layer"
+    )
+    parser.add_argument(
+        "--step1_batch", default=1, type=int,
+        help="Pages per step1 request, capped by the model's context window. 1: a request per page"
+    )
+    parser.add_argument(
+        "--route", default=False, action="store_true",
+        help="Route requests away from an unhealthy model, and fail over on transport errors and rate limits"
+    )
+    parser.add_argument(
+        "--hedge", default=False, action="store_true",
+        help="Race requests slower than the model's p95 latency against another model, implies --route"
+    )
+    parser.add_argument(
+        "--scheduling", default=FAIR, choices=SCHEDULING_POLICIES,
+        help="Order of model requests: fifo; fair - step2 and retries first, round-robin across documents; "
+             "sjf - as fair, smallest document first"
+    )
+    parser.add_argument(
+        "--metrics_port", default=None, type=int,
+        help="Serve metrics at http://localhost:PORT/metrics (Prometheus) and /metrics.json"
+    )
+    parser.add_argument(
+        "--exit_when_done", default=False, action="store_true",
+        help="Exit once PDFs found in target dir on start are processed, instead of watching for new ones"
+    )
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        "--llm_record", default=None, type=Path,
+        help="Append every model request fingerprint and answer to PATH (gzipped JSONL)"
+    )
+    recording.add_argument(
+        "--llm_replay", default=None, type=Path,
+        help="Serve model answers recorded with --llm_record PATH, without calling models"
+    )
+    parser.add_argument(
+        "--work_queue", default=None, type=Path,
+        help="Coordinate summarizer workers (python -m core.worker --work_queue PATH) through a SQLite "
+             "queue at PATH, instead of calling models in this process"
+    )
+    parser.add_argument(
+        "--summarizer_procs", default=0, type=int,
+        help="Call models from N processes, each with its own event loop, when a single one is CPU bound. "
+             "0: a summarizer thread"
+    )
     args = parser.parse_args()
 
+    if (args.work_queue or args.summarizer_procs) and (args.llm_record or args.llm_replay):
+        error("--llm_record / --llm_replay call models in this process, they can't be used with "
+              "--work_queue or --summarizer_procs")
+        sys.exit(1)
+
+    if args.work_queue and args.summarizer_procs:
+        error("--work_queue and --summarizer_procs are exclusive: scale out with more workers instead")
+        sys.exit(1)
+
+    if args.llm_replay and not args.llm_replay.is_file():
+        error(f"Recording '{args.llm_replay}' does not exist")
+        sys.exit(1)
+
     target_dir: Path = args.target_dir
     if not target_dir.is_absolute():
         target_dir = base_dir / target_dir
@@ -35,5 +116,18 @@ def parse_args(base_dir: Path) -> Args:
 
     return Args(
         target_dir=target_dir,
-        DEBUG=args.DEBUG
+        DEBUG=args.DEBUG,
+        no_cache=args.no_cache,
+        reprocess_all=args.reprocess_all,
+        no_local_step1=args.no_local_step1,
+        step1_batch=args.step1_batch,
+        route=args.route or args.hedge,
+        hedge=args.hedge,
+        scheduling=args.scheduling,
+        metrics_port=args.metrics_port,
+        exit_when_done=args.exit_when_done,
+        llm_record=args.llm_record,
+        llm_replay=args.llm_replay,
+        work_queue=args.work_queue,
+        summarizer_procs=args.summarizer_procs,
     )
@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Queue
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from core.pdf_document import PDFDocument
+
+
+__all__ = ["FILE", "PAGES", "TICKET", "Event", "EventQueue"]
+
+
+# a new PDF to process
+FILE = "file"
+# a page range of a document was split
+PAGES = "pages"
+# a ticket of a document was post-processed, re-queued or dead-lettered
+TICKET = "ticket"
+
+
+@dataclass
+class Event:
+    kind: str
+    path: Optional[Path] = None
+    doc: Optional["PDFDocument"] = None
+
+
+class EventQueue(Queue):
+    """
+    Wakes up the main loop; filled by the watchdog, PDF pool callbacks and the summarizer thread
+    """
+    def put_file(self, path: Path) -> None:
+        self.put(Event(FILE, path=path))
+
+    def put_doc(self, kind: str, doc: "PDFDocument") -> None:
+        self.put(Event(kind, doc=doc))
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+
+from pathlib import Path
+
+from core.utils import file_sha256
+
+
+__all__ = ["FileIndex"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+class FileIndex:
+    """
+    Fingerprints (path, size, mtime, content hash) of PDFs whose results were already written.
+    Unchanged files are recognized by size and mtime alone; content is hashed only if mtime changed.
+    """
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def is_done(self, path: Path) -> bool:
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (str(path),)
+            ).fetchone()
+        if not row:
+            return False
+
+        size, mtime_ns, sha256 = row
+        if size != stat.st_size:
+            return False
+        if mtime_ns == stat.st_mtime_ns:
+            return True
+
+        # touched or copied over: same content is still done
+        if file_sha256(path) != sha256:
+            return False
+        with self._lock:
+            self._conn.execute("UPDATE files SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, str(path)))
+        return True
+
+    def mark_done(self, path: Path, sha256: str) -> None:
+        """
+        :param sha256: content hash the results were produced from
+        """
+        stat = path.stat()
+        if file_sha256(path) != sha256:
+            # modified while being processed: must be processed again
+            return
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (str(path), stat.st_size, stat.st_mtime_ns, sha256)
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM files")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,131 +1,285 @@
 import json
+import os
+import threading
+
 from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, List
 
 import pandas as pd
 
-from core.logger import info
-from core.globals import STEP1_DUMP_FILE, STEP2_DUMP_FILE
+from core.logger import info, error
+from core.globals import STEP1_DUMP_FILE, STEP2_DUMP_FILE, OUTPUT_DEBOUNCE_S
+from core.metrics import OUTPUT_FLUSH_SECONDS
 
 
-def format_output(target_dir: Path):
-    assert STEP1_DUMP_FILE.is_file(), f"File {STEP1_DUMP_FILE} not found"
-    assert STEP2_DUMP_FILE.is_file(), f"File {STEP2_DUMP_FILE} not found"
+SECTIONS_COLUMNS = ['file_name', 'section', 'section_n', 'page_start', 'page_end', 'section_summary']
+PARTS_COLUMNS = ['file_name', 'part', 'section', 'section_n', 'summary']
+USAGE_COLUMNS = [
+    'file_name', 'finished_in', 'models', 'calls', 'queue_wait', 'cache_hits', 'cache_misses',
+    'step1_local_pages', 'step1_samples', 'step1_agreement', 'retry_calls', 'retry_tokens_in', 'retry_tokens_out',
+    'tokens_in', 'tokens_in_cached', 'tokens_out', 'cost',
+]
 
-    s1_rows = []
-    s2_rows = []
 
-    with open(STEP1_DUMP_FILE, "r") as f:
-        for line in f:
-            data = json.loads(line)
-            s1_rows.append(convert_s1_to_output(data))
+def document_rows(s1: Dict[str, Any], s2: Optional[Dict[str, Any]]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    """
+    :return: output.csv, output_parts.csv and usage.csv rows of a single document
+    """
+    s1_row = convert_s1_to_output(s1)
+    file_name = s1_row['file_name']
 
-    with open(STEP2_DUMP_FILE, "r") as f:
-        for line in f:
-            s2_rows.append(json.loads(line))
+    summaries = {
+        (summary['section'], summary.get('section_n', '')): summary['section_summary']
+        for summary in (s2['summaries'] if s2 else [])
+    }
+
+    sections_rows = [
+        {
+            'file_name': file_name,
+            'section': section['section'],
+            'section_n': section['section_n'],
+            'page_start': section['page_start'],
+            'page_end': section['page_end'],
+            'section_summary': summaries.get((section['section'], section['section_n']), ''),
+        }
+        for section in s1_row['sections']
+    ]
+
+    if not s2:
+        return sections_rows, [], []
+
+    usage = s2['usage']
+
+    usage_cost = 0.
+    tokens_in = sum(c["tokens_in"] for c in usage["calls"])
+    tokens_in_cached = sum(c.get("tokens_in_cached", 0) for c in usage["calls"])
+    tokens_out = sum(c["tokens_out"] for c in usage["calls"])
+    queue_wait_s = sum(c.get("queue_wait_s", 0.) for c in usage["calls"])
+    cache_hits = sum(1 for c in usage["calls"] if c.get("cache_hit"))
+    retries = [c for c in usage["calls"] if c.get("attempt", 0) > 0]
+    step1_local_pages = sum(1 for p in usage.get("step1_pages", []) if p.get("source") == "local")
+    step1_pages = [p for p in usage.get("step1_pages", []) if p["agreement"] is not None]
+    step1_samples = sum(p["samples"] for p in step1_pages)
+    step1_agreement = sum(p["agreement"] for p in step1_pages) / len(step1_pages) if step1_pages else None
 
-    sections_rows = []
-    for item in s1_rows:
-        file_name = item['file_name']
-        for section in item['sections']:
-            sections_rows.append({
+    try:
+        usage_cost = sum([
+            (c["tokens_in"] - c.get("tokens_in_cached", 0)) / 1_000_000 * c["dollars_input"]
+            + c.get("tokens_in_cached", 0) / 1_000_000 * c.get("dollars_input_cached", c["dollars_input"])
+            + c["tokens_out"] / 1_000_000 * c["dollars_output"]
+            for c in usage["calls"]
+        ])
+    except ZeroDivisionError:
+        pass
+
+    usage_rows = [{
+        "file_name": file_name,
+        "finished_in": f'{usage["finished_in_s"]:.2f}s',
+        "models": list({c["model_name"] for c in usage["calls"]}),
+        "calls": len(usage["calls"]),
+        "queue_wait": f"{queue_wait_s:.2f}s",
+        "cache_hits": cache_hits,
+        "cache_misses": len(usage["calls"]) - cache_hits,
+        "step1_local_pages": step1_local_pages,
+        "step1_samples": step1_samples,
+        "step1_agreement": f"{step1_agreement:.2f}" if step1_agreement is not None else "",
+        "retry_calls": len(retries),
+        "retry_tokens_in": sum(c["tokens_in"] for c in retries),
+        "retry_tokens_out": sum(c["tokens_out"] for c in retries),
+        "tokens_in": tokens_in,
+        "tokens_in_cached": tokens_in_cached,
+        "tokens_out": tokens_out,
+        "cost": f"${usage_cost:.5f}",
+    }]
+
+    parts_rows = []
+    for summary in s2['summaries']:
+        section = summary['section']
+        section_n = summary.get('section_n', '')  # Get section_n from s2_rows summary
+        for part in summary['parts']:
+            parts_rows.append({
                 'file_name': file_name,
-                'section': section['section'],
-                'section_n': section['section_n'],
-                'page_start': section['page_start'],
-                'page_end': section['page_end'],
-                'section_summary': ''
+                'part': part['part_name'],
+                'section': str(section),
+                'section_n': section_n,
+                'summary': part['part_summary']
             })
 
-    summaries = {
-        (obj['file_name'], summary['section'], summary.get('section_n', '')): summary['section_summary']
-        for obj in s2_rows
-        for summary in obj['summaries']
-    }
+    return sections_rows, parts_rows, usage_rows
 
-    for row in sections_rows:
-        key = (row['file_name'], row['section'], row['section_n'])
-        row['section_summary'] = summaries.get(key, '')
 
-    usages = []
-    parts_rows = []
-    for obj in s2_rows:
-        usage = obj['usage']
-        file_name = obj['file_name']
-
-        usage_cost = 0.
-        tokens_in = sum(c["tokens_in"] for c in usage["calls"])
-        tokens_out = sum(c["tokens_out"] for c in usage["calls"])
-
-        try:
-            usage_cost = sum([
-                c["tokens_in"] / 1_000_000 * c["dollars_input"] + c["tokens_out"] / 1_000_000 * c["dollars_output"]
-                for c in usage["calls"]
-            ])
-        except ZeroDivisionError:
-            pass
-
-        usage = {
-            "file_name": file_name,
-            "finished_in": f'{usage["finished_in_s"]:.2f}s',
-            "models": list({c["model_name"] for c in usage["calls"]}),
-            "calls": len(usage["calls"]),
-            "tokens_in": tokens_in,
-            "tokens_out": tokens_out,
-            "cost": f"${usage_cost:.5f}",
-        }
-        usages.append(usage)
-
-        for summary in obj['summaries']:
-            section = summary['section']
-            section_n = summary.get('section_n', '')  # Get section_n from s2_rows summary
-            for part in summary['parts']:
-                parts_rows.append({
-                    'file_name': file_name,
-                    'part': part['part_name'],
-                    'section': str(section),
-                    'section_n': section_n,
-                    'summary': part['part_summary']
-                })
-
-    sections_df = pd.DataFrame(sections_rows).sort_values(['file_name', 'page_start'])
-    parts_df = pd.DataFrame(parts_rows).sort_values(['file_name', 'section', 'section_n', 'part'])
-    usage_df = pd.DataFrame(usages).sort_values(['file_name'])
-
-    artifacts = target_dir / 'artifacts'
-    artifacts.mkdir(parents=True, exist_ok=True)
-
-    output_csv = artifacts / 'output.csv'
-    parts_csv = artifacts / 'output_parts.csv'
-    usage_csv = artifacts / 'usage.csv'
-
-    sections_df.to_csv(str(output_csv), index=False)
-    info(f"Saved output to {output_csv}")
-    parts_df.to_csv(str(parts_csv), index=False)
-    info(f"Saved output_parts to {parts_csv}")
-    usage_df.to_csv(str(usage_csv), index=False)
-    info(f"Saved output_usage to {usage_csv}")
+class OutputWriter:
+    """
+    Keeps output rows per document in memory, so that a finished document only adds its own rows.
+    CSVs are re-written by a background thread, at most once per debounce_s.
+    """
+    def __init__(self, target_dir: Path, debounce_s: float):
+        self.target_dir = target_dir
+        self.debounce_s = debounce_s
+        self._rows: Dict[str, Tuple[List[Dict], List[Dict], List[Dict]]] = {}
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def load_dumps(self) -> None:
+        """
+        Reads dump files once. Dumps are appended to across runs: the latest result of a file wins,
+        only files under target_dir which still exist make it to the output
+        """
+        s1_by_file = compact_dump(STEP1_DUMP_FILE)
+        s2_by_file = compact_dump(STEP2_DUMP_FILE)
+
+        target_dir = self.target_dir.resolve()
+        for file_path, s1 in s1_by_file.items():
+            if Path(file_path).resolve().is_relative_to(target_dir):
+                self.add(s1, s2_by_file.get(file_path))
+
+    def add(self, s1: Dict[str, Any], s2: Optional[Dict[str, Any]]) -> None:
+        rows = document_rows(s1, s2)
+        with self._lock:
+            self._rows[s1["file_path"]] = rows
+        self._dirty.set()
+
+    def flush(self) -> None:
+        with OUTPUT_FLUSH_SECONDS.time():
+            self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            self._dirty.clear()
+            docs = list(self._rows.values())
+
+        sections_rows = [r for d in docs for r in d[0]]
+        parts_rows = [r for d in docs for r in d[1]]
+        usage_rows = [r for d in docs for r in d[2]]
+
+        sections_df = pd.DataFrame(sections_rows, columns=SECTIONS_COLUMNS).sort_values(['file_name', 'page_start'])
+        parts_df = pd.DataFrame(parts_rows, columns=PARTS_COLUMNS).sort_values(['file_name', 'section', 'section_n', 'part'])
+        usage_df = pd.DataFrame(usage_rows, columns=USAGE_COLUMNS).sort_values(['file_name'])
+
+        artifacts = self.target_dir / 'artifacts'
+        artifacts.mkdir(parents=True, exist_ok=True)
+
+        output_csv = artifacts / 'output.csv'
+        parts_csv = artifacts / 'output_parts.csv'
+        usage_csv = artifacts / 'usage.csv'
+
+        sections_df.to_csv(str(output_csv), index=False)
+        info(f"Saved output to {output_csv}")
+        parts_df.to_csv(str(parts_csv), index=False)
+        info(f"Saved output_parts to {parts_csv}")
+        usage_df.to_csv(str(usage_csv), index=False)
+        info(f"Saved output_usage to {usage_csv}")
+
+    def _worker(self) -> None:
+        while not self._stop.is_set():
+            if not self._dirty.wait(timeout=1.):
+                continue
+            # debounce: documents finishing close to each other are written at once
+            self._stop.wait(self.debounce_s)
+            try:
+                self.flush()
+            except Exception as e:
+                error(f"Failed to write output: {e}")
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._dirty.is_set():
+            self.flush()
+
+
+def compact_dump(dump_file: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    Keeps the latest line of each file in a dump file, drops lines of files which no longer exist.
+    The dump is re-written only if lines were dropped
+    :return: {file path: latest line}
+    """
+    if not dump_file.is_file():
+        return {}
+
+    by_file = {}
+    lines_cnt = 0
+    with open(dump_file, "r") as f:
+        for line in f:
+            data = json.loads(line)
+            by_file[data["file_path"]] = data
+            lines_cnt += 1
+
+    by_file = {file_path: data for file_path, data in by_file.items() if Path(file_path).is_file()}
+    if len(by_file) < lines_cnt:
+        tmp_file = dump_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            for data in by_file.values():
+                f.write(json.dumps(data) + "\n")
+        os.replace(tmp_file, dump_file)
+        info(f"Compacted {dump_file.name}: {lines_cnt} -> {len(by_file)} lines")
+
+    return by_file
+
+
+def spawn_output_writer(target_dir: Path) -> OutputWriter:
+    writer = OutputWriter(target_dir, OUTPUT_DEBOUNCE_S)
+    writer.load_dumps()
+    writer.start()
+    info("output writer initialized")
+    return writer
+
+
+def format_output(target_dir: Path):
+    """
+    Full re-build of output CSVs from dump files
+    """
+    assert STEP1_DUMP_FILE.is_file(), f"File {STEP1_DUMP_FILE} not found"
+    assert STEP2_DUMP_FILE.is_file(), f"File {STEP2_DUMP_FILE} not found"
+
+    writer = OutputWriter(target_dir, OUTPUT_DEBOUNCE_S)
+    writer.load_dumps()
+    writer.flush()
 
 
 def convert_s1_to_output(input_data):
+    """
+    Page ranges of each (section, section_n), in a single pass over pages
+    """
+    pages = input_data["pages"]
+    # same order of section_n as iterating over a set of them
+    section_n_order = {section_n: idx for idx, section_n in enumerate(set(p["section_n"] for p in pages))}
+
+    ranges: Dict[Tuple[Any, Any], List[int]] = {}
+    for p in pages:
+        page_num, section_n = p["page_num"], p["section_n"]
+        for section in p["sections"]:
+            if (r := ranges.get((section, section_n))) is None:
+                ranges[(section, section_n)] = [page_num, page_num]
+            elif page_num < r[0]:
+                r[0] = page_num
+            elif page_num > r[1]:
+                r[1] = page_num
+
+    section_ns_by_section: Dict[Any, List[Any]] = {}
+    for section, section_n in ranges:
+        section_ns_by_section.setdefault(section, []).append(section_n)
+
     output = {
         "file_name": input_data["file_name"],
         "sections": []
     }
 
-    for section_idx, section in enumerate(input_data["sections"]):
-        for section_n in set(p["section_n"] for p in input_data["pages"]):
-            section_pages = [
-                p["page_num"] for p in input_data["pages"]
-                if section in p["sections"] and p["section_n"] == section_n
-            ]
-
-            if section_pages:
-                section_entry = {
-                    "section": section,
-                    "section_n": section_n,
-                    "page_start": min(section_pages),
-                    "page_end": max(section_pages)
-                }
-                output["sections"].append(section_entry)
+    for section in input_data["sections"]:
+        for section_n in sorted(section_ns_by_section.get(section, []), key=section_n_order.__getitem__):
+            page_start, page_end = ranges[(section, section_n)]
+            output["sections"].append({
+                "section": section,
+                "section_n": section_n,
+                "page_start": page_start,
+                "page_end": page_end
+            })
 
     return output
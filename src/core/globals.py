@@ -1,11 +1,86 @@
+import os
+
 from pathlib import Path
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
+# dumps, job store, completion cache and metrics snapshot; SUMM_STATE_DIR keeps benchmark runs apart
+STATE_DIR = Path(os.environ.get("SUMM_STATE_DIR", BASE_DIR))
 
 SUMMARIZER_MODEL = "gemini-2.0-flash"
 SUMMARIZER_FALLBACK_MODEL = "gpt-4o"
-SUMMARIZER_BS = 8
+# default in-flight requests per model, overridden by max_concurrency in model_list.json
+SUMMARIZER_CONCURRENCY = 8
+
+# with --route, tickets are routed between ROUTER_MODELS: the requested model is used unless more than
+# ROUTER_MAX_ERROR_RATE of its recent requests failed, less than ROUTER_MIN_BUDGET of its rate limit
+# is left, or its p95 latency is ROUTER_SLOW_FACTOR times the fastest alternative's.
+# Off by default: the fallback model costs more, and a step1 request with n samples costs n times more there
+ROUTER_MODELS = [SUMMARIZER_MODEL, SUMMARIZER_FALLBACK_MODEL]
+ROUTER_MAX_ERROR_RATE = 0.25
+ROUTER_MIN_BUDGET = 0.1
+ROUTER_SLOW_FACTOR = 3.
+# latency samples kept per model, and needed before its p95 is trusted
+ROUTER_WINDOW = 100
+ROUTER_MIN_SAMPLES = 20
+
+# step1 self-consistency: request STEP1_N_INITIAL samples, escalate up to STEP1_N_MAX only
+# if samples agree less than STEP1_AGREEMENT_THRESHOLD. STEP1_N_INITIAL = STEP1_N_MAX for a fixed n
+STEP1_N_INITIAL = 3
+STEP1_N_MAX = 8
+STEP1_AGREEMENT_THRESHOLD = 1.
+
+# step1 batches (--step1_batch K): K is capped so that pages fit the model's context window
+# and STEP1_BATCH_PAGE_OUTPUT_TOKENS per page fit the output limit
+STEP1_BATCH_PROMPT_TOKENS = 2048
+STEP1_BATCH_MAX_TOKENS = 8192
+STEP1_BATCH_PAGE_OUTPUT_TOKENS = 256
+
+# step1 from the page text layer: pages with a single unambiguous section in headers, footers
+# or titles skip the model. Text within LOCAL_STEP1_MARGIN of page height is header / footer
+LOCAL_STEP1_MIN_CHARS = 200
+LOCAL_STEP1_MARGIN = 0.08
+
+# failed tickets are retried after exponential backoff with jitter, up to RETRY_MAX_ATTEMPTS
+# (RETRY_MAX_ATTEMPTS_RATE_LIMIT for rate limit errors). Then the document fails
+RETRY_MAX_ATTEMPTS = 5
+RETRY_MAX_ATTEMPTS_RATE_LIMIT = 10
+RETRY_BACKOFF_BASE_S = 1.
+RETRY_BACKOFF_MAX_S = 60.
+
+# admit requests just under provider TPM / RPM from model_list.json
+RATE_LIMIT_HEADROOM = 0.9
+# rough input token estimates, used for rate limiting only
+PDF_PAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+# PDFs are split into single page PDFs in a process pool, in ranges of PDF_SPLIT_CHUNK_PAGES
+PDF_SPLIT_WORKERS = min(4, os.cpu_count() or 1)
+PDF_SPLIT_CHUNK_PAGES = 8
+
+# --work_queue: tickets go to summarizer workers (core/worker.py) through a SQLite queue shared with them.
+# A worker leases a ticket for WORK_QUEUE_LEASE_S and extends the lease while the model call runs, tickets
+# of a worker that died are leased again once it expires. Idle workers and the coordinator poll every
+# WORK_QUEUE_POLL_S
+WORK_QUEUE_LEASE_S = 60.
+WORK_QUEUE_POLL_S = 0.05
+# rate limit budget of shared buckets the router sees is at most WORK_QUEUE_BUDGET_REFRESH_S old
+WORK_QUEUE_BUDGET_REFRESH_S = 1.
+
+COMPLETION_CACHE_DIR = STATE_DIR / ".cache" / "completions"
+COMPLETION_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+JOB_STORE_FILE = STATE_DIR / ".jobs.sqlite3"
+
+# output CSVs are re-written at most once per OUTPUT_DEBOUNCE_S
+OUTPUT_DEBOUNCE_S = 2.
+
+STEP1_DUMP_FILE = STATE_DIR / ".step1.jsonl"
+STEP2_DUMP_FILE = STATE_DIR / ".step2.jsonl"
+FAILED_DUMP_FILE = STATE_DIR / ".failed.jsonl"
 
-STEP1_DUMP_FILE = BASE_DIR / ".step1.jsonl"
-STEP2_DUMP_FILE = BASE_DIR / ".step2.jsonl"
+# metrics are written to METRICS_SNAPSHOT_FILE every METRICS_SNAPSHOT_S, and served over HTTP
+# with --metrics_port. Set METRICS_HOST=0.0.0.0 to scrape from outside a container
+METRICS_SNAPSHOT_FILE = STATE_DIR / ".metrics.json"
+METRICS_SNAPSHOT_S = 10.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
@@ -0,0 +1,213 @@
+import json
+import sqlite3
+import threading
+
+from pathlib import Path
+from typing import Optional, Tuple, List
+
+from core.logger import info
+from core.pdf_document import (
+    PDFDocument, PDFPage, PDFDocumentDataItemStep2, PDFDocumentDataItemStep2Part, ModelCallUsage
+)
+
+
+__all__ = ["JobStore"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_path ON documents(path);
+
+CREATE TABLE IF NOT EXISTS step1 (
+    doc_id TEXT NOT NULL,
+    page_num INTEGER NOT NULL,
+    sections TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 0,
+    agreement REAL,
+    PRIMARY KEY (doc_id, page_num)
+);
+
+CREATE TABLE IF NOT EXISTS step2 (
+    doc_id TEXT NOT NULL,
+    section_n INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    section_summary TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    PRIMARY KEY (doc_id, section_n)
+);
+
+CREATE TABLE IF NOT EXISTS calls (
+    doc_id TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    ts_start REAL NOT NULL,
+    ts_end REAL,
+    tokens_in INTEGER NOT NULL,
+    tokens_out INTEGER NOT NULL,
+    queue_wait_s REAL NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    tokens_in_cached INTEGER NOT NULL DEFAULT 0,
+    attempt INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS calls_doc_id ON calls(doc_id);
+"""
+
+
+class JobStore:
+    """
+    Durable record of step1 (per page) and step2 (per section) results, written as they complete.
+    On restart, documents pick up stored results and only missing tickets are re-queued.
+    Documents are identified by content hash: results of a changed file are never reused.
+    Results of a document are dropped once its output is written, see forget()
+    """
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        info(f"job store: {db_path}")
+
+    def _migrate(self) -> None:
+        """
+        Adds columns missing in job stores created by older versions
+        """
+        missing = {
+            "calls": {
+                "tokens_in_cached": "INTEGER NOT NULL DEFAULT 0",
+                "attempt": "INTEGER NOT NULL DEFAULT 0",
+            },
+            "step1": {
+                "samples": "INTEGER NOT NULL DEFAULT 0",
+                "agreement": "REAL",
+            },
+        }
+        for table, table_columns in missing.items():
+            columns = {r[1] for r in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in table_columns.items():
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def register(self, doc: PDFDocument) -> None:
+        """
+        Drops results of previous versions of the document at the same path
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            stale = [
+                r[0] for r in self._conn.execute(
+                    "SELECT doc_id FROM documents WHERE path = ? AND doc_id != ?", (str(doc.path), doc.doc_id)
+                )
+            ]
+            self._delete(stale)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_id, path) VALUES (?, ?)", (doc.doc_id, str(doc.path))
+            )
+
+    def _delete(self, doc_ids: List[str]) -> None:
+        for table in ["documents", "step1", "step2", "calls"]:
+            self._conn.executemany(f"DELETE FROM {table} WHERE doc_id = ?", [(d,) for d in doc_ids])
+
+    def forget(self, doc: PDFDocument) -> None:
+        """
+        Drops results of a finished document: its output is in the dump files from now on
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._delete([doc.doc_id])
+
+    def save_step1(self, doc: PDFDocument, page: PDFPage) -> None:
+        step1 = page.data_step1
+        self._execute(
+            "INSERT OR REPLACE INTO step1 (doc_id, page_num, sections, parts, samples, agreement) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                doc.doc_id, page.data.page_num, json.dumps(step1.sections), json.dumps(step1.parts),
+                step1.samples, step1.agreement
+            )
+        )
+
+    def load_step1(self, doc: PDFDocument, page: PDFPage) -> bool:
+        """
+        :return: True if the page's step1 result was restored, with the votes it was taken from
+        """
+        rows = self._execute(
+            "SELECT sections, parts, samples, agreement FROM step1 WHERE doc_id = ? AND page_num = ?",
+            (doc.doc_id, page.data.page_num)
+        )
+        if not rows:
+            return False
+
+        sections, parts, samples, agreement = rows[0]
+        page.data_step1.sections = json.loads(sections)
+        page.data_step1.parts = json.loads(parts)
+        page.data_step1.samples = samples
+        page.data_step1.agreement = agreement
+        doc.mark_step1_done(page)
+        return True
+
+    def save_step2(self, doc: PDFDocument, item: PDFDocumentDataItemStep2) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO step2 (doc_id, section_n, section, section_summary, parts) VALUES (?, ?, ?, ?, ?)",
+            (
+                doc.doc_id, item.section_n, item.section, item.section_summary,
+                json.dumps([{"part_name": p.part_name, "part_summary": p.part_summary} for p in item.parts])
+            )
+        )
+
+    def load_step2(self, doc: PDFDocument, section_n: int) -> Optional[PDFDocumentDataItemStep2]:
+        rows = self._execute(
+            "SELECT section, section_summary, parts FROM step2 WHERE doc_id = ? AND section_n = ?",
+            (doc.doc_id, section_n)
+        )
+        if not rows:
+            return None
+
+        section, section_summary, parts = rows[0]
+        return PDFDocumentDataItemStep2(
+            section=section,
+            section_n=section_n,
+            section_summary=section_summary,
+            parts=[PDFDocumentDataItemStep2Part(**p) for p in json.loads(parts)],
+        )
+
+    def save_call(self, doc: PDFDocument, usage: ModelCallUsage) -> None:
+        self._execute(
+            "INSERT INTO calls "
+            "(doc_id, model_name, ts_start, ts_end, tokens_in, tokens_out, queue_wait_s, cache_hit, "
+            "tokens_in_cached, attempt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                doc.doc_id, usage.model_name, usage.ts_start, usage.ts_end, usage.tokens_in, usage.tokens_out,
+                usage.queue_wait_s, int(usage.cache_hit), usage.tokens_in_cached, usage.attempt
+            )
+        )
+
+    def load_calls(self, doc: PDFDocument) -> List[ModelCallUsage]:
+        rows = self._execute(
+            "SELECT model_name, ts_start, ts_end, tokens_in, tokens_out, queue_wait_s, cache_hit, "
+            "tokens_in_cached, attempt "
+            "FROM calls WHERE doc_id = ?", (doc.doc_id,)
+        )
+        return [
+            ModelCallUsage(
+                model_name=model_name, ts_start=ts_start, ts_end=ts_end,
+                tokens_in=tokens_in, tokens_out=tokens_out, queue_wait_s=queue_wait_s, cache_hit=bool(cache_hit),
+                tokens_in_cached=tokens_in_cached, attempt=attempt,
+            )
+            for (
+                model_name, ts_start, ts_end, tokens_in, tokens_out, queue_wait_s, cache_hit, tokens_in_cached, attempt
+            ) in rows
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,21 +1,36 @@
-import queue
 import time
 
-from queue import Queue
+from pathlib import Path
+from typing import Dict, Optional
 
 from core.args import parse_args
-from core.fmt_output import format_output
-from core.globals import BASE_DIR
-from core.summarizer.step1 import create_ticket_step1, post_step1_heuristics, dump_step1_results
+from core.events import EventQueue, FILE, PAGES
+from core.fmt_output import spawn_output_writer
+from core.globals import (
+    SUMMARIZER_MODEL, BASE_DIR, COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES, JOB_STORE_FILE,
+    METRICS_HOST, METRICS_SNAPSHOT_FILE, METRICS_SNAPSHOT_S
+)
+from core.file_index import FileIndex
+from core.job_store import JobStore
+from core.metrics import spawn_metrics, DOCUMENTS, QUEUE_DEPTH
+from core.summarizer.step1 import (
+    create_tickets_step1, step1_batch_size, advance_step1_heuristics, section_name, dump_step1_results, step1_results
+)
 from core.summarizer.step2 import dump_step2_results, create_ticket_step2
-from core.summarizer.summarizer import spawn_summarizer
-from core.utils import clear_dump_files
+from core.summarizer.retry import dump_failed_results
+from core.summarizer.summarizer import spawn_summarizer, spawn_dispatcher
+from core.summarizer.ticket_queue import TicketQueue
+from core.summarizer.summarizer_procs import spawn_summarizer_procs
+from core.summarizer.work_queue import WorkQueue, RemoteTicketQueue
+from core.utils import file_sha256
 from core.logger import init_logger, info, warn
 from core.pdf_watchdog import spawn_watchdog
-from core.pdf_processor import process_pdf, PDFDocument
+from core.pdf_processor import spawn_pdf_pool, process_pdf, collect_pages, PDFDocument
 from core.prompts import load_prompts
 
-from llm_completion.models import get_model_list
+from llm_completion.cache import CompletionCache
+from llm_completion.models import get_model_list, resolve_model_record
+from llm_completion.recording import CompletionRecording
 
 
 def main():
@@ -23,66 +38,165 @@ def main():
     args = parse_args(BASE_DIR)
     init_logger(args.DEBUG)
     info("logger initialized")
-    clear_dump_files()
 
-    process_q, summ_q = Queue(), Queue()
-    documents = []
+    events = EventQueue()
+    # documents in progress, by path
+    documents: Dict[Path, PDFDocument] = {}
 
-    model_list = get_model_list(BASE_DIR)
+    # model calls are made by workers with --work_queue
+    model_list = get_model_list(BASE_DIR, check_env=not (args.llm_replay or args.work_queue))
     prompts = load_prompts(BASE_DIR)
+    batch_size = step1_batch_size(resolve_model_record(SUMMARIZER_MODEL, model_list), args.step1_batch)
+    if batch_size > 1:
+        info(f"step1: up to {batch_size} pages per request")
+    cache = None
+    if not args.no_cache:
+        cache = CompletionCache(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES)
+    recording = None
+    if args.llm_record or args.llm_replay:
+        recording = CompletionRecording(args.llm_replay or args.llm_record, replay=bool(args.llm_replay))
+    job_store = JobStore(JOB_STORE_FILE)
+    file_index = FileIndex(JOB_STORE_FILE)
+    if args.reprocess_all:
+        file_index.clear()
+
+    work_queue = None
+    if args.work_queue:
+        work_queue = WorkQueue(args.work_queue)
+        # tickets of a previous coordinator can't be post-processed: their documents are restored from the job store
+        work_queue.clear()
+        summ_q = RemoteTicketQueue(work_queue, args.scheduling, cache)
+        s_stop_event = spawn_dispatcher(summ_q, events)
+    elif args.summarizer_procs:
+        summ_q, s_stop_event = spawn_summarizer_procs(
+            model_list, args.summarizer_procs, cache, args.hedge, events, args.scheduling, route=args.route
+        )
+    else:
+        summ_q = TicketQueue()
+        s_stop_event = spawn_summarizer(
+            summ_q, model_list, cache, args.hedge, events, args.scheduling, recording, args.route
+        )
+
+    QUEUE_DEPTH.labels("tickets").set_function(summ_q.qsize)
+    QUEUE_DEPTH.labels("events").set_function(events.qsize)
+    m_stop_event = spawn_metrics(args.metrics_port, METRICS_HOST, METRICS_SNAPSHOT_FILE, METRICS_SNAPSHOT_S)
+    output_writer = spawn_output_writer(args.target_dir)
+    w_stop_event = spawn_watchdog(events, args.target_dir, file_index)
+    pdf_pool = spawn_pdf_pool()
+
+    def open_document(file_path: Path) -> Optional[PDFDocument]:
+        doc = PDFDocument(file_path)
+        info(f"processing PDF {doc.path.name} ...")
+        doc.usage.ts_start = time.time()
+        try:
+            doc.doc_id = file_sha256(doc.path)
+            doc.job_store = job_store
+            job_store.register(doc)
+            doc.usage.calls.extend(job_store.load_calls(doc))
+        except OSError as e:
+            warn(f"PDF {doc.path.name} could not be read: {e}. SKIPPING")
+            DOCUMENTS.labels("failed").inc()
+            return None
+
+        process_pdf(doc, pdf_pool, not args.no_local_step1, lambda: events.put_doc(PAGES, doc))
+
+        if doc.has_unrecoverable_errors():
+            warn(f"PDF {doc.path.name} has unrecoverable errors. SKIPPING")
+            doc.close()
+            DOCUMENTS.labels("failed").inc()
+            return None
+
+        return doc
+
+    def advance(doc: PDFDocument) -> bool:
+        """
+        Moves the document as far as its pages and finished tickets allow
+        :return: True if the document is finished or failed
+        """
+        if not doc.ingested:
+            pages = collect_pages(doc)
+
+            if any([p.has_unrecoverable_errors() for p in pages]):
+                doc.errors.extend(e for p in pages for e in p.errors if not e.recoverable)
+
+            if not doc.has_unrecoverable_errors():
+                pages = [p for p in pages if not p.data_step1.success and not job_store.load_step1(doc, p)]
+                [summ_q.put(ticket) for ticket in create_tickets_step1(doc, pages, prompts, batch_size)]
+
+        if doc.has_unrecoverable_errors():
+            # unreadable pages, or tickets which ran out of retry attempts
+            warn(f"PDF {doc.path.name} or some of its pages have unrecoverable errors. SKIPPING the document")
+            dump_failed_results(doc)
+            doc.close()
+            DOCUMENTS.labels("failed").inc()
+            return True
+
+        if not doc.step1_set:
+            # step2 of a section starts as soon as its pages are final, while later pages are in step1
+            for s_n in advance_step1_heuristics(doc):
+                doc.step2_dispatched.add(s_n)
+                if item := job_store.load_step2(doc, s_n):
+                    doc.add_step2(item)
+                    continue
+                ticket = create_ticket_step2(doc, prompts, s_n, section_name(doc, s_n))
+                summ_q.put(ticket)
+
+            if doc.step1_set:
+                dump_step1_results(doc)
 
-    w_stop_event = spawn_watchdog(process_q, args.target_dir)
-    s_stop_event = spawn_summarizer(summ_q, model_list)
+        if doc.step2_done():
+            doc.usage.ts_end = time.time()
+            s2 = dump_step2_results(doc, model_list)
+            output_writer.add(step1_results(doc), s2)
+            file_index.mark_done(doc.path, doc.doc_id)
+            job_store.forget(doc)
+            doc.close()
+            DOCUMENTS.labels("done").inc()
+            info(f"Document {doc.path.name} was processed")
+            return True
+
+        return False
 
     try:
         while True:
-            try:
-                file_path = process_q.get(timeout=0.5)
+            if args.exit_when_done and not documents and events.empty():
+                # files present on start were queued by spawn_watchdog() before the loop
+                info("All documents were processed, exiting")
+                break
 
-                doc = PDFDocument(file_path)
-                info(f"processing PDF {doc.path.name} ...")
-                doc.usage.ts_start = time.time()
-                process_pdf(doc)
+            # blocks until the watchdog, the PDF pool or the summarizer has news
+            event = events.get()
 
-                if doc.has_unrecoverable_errors():
-                    warn(f"PDF {doc.path.name} has unrecoverable errors. SKIPPING")
+            if event.kind == FILE:
+                if event.path in documents:
+                    info(f"{event.path.name} is already being processed. SKIPPING")
                     continue
-                if any([p.has_unrecoverable_errors() for p in doc]):
-                    warn(f"Some pages in {doc.path.name} have unrecoverable errors. SKIPPING the document")
+                if not (doc := open_document(event.path)):
                     continue
+                documents[doc.path] = doc
+            elif documents.get(event.doc.path) is event.doc:
+                doc = event.doc
+            else:
+                # late event of a finished or failed document
+                continue
 
-                [summ_q.put(create_ticket_step1(doc, page, prompts)) for page in doc]
-
-                documents.append(doc)
-
-            except queue.Empty:
-                pass
-
-            for doc in documents:
-                if doc.step1_done() and not doc.step1_set:
-                    post_step1_heuristics(doc)
-                    dump_step1_results(doc)
-                    doc.step1_set = True
-
-                    sections = {p.data_step1.section_n for p in doc}
-                    for s_n in sections:
-                        page = [page for page in doc if page.data_step1.section_n == s_n][-1]
-                        s_name = page.data_step1.sections[0]
-                        ticket = create_ticket_step2(doc, prompts, s_n, s_name)
-                        summ_q.put(ticket)
-
-                if doc.step2_done():
-                    doc.usage.ts_end = time.time()
-                    dump_step2_results(doc, model_list)
-                    documents.remove(doc)
-                    info(f"Document {doc.path.name} was processed")
-                    format_output(args.target_dir)
+            if advance(doc):
+                del documents[doc.path]
 
     except KeyboardInterrupt:
         info("Gracefully shutting down")
     finally:
         w_stop_event.set()
         s_stop_event.set()
+        m_stop_event.set()
+        pdf_pool.shutdown(wait=False, cancel_futures=True)
+        output_writer.stop()
+        job_store.close()
+        file_index.close()
+        if recording:
+            recording.close()
+        if work_queue:
+            work_queue.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,339 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, List, Tuple, Optional, Callable, Any, Iterator
+
+from core.logger import info, error
+
+
+__all__ = [
+    "Counter", "Gauge", "Histogram", "Registry", "REGISTRY", "spawn_metrics",
+    "DOCUMENTS", "PAGES", "PDF_INGEST_SECONDS", "QUEUE_DEPTH", "TICKETS_IN_FLIGHT",
+    "REQUESTS", "REQUEST_SECONDS", "QUEUE_WAIT_SECONDS", "TOKENS", "RETRIES", "DEAD_LETTERS",
+    "PP_SECONDS", "OUTPUT_FLUSH_SECONDS",
+]
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+
+def _escape(text: str, quote: bool = True) -> str:
+    """
+    Escapes backslashes and line feeds, and double quotes in label values, as the exposition format requires
+    """
+    text = str(text).replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quote else text
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "_Metric") -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f"# HELP {metric.name} {_escape(metric.help, quote=False)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ts": time.time(),
+            "metrics": {metric.name: metric.snapshot() for metric in list(self._metrics)},
+        }
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> Any:
+        assert len(values) == len(self.label_names), f"{self.name} expects labels {self.label_names}"
+        key = tuple(str(v) for v in values)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = self._new_child()
+            return self._children[key]
+
+    def _items(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(child.get())}"
+            for key, child in self._items()
+        ]
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [
+            {"labels": dict(zip(self.label_names, key)), "value": child.get()}
+            for key, child in self._items()
+        ]
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.) -> None:
+        with self._lock:
+            self._value += amount
+
+    def get(self) -> float:
+        return self._value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.) -> None:
+        self.labels().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    def __init__(self):
+        super().__init__()
+        self._fn: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def dec(self, amount: float = 1.) -> None:
+        self.inc(-amount)
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        """
+        The value is read from fn at scrape time, e.g. a queue length
+        """
+        self._fn = fn
+
+    def get(self) -> float:
+        return self._fn() if self._fn else self._value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1.) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.) -> None:
+        self.labels().dec(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - ts)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket holding the q-quantile, None if it is above the last bucket
+        """
+        total = sum(self.counts)
+        if not total:
+            return None
+        seen = 0
+        for idx, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= q * total:
+                return self.buckets[idx] if idx < len(self.buckets) else None
+        return None
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+            registry: Registry = REGISTRY,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, child in self._items():
+            cumulative = 0
+            for bound, cnt in zip([*self.buckets, "+Inf"], child.counts):
+                cumulative += cnt
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "labels": dict(zip(self.label_names, key)),
+                "count": sum(child.counts),
+                "sum": child.sum,
+                "p50": child.quantile(0.5),
+                "p95": child.quantile(0.95),
+            }
+            for key, child in self._items()
+        ]
+
+
+DOCUMENTS = Counter("summ_documents_total", "Documents handled, by result: done, failed", ("result",))
+PAGES = Counter("summ_pages_total", "Pages split from PDFs, by step1 source: llm, local", ("source",))
+PDF_INGEST_SECONDS = Histogram("summ_pdf_ingest_seconds", "From process_pdf until every page of a PDF is split")
+QUEUE_DEPTH = Gauge("summ_queue_depth", "Items waiting in a queue: tickets, events", ("queue",))
+TICKETS_IN_FLIGHT = Gauge("summ_tickets_in_flight", "Tickets being sent to a model or post-processed")
+REQUESTS = Counter(
+    "summ_requests_total", "Model calls of tickets, by model and result: ok, error, cache_hit", ("model", "result")
+)
+REQUEST_SECONDS = Histogram(
+    "summ_request_seconds", "Model call latency of tickets, rate limiter wait excluded", ("model",)
+)
+QUEUE_WAIT_SECONDS = Histogram("summ_queue_wait_seconds", "Rate limiter admission wait", ("model",))
+TOKENS = Counter("summ_tokens_total", "Tokens paid for, by model and kind: in, in_cached, out", ("model", "kind"))
+RETRIES = Counter("summ_retries_total", "Re-queued tickets, by error kind", ("kind",))
+DEAD_LETTERS = Counter("summ_dead_letters_total", "Tickets out of retry attempts, by error kind", ("kind",))
+PP_SECONDS = Histogram("summ_pp_seconds", "Post-processing of model answers, by ticket type", ("ticket",))
+OUTPUT_FLUSH_SECONDS = Histogram("summ_output_flush_seconds", "Re-writing output CSVs")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = REGISTRY.render(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(REGISTRY.snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log
+        pass
+
+
+def write_snapshot(snapshot_file: Path) -> None:
+    tmp = snapshot_file.with_suffix(".tmp")
+    tmp.write_text(json.dumps(REGISTRY.snapshot()))
+    os.replace(tmp, snapshot_file)
+
+
+def metrics_worker(stop_event: threading.Event, snapshot_file: Path, snapshot_s: float):
+    while not stop_event.wait(snapshot_s):
+        try:
+            write_snapshot(snapshot_file)
+        except OSError as e:
+            error(f"Failed to write metrics snapshot: {e}")
+
+
+def spawn_metrics(
+        port: Optional[int],
+        host: str,
+        snapshot_file: Path,
+        snapshot_s: float,
+) -> threading.Event:
+    """
+    Writes a JSON snapshot of metrics every snapshot_s; with a port, also serves
+    /metrics (Prometheus text format) and /metrics.json over HTTP
+    """
+    stop_event = threading.Event()
+
+    threading.Thread(
+        target=metrics_worker,
+        args=(stop_event, snapshot_file, snapshot_s),
+        daemon=True
+    ).start()
+
+    if port is not None:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # serve_forever() stops from another thread only
+        threading.Thread(target=lambda: (stop_event.wait(), server.shutdown()), daemon=True).start()
+        info(f"metrics served at http://{host}:{server.server_port}/metrics")
+
+    info("metrics initialized")
+    return stop_event
@@ -0,0 +1,81 @@
+import re
+
+from dataclasses import dataclass, field
+from typing import List, Tuple, Optional, Dict
+
+from pypdf import PageObject
+
+from core.globals import LOCAL_STEP1_MIN_CHARS, LOCAL_STEP1_MARGIN
+
+
+__all__ = ["LocalStep1", "extract_text_lines", "classify_page"]
+
+
+# "SECTION 123456", "SECTION 123 456", "SECTION 12 34 56"
+_SECTION_RE = re.compile(r"\bSECTION\s+(\d{2}\s?\d{2}\s?\d{2})\b", re.IGNORECASE)
+_SECTION_TITLE_RE = re.compile(r"^SECTION\s+(\d{2}\s?\d{2}\s?\d{2})\b")
+# footers like "123456 - 3" or "12 34 56 - 3"
+_SECTION_FOOTER_RE = re.compile(r"^(\d{2}\s?\d{2}\s?\d{2})\s*[-–—]\s*\d+$")
+_PART_RE = re.compile(r"^PART\s+\d+\b")
+
+
+@dataclass
+class LocalStep1:
+    """
+    Step1 result taken from the page text layer, without a model call
+    """
+    sections: List[str] = field(default_factory=list)
+    parts: List[str] = field(default_factory=list)
+
+
+def extract_text_lines(page: PageObject) -> List[Tuple[float, str]]:
+    """
+    :return: (y, text) of each text line, y is relative to page height: 0. bottom, 1. top
+    """
+    box = page.mediabox
+    bottom, height = float(box.bottom), float(box.height) or 1.
+    lines: Dict[int, List[str]] = {}
+
+    def visitor(text, cm, tm, _font_dict, _font_size):
+        if not text.strip():
+            return
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        lines.setdefault(round(y), []).append(text)
+
+    page.extract_text(visitor_text=visitor)
+
+    return [
+        ((y - bottom) / height, " ".join("".join(chunks).split()))
+        for y, chunks in sorted(lines.items(), reverse=True)
+    ]
+
+
+def classify_page(lines: List[Tuple[float, str]]) -> Optional[LocalStep1]:
+    """
+    Assigns section and parts from headers, footers and headings of the text layer.
+    Plain text mentions of sections are ignored, like the step1 prompt asks the model to.
+    :return: None if the page is ambiguous and must go to the model
+    """
+    if sum(len(text) for _, text in lines) < LOCAL_STEP1_MIN_CHARS:
+        # scanned page, or no text layer at all
+        return None
+
+    sections = set()
+    parts = []
+    for y, text in lines:
+        margin = y >= 1. - LOCAL_STEP1_MARGIN or y <= LOCAL_STEP1_MARGIN
+        if margin:
+            found = _SECTION_RE.findall(text) or _SECTION_FOOTER_RE.findall(text)
+        elif text.isupper():
+            found = _SECTION_TITLE_RE.findall(text)
+        else:
+            found = []
+        sections.update(s.replace(" ", "") for s in found)
+
+        if not margin and _PART_RE.match(text) and text.isupper():
+            parts.append(text)
+
+    if len(sections) != 1:
+        return None
+
+    return LocalStep1(sections=list(sections), parts=parts)
@@ -0,0 +1,52 @@
+import tempfile
+import threading
+
+from pathlib import Path
+from typing import Tuple
+
+
+__all__ = ["PageStore"]
+
+
+class PageStore:
+    """
+    Append-only spill file for split page PDFs of a single document.
+    Pages are kept on disk and read back only when a request is being serialized, possibly by another
+    process on this host which reads them from path, see read_at(). The file is removed on close().
+    """
+    def __init__(self):
+        self._f = tempfile.NamedTemporaryFile(prefix="pdf-summ-pages-")
+        self.path = Path(self._f.name)
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def write(self, data: bytes) -> Tuple[int, int]:
+        """
+        :return: (offset, length) of written data
+        """
+        with self._lock:
+            offset = self._size
+            self._f.seek(offset)
+            self._f.write(data)
+            # visible to readers in other processes
+            self._f.flush()
+            self._size += len(data)
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> bytes:
+        with self._lock:
+            self._f.seek(offset)
+            return self._f.read(length)
+
+    @staticmethod
+    def read_at(path: Path, offset: int, length: int) -> bytes:
+        """
+        Reads a page by its location, without the PageStore object
+        """
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
@@ -1,6 +1,17 @@
+import base64
+import threading
+
+from collections import deque
+from concurrent.futures import Future
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, Iterator, List
+from typing import Optional, Iterator, List, Dict, Deque, Set, Tuple, TYPE_CHECKING
+
+from core.page_store import PageStore
+
+if TYPE_CHECKING:
+    from core.job_store import JobStore
+    from core.summarizer.step1 import Step1Heuristics
 
 
 @dataclass
@@ -10,6 +21,13 @@ class ModelCallUsage:
     tokens_in: int = 0
     tokens_out: int = 0
     ts_end: Optional[float] = None
+    # part of tokens_in served from provider side prompt cache
+    tokens_in_cached: int = 0
+    # 0 for the first call of a ticket, N for its N-th retry
+    attempt: int = 0
+    # time spent waiting for rate limiter admission, not included in ts_start..ts_end
+    queue_wait_s: float = 0.
+    cache_hit: bool = False
 
 
 @dataclass
@@ -25,12 +43,36 @@ class PDFError:
     recoverable: bool
 
 
+@dataclass
+class DeadLetter:
+    """
+    Ticket that ran out of retry attempts
+    """
+    ticket: str
+    error_kind: str
+    reason: str
+    attempts: int
+    ts: float
+
+
 @dataclass
 class PDFPageData:
-    b64_data: str
+    """
+    Split page PDF lives in the document's PageStore; base64 is produced only while a request is serialized
+    """
+    store: PageStore
+    offset: int
+    length: int
+    sha256: str
     page_num: int
     parent_path: Path
 
+    def read_bytes(self) -> bytes:
+        return self.store.read(self.offset, self.length)
+
+    def b64_data(self) -> str:
+        return base64.b64encode(self.read_bytes()).decode('utf-8')
+
 
 @dataclass
 class PDFPageDataStep1:
@@ -38,6 +80,11 @@ class PDFPageDataStep1:
     parts: List[str] = field(default_factory=list)
     success: bool = False
     section_n: Optional[int] = None
+    # "llm" or "local" if taken from the page text layer
+    source: str = "llm"
+    # self-consistency votes the result was taken from
+    samples: int = 0
+    agreement: Optional[float] = None
 
     def print(self):
         print(f"sections: {self.sections}")
@@ -45,6 +92,8 @@ class PDFPageDataStep1:
 
 
 class PDFBase:
+    __slots__ = ("errors",)
+
     def __init__(self):
         self.errors: List[PDFError] = []
 
@@ -53,12 +102,25 @@ class PDFBase:
 
 
 class PDFPage(PDFBase):
+    """
+    Page of a PDFDocument, neighbours are looked up by index in the document's page array
+    """
+    __slots__ = ("data", "data_step1", "index", "_pages")
+
     def __init__(self):
         super().__init__()
         self.data: Optional[PDFPageData] = None
-        self.prev: Optional[PDFPage] = None
-        self.next: Optional[PDFPage] = None
         self.data_step1 = PDFPageDataStep1()
+        self.index: int = 0
+        self._pages: Optional[List[PDFPage]] = None
+
+    @property
+    def prev(self) -> Optional["PDFPage"]:
+        return self._pages[self.index - 1] if self._pages is not None and self.index > 0 else None
+
+    @property
+    def next(self) -> Optional["PDFPage"]:
+        return self._pages[self.index + 1] if self._pages is not None and self.index + 1 < len(self._pages) else None
 
 
 @dataclass
@@ -79,36 +141,79 @@ class PDFDocument(PDFBase):
     def __init__(self, path: Path):
         super().__init__()
         self.path = path
-        self.pages_cnt = 0
+        # content hash, identifies the document in JobStore
+        self.doc_id: Optional[str] = None
+        self.job_store: Optional["JobStore"] = None
+        self.pages: List[PDFPage] = []
+        # page count of the PDF, known once it is opened; pages_cnt grows while it is split
+        self.pages_total: int = 0
+        # pages with step1 result, see mark_step1_done(); summarizer thread and main loop both count
+        self.step1_success_cnt: int = 0
+        self._step1_lock = threading.Lock()
         self.data_step2: List[PDFDocumentDataItemStep2] = []
         self.step1_set: bool = False
+        # step1 heuristics state, fed with the leading pages with resolved step1, see advance_step1_heuristics()
+        self.step1_heuristics: Optional["Step1Heuristics"] = None
+        # leading pages whose heuristic result can no longer change
+        self.step1_final: int = 0
+        # [start, end) page indices of sections whose pages are final
+        self.section_bounds: Dict[int, Tuple[int, int]] = {}
+        # pages held back for a step1 batch the next split chunk may fill up, see create_tickets_step1()
+        self.step1_pending: List[PDFPage] = []
+        # sections whose step2 was queued or restored
+        self.step2_dispatched: Set[int] = set()
+        # sections with a step2 result, see add_step2()
+        self.step2_sections: Set[int] = set()
         self.usage = PDFDocumentUsage()
-        self.__head: Optional[PDFPage] = None
+        self.page_store: Optional[PageStore] = None
+        # page ranges being split in the PDF pool, in page order
+        self.ingest_futures: Deque[Future] = deque()
+        self.ingested: bool = False
+        self.dead_letters: List[DeadLetter] = []
+
+    @property
+    def pages_cnt(self) -> int:
+        return len(self.pages)
 
     def insert_page(self, page: PDFPage) -> None:
-        self.pages_cnt += 1
+        page.index = len(self.pages)
+        page._pages = self.pages
+        self.pages.append(page)
+        if page.data_step1.success:
+            with self._step1_lock:
+                self.step1_success_cnt += 1
 
-        if not self.__head:
-            self.__head = page
-            return
+    def __iter__(self) -> Iterator[PDFPage]:
+        return iter(self.pages)
 
-        last = self.__head
-        while last.next:
-            last = last.next
+    def __getitem__(self, index: int) -> PDFPage:
+        return self.pages[index]
 
-        page.prev = last
-        last.next = page
+    def mark_step1_done(self, page: PDFPage) -> None:
+        with self._step1_lock:
+            if not page.data_step1.success:
+                page.data_step1.success = True
+                self.step1_success_cnt += 1
 
-    def __iter__(self) -> Iterator[PDFPage]:
-        current = self.__head
-        while current:
-            yield current
-            current = current.next
+    def add_step2(self, item: PDFDocumentDataItemStep2) -> None:
+        self.data_step2.append(item)
+        self.step2_sections.add(item.section_n)
+
+    def section_pages(self, section_n: int) -> List[PDFPage]:
+        start, end = self.section_bounds[section_n]
+        return self.pages[start:end]
+
+    def close(self) -> None:
+        for future in self.ingest_futures:
+            future.cancel()
+        self.ingest_futures.clear()
+
+        if self.page_store:
+            self.page_store.close()
+            self.page_store = None
 
     def step1_done(self) -> bool:
-        return all([page.data_step1.success for page in self])
+        return self.ingested and self.step1_success_cnt == len(self.pages)
 
     def step2_done(self) -> bool:
-        all_sections = {page.data_step1.section_n for page in self}
-        processed_sections = {d.section_n for d in self.data_step2}
-        return all_sections == processed_sections
+        return self.step1_set and self.step2_sections.issuperset(self.section_bounds)
@@ -1,51 +1,148 @@
-import base64
+import hashlib
+import multiprocessing
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple, Optional, Callable
+
 from pypdf import PdfReader, PdfWriter
 from io import BytesIO
 
+from core.globals import PDF_SPLIT_WORKERS, PDF_SPLIT_CHUNK_PAGES
 from core.logger import warn, info
+from core.metrics import PAGES, PDF_INGEST_SECONDS
+from core.page_classifier import LocalStep1, extract_text_lines, classify_page
+from core.page_store import PageStore
 from core.pdf_document import PDFDocument, PDFError, PDFPage, PDFPageData
 
 
-def process_pdf(doc: PDFDocument):
-    time_start = time.time()
+__all__ = ["spawn_pdf_pool", "process_pdf", "collect_pages"]
+
 
+def split_pages(
+        path: Path, page_start: int, page_end: int, classify: bool
+) -> List[Tuple[int, Optional[bytes], Optional[str], Optional[LocalStep1]]]:
+    """
+    Runs in a pool process: splits pages [page_start, page_end) into single page PDFs
+    :param classify: also try to take step1 results from the page text layer
+    :return: (page_num, pdf_bytes, error, local step1 result) for each page
+    """
+    reader = PdfReader(path)
+
+    results = []
+    for page_num in range(page_start, page_end):
+        try:
+            writer = PdfWriter()
+            writer.add_page(reader.pages[page_num])
+            memory_file = BytesIO()
+            writer.write(memory_file)
+            results.append((page_num, memory_file.getvalue(), None, _classify(reader, page_num) if classify else None))
+            memory_file.close()
+
+        except Exception as e:
+            results.append((page_num, None, str(e), None))
+
+    return results
+
+
+def _classify(reader: PdfReader, page_num: int) -> Optional[LocalStep1]:
+    try:
+        return classify_page(extract_text_lines(reader.pages[page_num]))
+    except Exception:
+        # broken text layer: the model will look at the page
+        return None
+
+
+def spawn_pdf_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: the parent process runs watchdog and summarizer threads
+    pool = ProcessPoolExecutor(max_workers=PDF_SPLIT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    # start workers right away, so that their start up is not paid by the first document
+    [pool.submit(time.sleep, 0) for _ in range(PDF_SPLIT_WORKERS)]
+    return pool
+
+
+def process_pdf(
+        doc: PDFDocument,
+        pool: ProcessPoolExecutor,
+        classify: bool = True,
+        on_split: Optional[Callable[[], None]] = None,
+):
+    """
+    Schedules splitting of the document in page ranges; pages are picked up with collect_pages()
+    :param classify: assign step1 results of unambiguous pages from their text layer
+    :param on_split: called from a pool thread whenever a page range is split
+    """
     try:
         reader = PdfReader(doc.path)
+        pages_cnt = len(reader.pages)
     except Exception as e:
         err = PDFError(f"Error reading PDF at path {doc.path}. Non recoverable", False)
         warn(f"{err.text}\nERROR: {e}")
         doc.errors.append(err)
         return
 
-    for page_num in range(len(reader.pages)):
-        page = PDFPage()
-        try:
-            writer = PdfWriter()
-            writer.add_page(reader.pages[page_num])
-            memory_file = BytesIO()
-            writer.write(memory_file)
-
-            pdf_bytes = memory_file.getvalue()
-            base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
+    doc.pages_total = pages_cnt
+    doc.page_store = PageStore()
+    for page_start in range(0, pages_cnt, PDF_SPLIT_CHUNK_PAGES):
+        page_end = min(page_start + PDF_SPLIT_CHUNK_PAGES, pages_cnt)
+        future = pool.submit(split_pages, doc.path, page_start, page_end, classify)
+        if on_split:
+            future.add_done_callback(lambda _: on_split())
+        doc.ingest_futures.append(future)
 
-            page_data = PDFPageData(base64_pdf, page_num + 1, doc.path)
-            page.data = page_data
+    if not doc.ingest_futures:
+        doc.ingested = True
 
-            memory_file.close()
 
+def collect_pages(doc: PDFDocument, block: bool = False) -> List[PDFPage]:
+    """
+    Inserts pages of already split leading page ranges into the document, keeping page order
+    :return: newly inserted pages
+    """
+    new_pages = []
+    while doc.ingest_futures and (block or doc.ingest_futures[0].done()):
+        future = doc.ingest_futures.popleft()
+        try:
+            results = future.result()
         except Exception as e:
-            err = PDFError(f"Error processing page {page_num} of PDF {doc.path}. Non recoverable", False)
+            err = PDFError(f"Error splitting PDF {doc.path}. Non recoverable", False)
             warn(f"{err.text}\nERROR: {e}")
-            page.errors.append(err)
+            doc.errors.append(err)
+            doc.ingest_futures.clear()
+            break
+
+        for page_num, pdf_bytes, page_error, local in results:
+            page = PDFPage()
+            if page_error:
+                err = PDFError(f"Error processing page {page_num} of PDF {doc.path}. Non recoverable", False)
+                warn(f"{err.text}\nERROR: {page_error}")
+                page.errors.append(err)
+            else:
+                offset, length = doc.page_store.write(pdf_bytes)
+                page.data = PDFPageData(
+                    doc.page_store, offset, length, hashlib.sha256(pdf_bytes).hexdigest(), page_num + 1, doc.path
+                )
+                if local:
+                    page.data_step1.sections = local.sections
+                    page.data_step1.parts = local.parts
+                    page.data_step1.source = "local"
+                    page.data_step1.success = True
 
-        finally:
             doc.insert_page(page)
+            new_pages.append(page)
+            if not page_error:
+                PAGES.labels(page.data_step1.source).inc()
+
+    if not doc.ingest_futures and not doc.ingested:
+        doc.ingested = True
+        PDF_INGEST_SECONDS.observe(time.time() - doc.usage.ts_start)
+        info(
+            f"Processed PDF {doc.path.name} in {time.time() - doc.usage.ts_start:.3f}s:\n"
+            f"Pages: {doc.pages_cnt}\n"
+            f"Pages classified from text layer: {sum(1 for p in doc if p.data_step1.source == 'local')}\n"
+            f"Document has Unrecoverable Errors: {doc.has_unrecoverable_errors()}\n"
+            f"Any Page has Unrecoverable Errors: {any([p.has_unrecoverable_errors() for p in doc])}\n"
+        )
 
-    info(
-        f"Processed PDF {doc.path.name} in {time.time() - time_start:.3f}s:\n"
-        f"Pages: {doc.pages_cnt}\n"
-        f"Document has Unrecoverable Errors: {doc.has_unrecoverable_errors()}\n"
-        f"Any Page has Unrecoverable Errors: {any([p.has_unrecoverable_errors() for p in doc])}\n"
-    )
+    return new_pages
@@ -1,12 +1,13 @@
 import time
 import threading
 from pathlib import Path
-from queue import Queue
-from typing import Iterator
+from typing import Iterator, Optional
 
 from watchdog.events import FileSystemEvent, FileSystemEventHandler
 from watchdog.observers import Observer
 
+from core.events import EventQueue
+from core.file_index import FileIndex
 from core.logger import info
 
 
@@ -22,18 +23,22 @@ def scan_existing_files(directory: Path) -> Iterator[Path]:
 
 
 class EventHandler(FileSystemEventHandler):
-    def __init__(self, queue: Queue):
+    def __init__(self, queue: EventQueue, file_index: Optional[FileIndex]):
         super().__init__()
         self.queue = queue
+        self.file_index = file_index
 
     def on_created(self, event: FileSystemEvent) -> None:
         path = Path(event.src_path)
         if path.match(FILE_RULE):
-            self.queue.put(Path(event.src_path))
+            if self.file_index and self.file_index.is_done(path):
+                info(f"{path.name} was already processed. SKIPPING")
+                return
+            self.queue.put_file(Path(event.src_path))
 
 
-def watchdog_worker(target_dir: Path, queue: Queue, stop_event: threading.Event):
-    event_handler = EventHandler(queue)
+def watchdog_worker(target_dir: Path, queue: EventQueue, stop_event: threading.Event, file_index: Optional[FileIndex]):
+    event_handler = EventHandler(queue, file_index)
     observer = Observer()
     observer.schedule(event_handler, str(target_dir), recursive=True)
     observer.start()
@@ -45,14 +50,21 @@ def watchdog_worker(target_dir: Path, queue: Queue, stop_event: threading.Event)
         observer.join()
 
 
-def spawn_watchdog(q: Queue, target_dir: Path) -> threading.Event:
+def spawn_watchdog(q: EventQueue, target_dir: Path, file_index: Optional[FileIndex] = None) -> threading.Event:
     stop_event = threading.Event()
 
-    [q.put(f) for f in scan_existing_files(target_dir)]
+    skipped = 0
+    for f in scan_existing_files(target_dir):
+        if file_index and file_index.is_done(f):
+            skipped += 1
+            continue
+        q.put_file(f)
+    if skipped:
+        info(f"{skipped} PDFs were already processed and are unchanged. SKIPPING")
 
     watchdog_thread = threading.Thread(
         target=watchdog_worker,
-        args=(target_dir, q, stop_event),
+        args=(target_dir, q, stop_event, file_index),
         daemon=True
     )
     watchdog_thread.start()
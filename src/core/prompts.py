@@ -8,6 +8,8 @@ from pathlib import Path
 class Prompts:
     SP_markdown_sections_and_parts: str
     USER_markdown_sections_and_parts: str
+    SP_markdown_sections_and_parts_batch: str
+    USER_markdown_sections_and_parts_batch: str
     SP_summarize_section_and_parts: str
     USER_summarize_section_and_parts: str
 
@@ -20,6 +22,8 @@ def load_prompts(base_dir: Path):
     return Prompts(
         SP_markdown_sections_and_parts=prompts_dict['SP_markdown_sections_and_parts'],
         USER_markdown_sections_and_parts=prompts_dict['USER_markdown_sections_and_parts'],
+        SP_markdown_sections_and_parts_batch=prompts_dict['SP_markdown_sections_and_parts_batch'],
+        USER_markdown_sections_and_parts_batch=prompts_dict['USER_markdown_sections_and_parts_batch'],
         SP_summarize_section_and_parts=prompts_dict['SP_summarize_section_and_parts'],
         USER_summarize_section_and_parts=prompts_dict['USER_summarize_section_and_parts']
     )
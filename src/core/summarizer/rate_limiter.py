@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from typing import Optional, List, Dict, Callable
+
+from llm_completion.models import ModelInfo
+
+
+__all__ = ["TokenBucket", "ModelRateLimiter", "RateLimiters"]
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds at most `capacity` units, refills at `capacity / period_s` units per second.
+    Level may go below zero after reconcile(), which simply delays next admissions.
+    A bucket shared between processes keeps level and ts in a store and uses wall clock time.
+    """
+    def __init__(self, capacity: float, period_s: float = 60., clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / period_s
+        self.clock = clock
+        self.level = capacity
+        self.ts = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.
+        return (amount - self.level) / self.rate
+
+    def fill(self) -> float:
+        """
+        :return: share of capacity available, 0..1
+        """
+        self._refill()
+        return max(0., self.level / self.capacity)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class ModelRateLimiter:
+    """
+    Admits requests of a single model just under its configured TPM and RPM.
+    Waiters are served in FIFO order, so a big request is not starved by a stream of small ones.
+    """
+    def __init__(self, tpm: Optional[int], rpm: Optional[int], headroom: float):
+        self.tokens = TokenBucket(tpm * headroom) if tpm else None
+        self.requests = TokenBucket(rpm * headroom) if rpm else None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> float:
+        """
+        :return: seconds spent waiting for admission
+        """
+        ts_start = time.monotonic()
+        async with self._lock:
+            while True:
+                wait = max(
+                    self.tokens.wait_time(tokens) if self.tokens else 0.,
+                    self.requests.wait_time(1) if self.requests else 0.,
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.tokens:
+                self.tokens.consume(tokens)
+            if self.requests:
+                self.requests.consume(1)
+
+        return time.monotonic() - ts_start
+
+    def budget(self) -> float:
+        """
+        :return: share of TPM / RPM budget left, 0..1
+        """
+        return min(
+            self.tokens.fill() if self.tokens else 1.,
+            self.requests.fill() if self.requests else 1.,
+        )
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        """
+        Corrects the token bucket once the provider reported real usage
+        """
+        if self.tokens and actual:
+            self.tokens.level -= actual - estimated
+
+
+class RateLimiters:
+    def __init__(self, model_list: List[ModelInfo], headroom: float):
+        self._limiters: Dict[str, ModelRateLimiter] = {
+            m.name: ModelRateLimiter(m.tokens_per_minute, m.request_per_minute, headroom)
+            for m in model_list
+        }
+
+    def get(self, model_name: str) -> Optional[ModelRateLimiter]:
+        return self._limiters.get(model_name)
+
+    def budget(self, model_name: str) -> float:
+        limiter = self._limiters.get(model_name)
+        return limiter.budget() if limiter else 1.
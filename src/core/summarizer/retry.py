@@ -0,0 +1,89 @@
+import json
+import random
+import time
+
+from typing import Dict, Any
+
+from core.globals import (
+    RETRY_MAX_ATTEMPTS, RETRY_MAX_ATTEMPTS_RATE_LIMIT, RETRY_BACKOFF_BASE_S, RETRY_BACKOFF_MAX_S, FAILED_DUMP_FILE
+)
+from core.logger import warn, error
+from core.metrics import RETRIES, DEAD_LETTERS
+from core.pdf_document import PDFDocument, PDFError, DeadLetter
+from core.summarizer.summ_utils import SummarizeTicket
+from core.summarizer.ticket_queue import TicketQueue
+from llm_completion.errors import RATE_LIMIT, TRANSPORT, FATAL, classify_error
+
+
+__all__ = [
+    "RATE_LIMIT", "TRANSPORT", "PARSE", "FATAL",
+    "classify_error", "backoff_s", "retry_ticket", "dump_failed_results",
+]
+
+
+# the model answered, but the answer is unusable
+PARSE = "parse"
+
+
+def backoff_s(attempts: int) -> float:
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0., min(RETRY_BACKOFF_MAX_S, RETRY_BACKOFF_BASE_S * 2 ** (attempts - 1)))
+
+
+def retry_ticket(q: TicketQueue, ticket: SummarizeTicket, error_kind: str, reason: str) -> bool:
+    """
+    Re-queues a failed ticket after a backoff, while its attempt budget lasts.
+    Otherwise the ticket is dead-lettered and its document fails.
+    :return: True if the ticket was re-queued
+    """
+    ticket.attempts += 1
+    max_attempts = RETRY_MAX_ATTEMPTS_RATE_LIMIT if error_kind == RATE_LIMIT else RETRY_MAX_ATTEMPTS
+
+    if error_kind != FATAL and ticket.attempts < max_attempts:
+        delay_s = backoff_s(ticket.attempts)
+        warn(
+            f"{ticket.describe()} of {ticket.doc.path.name} failed ({error_kind}), "
+            f"attempt {ticket.attempts}/{max_attempts}, retrying in {delay_s:.1f}s"
+        )
+        q.put_later(ticket, delay_s)
+        RETRIES.labels(error_kind).inc()
+        return True
+
+    error(f"{ticket.describe()} of {ticket.doc.path.name} failed ({error_kind}) after {ticket.attempts} attempts")
+    DEAD_LETTERS.labels(error_kind).inc()
+    ticket.doc.dead_letters.append(DeadLetter(
+        ticket=ticket.describe(),
+        error_kind=error_kind,
+        reason=reason,
+        attempts=ticket.attempts,
+        ts=time.time(),
+    ))
+    ticket.doc.errors.append(PDFError(f"{ticket.describe()} failed: {reason}", False))
+    return False
+
+
+def dump_failed_results(doc: PDFDocument) -> Dict[str, Any]:
+    data = {
+        "file_path": str(doc.path),
+        "file_name": doc.path.name,
+        "pages_cnt": doc.pages_cnt,
+        "errors": [e.text for e in doc.errors if not e.recoverable],
+        "dead_letters": [
+            {
+                "ticket": d.ticket,
+                "error_kind": d.error_kind,
+                "reason": d.reason,
+                "attempts": d.attempts,
+                "ts": d.ts,
+            }
+            for d in doc.dead_letters
+        ],
+        "calls": len(doc.usage.calls),
+    }
+
+    with FAILED_DUMP_FILE.open("a") as f:
+        f.write(json.dumps(data) + "\n")
+
+    return data
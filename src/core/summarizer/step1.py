@@ -1,25 +1,68 @@
 import json
 import re
 
-from dataclasses import dataclass
-from queue import Queue
-from typing import List, Dict, Any
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Tuple, Optional
 
-from core.globals import SUMMARIZER_MODEL, STEP1_DUMP_FILE
+from core.globals import (
+    SUMMARIZER_MODEL, STEP1_DUMP_FILE, STEP1_N_INITIAL, STEP1_N_MAX, STEP1_AGREEMENT_THRESHOLD,
+    PDF_PAGE_TOKENS, STEP1_BATCH_PROMPT_TOKENS, STEP1_BATCH_MAX_TOKENS, STEP1_BATCH_PAGE_OUTPUT_TOKENS
+)
 from core.logger import warn
 from core.pdf_document import PDFPage, PDFDocument
 from core.prompts import Prompts
-from core.summarizer.summ_utils import SummarizeTicket, create_page_message, most_frequent, create_content_pdf
+from core.summarizer.retry import retry_ticket, PARSE
+from core.summarizer.ticket_queue import TicketQueue
+from core.summarizer.summ_utils import (
+    SummarizeTicket, create_page_message, most_frequent, create_content_pdf, agreement
+)
 
 from llm_completion.completion import CompletionPayload, ChatMessage
+from llm_completion.models import ModelInfo
 
 
 @dataclass
 class SummarizeStep1Ticket(SummarizeTicket):
     page: PDFPage
+    # (page_number, sections, parts) of every parsed choice, accumulated over escalations
+    samples: List[Tuple[Any, Any, Any]] = field(default_factory=list)
 
+    def describe(self) -> str:
+        return f"step1 page {self.page.data.page_num}"
 
-def pp(ticket: SummarizeStep1Ticket, res: List[Dict[str, Any]], q: Queue):
+    def priority(self) -> int:
+        # escalated for more samples: the page is half done
+        return 0 if self.attempts or self.samples else 1
+
+
+def _vote_key(sections: Any, parts: Any) -> str:
+    """
+    What samples must agree on: sections and part numbers, as heuristics only look at those
+    """
+    part_numbers = sorted(re.findall(r"part\s+(\d+)", str(parts), re.IGNORECASE))
+    return str((sorted(str(s) for s in sections) if isinstance(sections, list) else sections, part_numbers))
+
+
+def _validation_error(sections: Any, parts: Any) -> Optional[str]:
+    if not isinstance(sections, list) or not isinstance(parts, list):
+        return "Error: sections and parts must be lists"
+
+    if len(sections) > 1:
+        return "Error: there only could be 1 section in a page"
+
+    if any(not re.match(r'^\d{6}$', str(s)) for s in sections):
+        return "Error: section must be always a 6-digit number"
+
+    return None
+
+
+def _retry(ticket: SummarizeStep1Ticket, q: TicketQueue, reason: str):
+    ticket.samples.clear()
+    ticket.post.n = STEP1_N_INITIAL
+    retry_ticket(q, ticket, PARSE, reason)
+
+
+def pp(ticket: SummarizeStep1Ticket, res: List[Dict[str, Any]], q: TicketQueue):
     r = res[0]
     ch0 = r["choices"][0]
 
@@ -46,48 +89,45 @@ def pp(ticket: SummarizeStep1Ticket, res: List[Dict[str, Any]], q: Queue):
         except Exception as e:
             errors.append(e)
 
-    if len(errors) == len(r["choices"]) and not sections_all and not parts_all:
+    if len(errors) == len(r["choices"]) and not sections_all and not parts_all and not ticket.samples:
         text = f"couldn't parse markdown sections and parts from model response. Response:\n{ch0}\nErrors: {errors}"
-        ticket.post.messages.append(
-            ChatMessage(role="user", content=text)
+        ticket.set_retry_messages(
+            str(ch0.get("message", {}).get("content")),
+            f"Error: couldn't parse sections and parts from your answer: {errors}"
         )
-        warn(text)
-        q.put(ticket)
+        _retry(ticket, q, text)
         return
 
-    _page_number = most_frequent(page_number_all)
-    sections = most_frequent(sections_all)
-    parts = most_frequent(parts_all)
-
-    ticket.post.messages.append(
-        ChatMessage(role="assistant", content=json.dumps(
-            {"page_number": ticket.page.data.page_num, "sections": sections, "parts": parts}))
-    )
+    ticket.samples.extend(zip(page_number_all, sections_all, parts_all))
+    samples_agreement = agreement([_vote_key(s, p) for _, s, p in ticket.samples])
 
-    if len(sections) > 1:
-        ticket.post.messages.append(
-            ChatMessage(role="user", content="Error: there only could be 1 section in a page")
-        )
+    # adaptive self-consistency: sample more only if the first samples disagree.
+    # An escalation whose answers were all unparseable adds nothing, the vote is taken from the samples at hand
+    if sections_all and samples_agreement < STEP1_AGREEMENT_THRESHOLD and len(ticket.samples) < STEP1_N_MAX:
+        ticket.post.n = STEP1_N_MAX - len(ticket.samples)
         q.put(ticket)
         return
 
-    if any(not re.match(r'^\d{6}$', str(s)) for s in sections):
-        ticket.post.messages.append(
-            ChatMessage(role="user", content="Error: section must be always a 6-digit number")
-        )
-        q.put(ticket)
-        return
+    _page_number = most_frequent([n for n, _, _ in ticket.samples])
+    sections = most_frequent([s for _, s, _ in ticket.samples])
+    parts = most_frequent([p for _, _, p in ticket.samples])
+    samples_cnt = len(ticket.samples)
 
-    if not isinstance(sections, list) or not isinstance(parts, list):
-        ticket.post.messages.append(
-            ChatMessage(role="user", content="Error: sections and parts must be lists")
+    if err := _validation_error(sections, parts):
+        ticket.set_retry_messages(
+            json.dumps({"page_number": ticket.page.data.page_num, "sections": sections, "parts": parts}), err
         )
-        q.put(ticket)
+        _retry(ticket, q, err)
         return
 
     ticket.page.data_step1.sections = sections
     ticket.page.data_step1.parts = parts
-    ticket.page.data_step1.success = True
+    ticket.page.data_step1.samples = samples_cnt
+    ticket.page.data_step1.agreement = samples_agreement
+    ticket.doc.mark_step1_done(ticket.page)
+
+    if ticket.doc.job_store:
+        ticket.doc.job_store.save_step1(ticket.doc, ticket.page)
 
 
 def create_ticket_step1(
@@ -96,8 +136,10 @@ def create_ticket_step1(
         prompts: Prompts,
         pages_before: int = 0, pages_after: int = 0
 ) -> SummarizeStep1Ticket:
+    # static instructions first: the prefix is the same for every page and can be cached by providers
     messages = [
         ChatMessage(role="system", content=prompts.SP_markdown_sections_and_parts),
+        ChatMessage(role="user", content=prompts.USER_markdown_sections_and_parts, cache_breakpoint=True),
     ]
 
     current = page
@@ -123,57 +165,305 @@ def create_ticket_step1(
         ]
     ))
 
-    messages.append(ChatMessage(role="user", content=prompts.USER_markdown_sections_and_parts))
-
     post = CompletionPayload(
         model=SUMMARIZER_MODEL,
         messages=messages,
         stream=False,
         max_tokens=8192,
-        n=8, # WARNING: not all models support N > 1
+        n=STEP1_N_INITIAL, # WARNING: not all models support N > 1
         temperature=0.6,
     )
 
     return SummarizeStep1Ticket(pp, post, doc, page)
 
 
-def post_step1_heuristics(doc: PDFDocument):
-    for page in doc:
-        if prev := page.prev:
-            if prev.data_step1.sections != page.data_step1.sections:
-                if any(re.search(r'part\s+(?:[2-9]|[1-9]\d+)', p, re.IGNORECASE) for p in page.data_step1.parts):
-                    page.data_step1.sections = []
+@dataclass
+class SummarizeStep1BatchTicket(SummarizeTicket):
+    pages: List[PDFPage]
+    # pages that fail are retried one by one with single page tickets
+    prompts: Prompts
+
+    def describe(self) -> str:
+        return f"step1 pages {self.pages[0].data.page_num}-{self.pages[-1].data.page_num}"
 
-    for page in doc:
-        page.data_step1.sections = list(set(page.data_step1.sections))
-        page.data_step1.parts = list(set(page.data_step1.parts))
 
-        if not page.data_step1.sections:
-            if prev := page.prev:
-                page.data_step1.sections = prev.data_step1.sections
+def _parse_batch_choice(content: str, pages: List[PDFPage]) -> Dict[int, Tuple[Any, Any]]:
+    """
+    :return: page index in the batch -> (sections, parts); objects are matched by page_number, else by position
+    """
+    content = content.replace("```json\n", "").replace("\n```", "")
+    items = json.loads(content)
+    if not isinstance(items, list):
+        raise ValueError("batch response must be a JSON array")
 
-    for page in doc:
-        if (prev := page.prev) and (next_ := page.next):
-            if set(prev.data_step1.sections) == set(next_.data_step1.sections) != set(page.data_step1.sections):
-                page.data_step1.sections = prev.data_step1.sections
+    page_idx = {page.data.page_num: idx for idx, page in enumerate(pages)}
+    by_number = all(isinstance(d, dict) and d.get("page_number") in page_idx for d in items)
 
-    section_n = 0
-    for idx, page in enumerate(doc, 1):
-        if idx == 1:
-            pass
+    parsed = {}
+    for pos, d in enumerate(items):
+        try:
+            idx = page_idx[d["page_number"]] if by_number else pos
+            if idx < len(pages):
+                parsed[idx] = (d["sections"], d["parts"])
+        except (KeyError, TypeError):
+            continue
+
+    return parsed
 
-        elif any(re.search(r"part\s+1\b", p, re.IGNORECASE) for p in page.data_step1.parts):
-            section_n += 1
 
-        elif prev := page.prev:
-            if prev.data_step1.sections != page.data_step1.sections:
-                section_n += 1
+def pp_batch(ticket: SummarizeStep1BatchTicket, res: List[Dict[str, Any]], q: TicketQueue):
+    r = res[0]
+
+    samples: Dict[int, List[Tuple[Any, Any]]] = {idx: [] for idx in range(len(ticket.pages))}
+    for ch in r["choices"]:
+        try:
+            for idx, sample in _parse_batch_choice(ch["message"]["content"], ticket.pages).items():
+                samples[idx].append(sample)
+        except Exception as e:
+            warn(f"couldn't parse step1 batch response: {e}")
+
+    retry = []
+    for idx, page in enumerate(ticket.pages):
+        page_samples = samples[idx]
+        page_agreement = agreement([_vote_key(s, p) for s, p in page_samples])
+        # pages the batch is not sure about get their own adaptive sampling
+        if not page_samples or page_agreement < STEP1_AGREEMENT_THRESHOLD:
+            retry.append(page)
+            continue
+
+        sections = most_frequent([s for s, _ in page_samples])
+        parts = most_frequent([p for _, p in page_samples])
+        if _validation_error(sections, parts):
+            retry.append(page)
+            continue
+
+        page.data_step1.sections = sections
+        page.data_step1.parts = parts
+        page.data_step1.samples = len(page_samples)
+        page.data_step1.agreement = page_agreement
+        ticket.doc.mark_step1_done(page)
+
+        if ticket.doc.job_store:
+            ticket.doc.job_store.save_step1(ticket.doc, page)
+
+    if retry:
+        warn(
+            f"step1 batch of {ticket.doc.path.name}: retrying pages "
+            f"{[p.data.page_num for p in retry]} one by one"
+        )
+    [q.put(create_ticket_step1(ticket.doc, page, ticket.prompts)) for page in retry]
+
+
+def step1_batch_size(model: ModelInfo, max_pages: int) -> int:
+    """
+    Pages per step1 batch request: max_pages, as long as pages fit the model's context window
+    and their answers fit the output token limit
+    """
+    fit_input = (model.context_window - STEP1_BATCH_PROMPT_TOKENS) // PDF_PAGE_TOKENS
+    fit_output = min(model.max_output_tokens, STEP1_BATCH_MAX_TOKENS) // STEP1_BATCH_PAGE_OUTPUT_TOKENS
+    return max(1, min(max_pages, fit_input, fit_output))
+
+
+def create_ticket_step1_batch(
+        doc: PDFDocument,
+        pages: List[PDFPage],
+        prompts: Prompts,
+) -> SummarizeStep1BatchTicket:
+    messages = [
+        ChatMessage(role="system", content=prompts.SP_markdown_sections_and_parts_batch),
+        ChatMessage(role="user", content=prompts.USER_markdown_sections_and_parts_batch, cache_breakpoint=True),
+    ]
+
+    for page in pages:
+        messages.append(ChatMessage(
+            role="user",
+            content=[
+                {"type": "text", "content": f"page_number: {page.data.page_num}"},
+                create_content_pdf(page),
+            ]
+        ))
+
+    post = CompletionPayload(
+        model=SUMMARIZER_MODEL,
+        messages=messages,
+        stream=False,
+        max_tokens=STEP1_BATCH_MAX_TOKENS,
+        n=STEP1_N_INITIAL, # WARNING: not all models support N > 1
+        temperature=0.6,
+    )
+
+    return SummarizeStep1BatchTicket(pp_batch, post, doc, pages, prompts)
+
+
+def create_tickets_step1(
+        doc: PDFDocument,
+        pages: List[PDFPage],
+        prompts: Prompts,
+        batch_size: int = 1,
+) -> List[SummarizeTicket]:
+    """
+    One ticket per page, or per run of up to batch_size consecutive pages.
+    Pages arrive in split chunks: a short last run which the next chunk may continue waits for it
+    in doc.step1_pending, so that batches are not cut at chunk boundaries
+    """
+    if batch_size <= 1:
+        return [create_ticket_step1(doc, page, prompts) for page in pages]
+
+    runs: List[List[PDFPage]] = []
+    for page in [*doc.step1_pending, *pages]:
+        if runs and len(runs[-1]) < batch_size and runs[-1][-1].data.page_num + 1 == page.data.page_num:
+            runs[-1].append(page)
+        else:
+            runs.append([page])
+
+    doc.step1_pending = []
+    if runs and len(runs[-1]) < batch_size and not doc.ingested and runs[-1][-1] is doc.pages[-1]:
+        doc.step1_pending = runs.pop()
+
+    return [
+        create_ticket_step1(doc, run[0], prompts) if len(run) == 1 else create_ticket_step1_batch(doc, run, prompts)
+        for run in runs
+    ]
 
-        page.data_step1.section_n = section_n
 
+# (sections, parts) of a page, as answered by step1
+Step1Raw = Tuple[List[str], List[str]]
+# (sections, parts, section_n) of a page after the heuristics
+Step1Resolved = Tuple[List[str], List[str], int]
+
+
+class Step1Heuristics:
+    """
+    Cleans up step1 answers of consecutive pages and numbers their sections, page by page.
+    The result of a page depends only on the pages before it and the one page after it:
+    it is returned once the next page is added, or by flush() for the last page of a document.
+    State of the pages before is carried over, so that each page is handled once.
+    """
+    def __init__(self):
+        # pages added
+        self.count = 0
+        # sections of the previous page after each pass: parts check, fill-in, smoothing
+        self._prev_checked: Optional[List[str]] = None
+        self._prev_filled: Optional[List[str]] = None
+        self._prev_smoothed: Optional[List[str]] = None
+        # (sections, parts) of the last page, waiting for the next one
+        self._pending: Optional[Tuple[List[str], List[str]]] = None
+        self._section_n = 0
+
+    def add(self, sections: List[str], parts: List[str]) -> Optional[Step1Resolved]:
+        """
+        :return: result of the previous page, which is final now
+        """
+        checked = list(sections)
+        if self.count and self._prev_checked != checked:
+            if any(re.search(r'part\s+(?:[2-9]|[1-9]\d+)', p, re.IGNORECASE) for p in parts):
+                checked = []
+        self._prev_checked = checked
+
+        filled = list(set(checked))
+        if not filled and self.count:
+            filled = self._prev_filled
+        self._prev_filled = filled
+
+        result = self._resolve(filled) if self._pending else None
+        self._pending = (filled, list(set(parts)))
+        self.count += 1
+        return result
+
+    def flush(self) -> Optional[Step1Resolved]:
+        """
+        :return: result of the last page, once no page follows it
+        """
+        result = self._resolve(None) if self._pending else None
+        self._pending = None
+        return result
+
+    def _resolve(self, next_sections: Optional[List[str]]) -> Step1Resolved:
+        sections, parts = self._pending
+        first = self.count == 1
+
+        # a page between two pages of the same section belongs to it
+        if next_sections is not None and not first:
+            if set(self._prev_smoothed) == set(next_sections) != set(sections):
+                sections = self._prev_smoothed
+
+        if first:
+            pass
 
-def dump_step1_results(doc: PDFDocument):
-    data = {
+        elif any(re.search(r"part\s+1\b", p, re.IGNORECASE) for p in parts):
+            self._section_n += 1
+
+        elif self._prev_smoothed != sections:
+            self._section_n += 1
+
+        self._prev_smoothed = sections
+        return sections, parts, self._section_n
+
+
+def step1_heuristics(raw: List[Step1Raw]) -> List[Step1Resolved]:
+    """
+    Step1 heuristics over a whole document, see Step1Heuristics
+    :param raw: (sections, parts) of consecutive pages from the first one
+    """
+    heuristics = Step1Heuristics()
+    results = [r for sections, parts in raw if (r := heuristics.add(sections, parts))]
+    if last := heuristics.flush():
+        results.append(last)
+    return results
+
+
+def section_name(doc: PDFDocument, section_n: int) -> str:
+    """
+    Name of a section is taken from its last page, which may have none if the document starts without one
+    """
+    page = doc.section_pages(section_n)[-1]
+    return page.data_step1.sections[0] if page.data_step1.sections else ""
+
+
+def _finalize_step1(doc: PDFDocument, result: Step1Resolved) -> None:
+    idx = doc.step1_final
+    page = doc.pages[idx]
+    page.data_step1.sections, page.data_step1.parts, section_n = result
+    page.data_step1.section_n = section_n
+    start, _ = doc.section_bounds.get(section_n, (idx, idx))
+    doc.section_bounds[section_n] = (start, idx + 1)
+    doc.step1_final = idx + 1
+
+
+def advance_step1_heuristics(doc: PDFDocument) -> List[int]:
+    """
+    Feeds the leading pages with resolved step1 to the document's step1 heuristics and finalizes pages whose
+    result can no longer change. Sets doc.step1_set once every page is final.
+    :return: section numbers which became complete: a later page already belongs to another section
+    """
+    if doc.step1_heuristics is None:
+        doc.step1_heuristics = Step1Heuristics()
+    heuristics = doc.step1_heuristics
+    pages = doc.pages
+    final = doc.step1_final
+
+    while heuristics.count < len(pages) and pages[heuristics.count].data_step1.success:
+        page = pages[heuristics.count]
+        if result := heuristics.add(page.data_step1.sections, page.data_step1.parts):
+            _finalize_step1(doc, result)
+
+    last = doc.ingested and heuristics.count == len(pages)
+    # the last added page still depends on its unresolved next page
+    if last and (result := heuristics.flush()):
+        _finalize_step1(doc, result)
+
+    doc.step1_set = last
+    if doc.step1_final == final:
+        # nothing new, unless it is a document without pages
+        return []
+
+    # the section of the last final page may continue on the next pages
+    open_section = None if last else pages[doc.step1_final - 1].data_step1.section_n
+    return sorted(n for n in doc.section_bounds if n != open_section and n not in doc.step2_dispatched)
+
+
+def step1_results(doc: PDFDocument) -> Dict[str, Any]:
+    return {
         "file_path": str(doc.path),
         "file_name": doc.path.name,
         "pages_cnt": doc.pages_cnt,
@@ -183,9 +473,18 @@ def dump_step1_results(doc: PDFDocument):
                 "page_num": page.data.page_num,
                 "sections": page.data_step1.sections,
                 "section_n": page.data_step1.section_n,
+                "source": page.data_step1.source,
+                "samples": page.data_step1.samples,
+                "agreement": page.data_step1.agreement,
             } for page in doc
         ]
     }
 
+
+def dump_step1_results(doc: PDFDocument) -> Dict[str, Any]:
+    data = step1_results(doc)
+
     with STEP1_DUMP_FILE.open("a") as f:
         f.write(json.dumps(data) + "\n")
+
+    return data
@@ -1,13 +1,13 @@
 import json
 
 from dataclasses import dataclass
-from queue import Queue
 from typing import List, Dict, Any
 
 from core.globals import SUMMARIZER_MODEL, STEP2_DUMP_FILE, SUMMARIZER_FALLBACK_MODEL
-from core.logger import warn
 from core.pdf_document import PDFDocument, PDFDocumentDataItemStep2Part, PDFDocumentDataItemStep2
 from core.prompts import Prompts
+from core.summarizer.retry import retry_ticket, PARSE
+from core.summarizer.ticket_queue import TicketQueue
 from core.summarizer.summ_utils import SummarizeTicket, create_page_message
 
 from llm_completion.completion import ChatMessage, CompletionPayload
@@ -19,8 +19,15 @@ class SummarizeStep2Ticket(SummarizeTicket):
     section_n: int
     section: str
 
+    def describe(self) -> str:
+        return f"step2 section {self.section} #{self.section_n}"
 
-def pp(ticket: SummarizeStep2Ticket, res: List[Dict[str, Any]], q: Queue):
+    def priority(self) -> int:
+        # finishes a document
+        return 0
+
+
+def pp(ticket: SummarizeStep2Ticket, res: List[Dict[str, Any]], q: TicketQueue):
     r = res[0]
     ch0 = r["choices"][0]
     content = ch0["message"]["content"]
@@ -38,24 +45,21 @@ def pp(ticket: SummarizeStep2Ticket, res: List[Dict[str, Any]], q: Queue):
         ]
     except Exception as e:
         err = f"Failed to parse answer. Error:\n{e}"
-        messages = [
-            ChatMessage(role="assistant", content=content),
-            ChatMessage(role="user", content=f"{err}\nTry again, minding JSON format!")
-        ]
-        ticket.post.messages = messages
+        ticket.set_retry_messages(content, f"{err}\nTry again, minding JSON format!")
         ticket.post.model = SUMMARIZER_FALLBACK_MODEL
-        warn(err)
-        q.put(ticket)
+        retry_ticket(q, ticket, PARSE, err)
         return
 
-    ticket.doc.data_step2.append(
-        PDFDocumentDataItemStep2(
-            section=ticket.section,
-            section_n=ticket.section_n,
-            section_summary=section_summary,
-            parts=parts,
-        )
+    item = PDFDocumentDataItemStep2(
+        section=ticket.section,
+        section_n=ticket.section_n,
+        section_summary=section_summary,
+        parts=parts,
     )
+    ticket.doc.add_step2(item)
+
+    if ticket.doc.job_store:
+        ticket.doc.job_store.save_step2(ticket.doc, item)
 
 
 def create_ticket_step2(
@@ -64,11 +68,13 @@ def create_ticket_step2(
         section_n: int,
         section: str,
 ) -> SummarizeStep2Ticket:
-    pages_of_section = [p for p in doc if p.data_step1.section_n == section_n]
+    pages_of_section = doc.section_pages(section_n)
     assert pages_of_section
 
+    # static instructions first, pages last: the prefix can be cached by providers
     messages = [
-        ChatMessage(role="system", content=prompts.SP_summarize_section_and_parts)
+        ChatMessage(role="system", content=prompts.SP_summarize_section_and_parts),
+        ChatMessage(role="user", content=prompts.USER_summarize_section_and_parts, cache_breakpoint=True),
     ]
 
     for p in pages_of_section:
@@ -76,10 +82,6 @@ def create_ticket_step2(
             create_page_message(p)
         )
 
-    messages.append(
-        ChatMessage(role="user", content=prompts.USER_summarize_section_and_parts)
-    )
-
     post = CompletionPayload(
         model=SUMMARIZER_MODEL,
         messages=messages,
@@ -92,7 +94,7 @@ def create_ticket_step2(
     return SummarizeStep2Ticket(pp, post, doc, section_n, section)
 
 
-def dump_step2_results(doc: PDFDocument, model_list: List[ModelInfo]):
+def dump_step2_results(doc: PDFDocument, model_list: List[ModelInfo]) -> Dict[str, Any]:
     data = {
         "file_path": str(doc.path),
         "file_name": doc.path.name,
@@ -110,19 +112,35 @@ def dump_step2_results(doc: PDFDocument, model_list: List[ModelInfo]):
                     for p in d.parts
                 ]
             }
-            for d in doc.data_step2
+            for d in sorted(doc.data_step2, key=lambda d: d.section_n)
         ],
 
         "usage": {
+            "ts_start": doc.usage.ts_start,
+            "ts_end": doc.usage.ts_end,
             "finished_in_s": round(doc.usage.ts_end - doc.usage.ts_start, 3),
+            "step1_pages": [
+                {
+                    "page_num": page.data.page_num,
+                    "source": page.data_step1.source,
+                    "samples": page.data_step1.samples,
+                    "agreement": page.data_step1.agreement,
+                }
+                for page in doc
+            ],
             "calls": [
                 {
                     "model_name": c.model_name,
                     "finished_in_s": round(c.ts_end - c.ts_start, 3),
+                    "queue_wait_s": round(c.queue_wait_s, 3),
+                    "cache_hit": c.cache_hit,
+                    "attempt": c.attempt,
                     "tokens_in": c.tokens_in,
+                    "tokens_in_cached": c.tokens_in_cached,
                     "tokens_out": c.tokens_out,
-                    "dollars_input": resolve_model_record(c.model_name, model_list).dollars_input,
-                    "dollars_output": resolve_model_record(c.model_name, model_list).dollars_output,
+                    "dollars_input": (m := resolve_model_record(c.model_name, model_list)).dollars_input,
+                    "dollars_input_cached": m.dollars_input if m.dollars_input_cached is None else m.dollars_input_cached,
+                    "dollars_output": m.dollars_output,
                 }
                 for c in doc.usage.calls
             ]
@@ -132,3 +150,5 @@ def dump_step2_results(doc: PDFDocument, model_list: List[ModelInfo]):
 
     with STEP2_DUMP_FILE.open("a") as f:
         f.write(json.dumps(data) + "\n")
+
+    return data
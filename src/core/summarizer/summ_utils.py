@@ -1,21 +1,129 @@
-from dataclasses import dataclass
-from queue import Queue
+import base64
+
+from dataclasses import dataclass, field
 from collections import Counter
-from typing import Callable, List, Any, Dict
+from pathlib import Path
+from typing import Callable, List, Any, Dict, Tuple
 
-from core.pdf_document import PDFPage, PDFDocument
-from llm_completion.completion import CompletionPayload, ChatMessage
+from core.globals import PDF_PAGE_TOKENS
+from core.page_store import PageStore
+from core.pdf_document import PDFPage, PDFDocument, PDFPageData
+from core.summarizer.ticket_queue import TicketQueue
+from llm_completion.completion import CompletionPayload, ChatMessage, LazyContent, estimate_tokens
 
 
 @dataclass
 class SummarizeTicket:
-    pp: Callable[[Any, List[Dict[str, Any]], Queue], None]
+    pp: Callable[[Any, List[Dict[str, Any]], TicketQueue], None]
     post: CompletionPayload
     doc: PDFDocument
+    # failed attempts, see retry.retry_ticket()
+    attempts: int = field(default=0, kw_only=True)
+    # messages the ticket was created with, retries are built on top of them
+    base_messages: List[ChatMessage] = field(default_factory=list, kw_only=True)
+
+    def __post_init__(self):
+        if not self.base_messages:
+            self.base_messages = list(self.post.messages)
+
+    def describe(self) -> str:
+        return type(self).__name__
+
+    def priority(self) -> int:
+        """
+        Scheduling class: 0 finishes work in progress, 1 is new work
+        """
+        return 0 if self.attempts else 1
+
+    def set_retry_messages(self, answer: str, err: str) -> None:
+        """
+        Retry conversation: original messages (pages are sent once), the latest failed answer and the error.
+        Earlier failed answers are dropped, so that retries don't grow in cost.
+        """
+        self.post.messages = [
+            *self.base_messages,
+            ChatMessage(role="assistant", content=answer),
+            ChatMessage(role="user", content=err),
+        ]
+
+
+@dataclass
+class TicketCall:
+    """
+    Model call of a ticket, made in the summarizer or by a remote worker. JSON-serializable
+    """
+    model_name: str
+    data: List[Dict[str, Any]]
+    # wall clock, ts_start includes rate limiter admission
+    ts_start: float
+    ts_end: float
+    queue_wait_s: float = 0.
+
+    def succeeded(self) -> bool:
+        return bool(self.data) and "error" not in self.data[0]
+
+    def cache_hit(self) -> bool:
+        return bool(self.data and self.data[0].get("cache_hit"))
+
+    def replayed(self) -> bool:
+        return bool(self.data and self.data[0].get("replayed"))
+
+    def tokens(self) -> Tuple[int, int, int]:
+        """
+        :return: (tokens_in, tokens_out, tokens_in_cached) reported by the provider
+        """
+        u = self.data[0]["usage"]
+        # litellm reports provider prompt caching as OpenAI prompt_tokens_details, Anthropic as cache_read
+        details = u.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens") or u.get("cache_read_input_tokens") or 0
+        return u["prompt_tokens"], u["completion_tokens"], cached
+
+
+def pdf_content_item(b64_data: str) -> Dict[str, str]:
+    return {"type": "image_url", "image_url": f"data:application/pdf;base64,{b64_data}"}
+
+
+@dataclass
+class PDFPageContent(LazyContent):
+    data: PDFPageData
+
+    def as_dict(self) -> Dict[str, str]:
+        return pdf_content_item(self.data.b64_data())
+
+    def fingerprint(self) -> str:
+        return f"pdf:{self.data.sha256}"
+
+    def tokens(self) -> int:
+        return PDF_PAGE_TOKENS
+
+    def reference(self) -> "PDFPageRef":
+        return PDFPageRef(self.data.store.path, self.data.offset, self.data.length, self.data.sha256)
+
+
+@dataclass
+class PDFPageRef(LazyContent):
+    """
+    PDF page by its location in the document's PageStore file, read and encoded by the process
+    serializing the request, see --summarizer_procs
+    """
+    path: Path
+    offset: int
+    length: int
+    sha256: str
 
+    def as_dict(self) -> Dict[str, str]:
+        data = PageStore.read_at(self.path, self.offset, self.length)
+        return pdf_content_item(base64.b64encode(data).decode('utf-8'))
 
-def create_content_pdf(p: PDFPage) -> Dict[str, str]:
-    return {"type": "image_url", "image_url": f"data:application/pdf;base64,{p.data.b64_data}"}
+    def fingerprint(self) -> str:
+        return f"pdf:{self.sha256}"
+
+    def tokens(self) -> int:
+        return PDF_PAGE_TOKENS
+
+
+def create_content_pdf(p: PDFPage) -> PDFPageContent:
+    return PDFPageContent(p.data)
 
 
 def create_page_message(p: PDFPage) -> ChatMessage:
@@ -25,6 +133,14 @@ def create_page_message(p: PDFPage) -> ChatMessage:
     ])
 
 
+def estimate_request_tokens(post: CompletionPayload) -> int:
+    """
+    Rough input token estimate of a request: text of all messages plus PDF pages, multiplied by n.
+    Intentionally pessimistic, as it is used to stay under provider TPM limits.
+    """
+    return estimate_tokens(post.messages) * (post.n or 1)
+
+
 def most_frequent(items: List[Any]) -> Any:
     if not items:
         return None
@@ -32,3 +148,12 @@ def most_frequent(items: List[Any]) -> Any:
     str_items = [str(item) for item in items]
     most_common = Counter(str_items).most_common(1)[0][0]
     return eval(most_common)
+
+
+def agreement(items: List[Any]) -> float:
+    """
+    Share of items equal to the most frequent one
+    """
+    if not items:
+        return 0.
+    return Counter(str(item) for item in items).most_common(1)[0][1] / len(items)
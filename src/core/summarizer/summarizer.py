@@ -1,96 +1,260 @@
 import asyncio
-import queue
+import dataclasses
+import sqlite3
 import threading
 import time
 
-from copy import copy
+from typing import List, Set, Optional
 
-from queue import Queue
-from typing import List, Iterable
-
-from core.globals import SUMMARIZER_BS
+from core.events import EventQueue, TICKET
+from core.globals import SUMMARIZER_CONCURRENCY, RATE_LIMIT_HEADROOM, ROUTER_MODELS, WORK_QUEUE_POLL_S
 from core.pdf_document import ModelCallUsage
-from core.summarizer.summ_utils import SummarizeTicket
-from llm_completion.completion import llm_completion
-from core.logger import info, warn
+from core.summarizer.rate_limiter import RateLimiters
+from core.summarizer.retry import retry_ticket, classify_error, PARSE, TRANSPORT
+from core.summarizer.summ_utils import SummarizeTicket, TicketCall, estimate_request_tokens
+from core.summarizer.ticket_queue import TicketQueue, FAIR
+from core.summarizer.work_queue import RemoteTicketQueue
+from llm_completion.cache import CompletionCache
+from llm_completion.completion import CompletionPayload
+from llm_completion.recording import CompletionRecording
+from llm_completion.router import ModelRouter, Admit
+from core.logger import info, warn, error
+from core.metrics import (
+    TICKETS_IN_FLIGHT, REQUESTS, REQUEST_SECONDS, QUEUE_WAIT_SECONDS, TOKENS, PP_SECONDS
+)
 
 from llm_completion.models import ModelInfo
 
 
-__all__ = ['spawn_summarizer']
+__all__ = [
+    'spawn_summarizer', 'spawn_dispatcher', 'call_ticket', 'finish_ticket', 'finish_result', 'limiter_admission',
+]
+
+
+def record_call(ticket: SummarizeTicket, usage: ModelCallUsage):
+    if usage.ts_end is None:
+        usage.ts_end = time.time()
+    ticket.doc.usage.calls.append(usage)
+
+    if ticket.doc.job_store:
+        ticket.doc.job_store.save_call(ticket.doc, usage)
+
+
+def limiter_admission(limiters: RateLimiters) -> Admit:
+    async def admit(model_name: str, post: CompletionPayload) -> float:
+        limiter = limiters.get(model_name)
+        return await limiter.acquire(estimate_request_tokens(post)) if limiter else 0.
+
+    return admit
 
 
-async def process_ticket(q, ticket: SummarizeTicket, model_list: List[ModelInfo]):
-    data = []
+async def call_ticket(
+        post: CompletionPayload,
+        router: ModelRouter,
+        limiters: RateLimiters,
+        cache: Optional[CompletionCache],
+) -> TicketCall:
+    """
+    Model call of a ticket, with its rate limiter bookkeeping. Touches no document,
+    so that it can be made by a remote worker, see core/worker.py
+    """
+    tokens_estimated = estimate_request_tokens(post)
+    ts_start = time.time()
+    routed = await router.complete(post, cache)
+    call = TicketCall(routed.model_name, routed.data, ts_start, time.time(), routed.queue_wait_s)
+
+    # cached and replayed answers did not go through admission
+    limiter = None if call.cache_hit() or call.replayed() else limiters.get(call.model_name)
+    if limiter:
+        tokens = 0
+        if call.succeeded():
+            try:
+                tokens_in, tokens_out, _ = call.tokens()
+                tokens = tokens_in + tokens_out
+            except Exception:
+                # reported by finish_ticket()
+                pass
+        limiter.reconcile(tokens_estimated, tokens)
+
+    return call
+
+
+def finish_ticket(q, ticket: SummarizeTicket, call: TicketCall, cache: Optional[CompletionCache] = None):
+    """
+    Accounts the model call to the ticket's document, then post-processes the answer or retries the ticket
+    :param cache: a fresh answer is cached once post-processing accepted it
+    """
+    if not call.cache_hit():
+        REQUEST_SECONDS.labels(call.model_name).observe(call.ts_end - call.ts_start - call.queue_wait_s)
+        QUEUE_WAIT_SECONDS.labels(call.model_name).observe(call.queue_wait_s)
+
     usage = ModelCallUsage(
-        model_name=ticket.post.model,
-        ts_start = time.time(),
+        model_name=call.model_name,
+        ts_start=call.ts_start + call.queue_wait_s,
+        ts_end=call.ts_end,
+        queue_wait_s=call.queue_wait_s,
+        attempt=ticket.attempts,
     )
-    stream = llm_completion(model_list, ticket.post)
-    async for chunk in stream:
-        data.append(chunk)
 
+    if not call.succeeded():
+        REQUESTS.labels(call.model_name, "error").inc()
+        r = call.data[0] if call.data else {"error": "no response"}
+        retry_ticket(q, ticket, classify_error(r), r["error"])
+        record_call(ticket, usage)
+        return
+
+    REQUESTS.labels(call.model_name, "cache_hit" if call.cache_hit() else "ok").inc()
+    if call.cache_hit():
+        # served from completion cache: nothing was paid for
+        usage.cache_hit = True
+    else:
+        try:
+            usage.tokens_in, usage.tokens_out, usage.tokens_in_cached = call.tokens()
+        except Exception as e:
+            warn(f"Failed to parse usage: {e}")
+
+    TOKENS.labels(call.model_name, "in").inc(usage.tokens_in)
+    TOKENS.labels(call.model_name, "in_cached").inc(usage.tokens_in_cached)
+    TOKENS.labels(call.model_name, "out").inc(usage.tokens_out)
+
+    # recorded before pp: once pp stores the last result, the document may be finished at any moment
+    record_call(ticket, usage)
+    # pp may change the post for a retry or an escalation: the key is the post the answer was given for
+    post = dataclasses.replace(ticket.post, model=call.model_name)
+    attempts = ticket.attempts
     try:
-        d = data[0]
-        u = d["usage"]
-        prompt_tokens = u["prompt_tokens"]
-        completion_tokens = u["completion_tokens"]
-        usage.tokens_in += prompt_tokens
-        usage.tokens_out += completion_tokens
+        with PP_SECONDS.labels(type(ticket).__name__).time():
+            ticket.pp(ticket, call.data, q)
     except Exception as e:
-        warn(f"Failed to parse usage: {e}")
+        # malformed response, e.g. without choices
+        retry_ticket(q, ticket, PARSE, f"post-processing failed: {e}")
+
+    # an answer pp retried on would be served again to the retry, as long as the model repeats itself
+    if cache and not call.cache_hit() and not call.replayed() and ticket.attempts == attempts:
+        cache.put(post, call.data[0])
 
-    ticket.pp(ticket, data, q)
-    usage.ts_end = time.time()
-    ticket.doc.usage.calls.append(usage)
 
+async def process_ticket(
+        q,
+        ticket: SummarizeTicket,
+        router: ModelRouter,
+        limiters: RateLimiters,
+        cache: Optional[CompletionCache],
+):
+    if ticket.doc.has_unrecoverable_errors():
+        # the document already failed, its remaining tickets are dropped
+        return
 
-async def summarize_batch(q, items: Iterable[SummarizeTicket], model_list: List[ModelInfo]):
-    await asyncio.gather(*[
-        process_ticket(q, item, model_list) for item in items
-    ])
+    # retries are not looked up: the cached answer could only be the one that failed
+    call = await call_ticket(ticket.post, router, limiters, None if ticket.attempts else cache)
+    finish_ticket(q, ticket, call, cache)
 
 
-def summarize_worker(
-        q: Queue,
+async def run_ticket(
+        q: TicketQueue,
+        ticket: SummarizeTicket,
+        router: ModelRouter,
+        limiters: RateLimiters,
+        cache: Optional[CompletionCache],
+        slots: asyncio.Semaphore,
+        events: Optional[EventQueue],
+):
+    TICKETS_IN_FLIGHT.inc()
+    try:
+        await process_ticket(q, ticket, router, limiters, cache)
+    except Exception as e:
+        warn(f"Failed to process ticket of {ticket.doc.path.name}: {e}")
+        retry_ticket(q, ticket, TRANSPORT, str(e))
+    finally:
+        TICKETS_IN_FLIGHT.dec()
+        slots.release()
+        if events:
+            events.put_doc(TICKET, ticket.doc)
+
+
+async def summarize_loop(
+        q: TicketQueue,
         stop_event: threading.Event,
         model_list: List[ModelInfo],
+        cache: Optional[CompletionCache],
+        hedge: bool,
+        events: Optional[EventQueue],
+        recording: Optional[CompletionRecording],
+        route: bool,
 ):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    limiters = RateLimiters(model_list, RATE_LIMIT_HEADROOM)
+
+    concurrency = {m.name: m.max_concurrency or SUMMARIZER_CONCURRENCY for m in model_list}
+    model_slots = {name: asyncio.Semaphore(n) for name, n in concurrency.items()}
+    router = ModelRouter(
+        model_list, ROUTER_MODELS if route else [], limiter_admission(limiters), limiters.budget, hedge, recording,
+        model_slots
+    )
+    # tickets stay in the queue until a slot frees up
+    slots = asyncio.Semaphore(sum(concurrency.values()) or SUMMARIZER_CONCURRENCY)
+    tasks: Set[asyncio.Task] = set()
 
     try:
         while not stop_event.is_set():
-            items = []
+            await slots.acquire()
             try:
-                items.append(q.get(timeout=1.))
+                ticket = await asyncio.wait_for(q.get(), timeout=1.)
+            except asyncio.TimeoutError:
+                slots.release()
+                continue
 
-                for _ in range(SUMMARIZER_BS - 1):
-                    try:
-                        items.append(q.get_nowait())
-                    except queue.Empty:
-                        break
+            task = asyncio.create_task(run_ticket(q, ticket, router, limiters, cache, slots, events))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-            except queue.Empty:
-                continue
+    finally:
+        for task in tasks:
+            task.cancel()
 
-            if items:
-                loop.run_until_complete(summarize_batch(q, copy(items), model_list))
-                items.clear()
 
+def summarize_worker(
+        loop: asyncio.AbstractEventLoop,
+        q: TicketQueue,
+        stop_event: threading.Event,
+        model_list: List[ModelInfo],
+        cache: Optional[CompletionCache],
+        hedge: bool,
+        events: Optional[EventQueue],
+        recording: Optional[CompletionRecording],
+        route: bool,
+):
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(summarize_loop(q, stop_event, model_list, cache, hedge, events, recording, route))
     finally:
         loop.close()
 
 
 def spawn_summarizer(
-        q: Queue,
+        q: TicketQueue,
         model_list: List[ModelInfo],
+        cache: Optional[CompletionCache] = None,
+        hedge: bool = False,
+        events: Optional[EventQueue] = None,
+        scheduling: str = FAIR,
+        recording: Optional[CompletionRecording] = None,
+        route: bool = False,
 ) -> threading.Event:
+    """
+    :param hedge: race slow requests against a second model, see ModelRouter
+    :param events: notified with a TICKET event after each ticket of a document is handled
+    :param scheduling: order of queued tickets, one of ticket_queue.SCHEDULING_POLICIES
+    :param recording: record model answers, or replay recorded ones instead of calling models
+    :param route: route and fail over between ROUTER_MODELS, else requests go to the requested model only
+    """
     stop_event = threading.Event()
+    loop = asyncio.new_event_loop()
+    q.bind(loop, scheduling)
 
     thread = threading.Thread(
         target=summarize_worker,
-        args=(q, stop_event, model_list),
+        args=(loop, q, stop_event, model_list, cache, hedge, events, recording, route),
         daemon=True
     )
 
@@ -98,3 +262,63 @@ def spawn_summarizer(
     info("summarizer initialized")
 
     return stop_event
+
+
+def finish_result(
+        q,
+        ticket: SummarizeTicket,
+        call: TicketCall,
+        events: Optional[EventQueue],
+        cache: Optional[CompletionCache] = None,
+):
+    """
+    Coordinator side of a model call made in another process
+    """
+    try:
+        if not ticket.doc.has_unrecoverable_errors():
+            finish_ticket(q, ticket, call, cache)
+    except Exception as e:
+        warn(f"Failed to process ticket of {ticket.doc.path.name}: {e}")
+        retry_ticket(q, ticket, TRANSPORT, str(e))
+    finally:
+        if events:
+            events.put_doc(TICKET, ticket.doc)
+
+
+def dispatch_worker(q: RemoteTicketQueue, stop_event: threading.Event, events: Optional[EventQueue]):
+    while not stop_event.is_set():
+        try:
+            results = q.take_results()
+        except sqlite3.Error as e:
+            error(f"Failed to take results from work queue: {e}")
+            results = []
+
+        if not results:
+            stop_event.wait(WORK_QUEUE_POLL_S)
+            continue
+
+        for ticket, call in results:
+            failed = ticket.doc.has_unrecoverable_errors()
+            finish_result(q, ticket, call, events, q.cache)
+            if not failed and ticket.doc.has_unrecoverable_errors():
+                # the document failed: workers need not call models for the rest of it
+                q.drop(ticket.doc)
+
+
+def spawn_dispatcher(q: RemoteTicketQueue, events: Optional[EventQueue] = None) -> threading.Event:
+    """
+    Coordinator side of --work_queue: model calls of tickets put to q are made by workers (core/worker.py),
+    their results are post-processed here, one at a time as in the summarizer
+    :param events: notified with a TICKET event after each ticket of a document is handled
+    """
+    stop_event = threading.Event()
+    TICKETS_IN_FLIGHT.labels().set_function(q.in_flight)
+
+    threading.Thread(
+        target=dispatch_worker,
+        args=(q, stop_event, events),
+        daemon=True
+    ).start()
+    info("dispatcher initialized")
+
+    return stop_event
@@ -0,0 +1,327 @@
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+
+from dataclasses import dataclass, field
+from multiprocessing.process import BaseProcess
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from core.events import EventQueue, TICKET
+from core.globals import SUMMARIZER_CONCURRENCY, RATE_LIMIT_HEADROOM, ROUTER_MODELS
+from core.logger import init_logger, info, warn
+from core.metrics import TICKETS_IN_FLIGHT
+from core.summarizer.rate_limiter import RateLimiters
+from core.summarizer.retry import retry_ticket, TRANSPORT
+from core.summarizer.summarizer import call_ticket, finish_result, limiter_admission
+from core.summarizer.summ_utils import SummarizeTicket, TicketCall
+from core.summarizer.ticket_queue import FifoScheduler, FairScheduler, FIFO, SJF, FAIR, SCHEDULING_POLICIES
+from llm_completion.cache import CompletionCache
+from llm_completion.completion import CompletionPayload, payload_by_reference
+from llm_completion.models import ModelInfo
+from llm_completion.router import ModelRouter
+
+
+__all__ = ["ProcessTicketQueue", "spawn_summarizer_procs"]
+
+
+def process_concurrency(model_list: List[ModelInfo], procs: int) -> Dict[str, int]:
+    """
+    In-flight requests per model of a single summarizer process: max_concurrency is split between processes
+    """
+    return {m.name: max(1, (m.max_concurrency or SUMMARIZER_CONCURRENCY) // procs) for m in model_list}
+
+
+@dataclass
+class SummarizerProcess:
+    process: BaseProcess
+    requests: multiprocessing.Queue
+    # ids of tickets handed to the process whose result has not come back
+    tickets: Set[int] = field(default_factory=set)
+
+
+class ProcessTicketQueue:
+    """
+    TicketQueue of the coordinator with --summarizer_procs: tickets are ordered by the scheduling policy here
+    and handed to summarizer processes only as they have free slots, so that the policy still applies.
+    Ticket objects (document, post-processing) stay here until the result of their model call comes back.
+    Pages are sent by reference: processes read and encode them. The completion cache is kept here only,
+    cached answers don't go to the processes. A process that died is replaced, see check_processes()
+    """
+    def __init__(
+            self,
+            start: Callable[[], SummarizerProcess],
+            procs: int,
+            slots: int,
+            results: multiprocessing.Queue,
+            policy: str = FIFO,
+            cache: Optional[CompletionCache] = None,
+            events: Optional[EventQueue] = None,
+    ):
+        """
+        :param start: starts a summarizer process
+        :param slots: in-flight tickets per process
+        """
+        assert policy in SCHEDULING_POLICIES, f"unknown scheduling policy {policy}"
+        self._start = start
+        self._slots = slots
+        self._results = results
+        self._scheduler = FifoScheduler() if policy == FIFO else FairScheduler(sjf=policy == SJF)
+        self._tickets: Dict[int, SummarizeTicket] = {}
+        self._owners: Dict[int, SummarizerProcess] = {}
+        self._ids = itertools.count()
+        self.cache = cache
+        self._events = events
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._procs = [start() for _ in range(procs)]
+
+    def _feed(self) -> Tuple[List[Tuple[int, SummarizeTicket, SummarizerProcess]], List[SummarizeTicket]]:
+        """
+        Takes tickets for free slots, under the lock; they are sent by _send()
+        :return: (tickets taken with their ids and processes, tickets of failed documents)
+        """
+        taken, dropped = [], []
+        while self._scheduler:
+            proc = min(self._procs, key=lambda p: len(p.tickets))
+            if len(proc.tickets) >= self._slots:
+                break
+
+            ticket = self._scheduler.pop()
+            if ticket.doc.has_unrecoverable_errors():
+                # the document already failed, its remaining tickets are dropped
+                dropped.append(ticket)
+                continue
+
+            ticket_id = next(self._ids)
+            self._tickets[ticket_id] = ticket
+            self._owners[ticket_id] = proc
+            proc.tickets.add(ticket_id)
+            taken.append((ticket_id, ticket, proc))
+
+        return taken, dropped
+
+    def _send(self, taken: List[Tuple[int, SummarizeTicket, SummarizerProcess]], dropped: List[SummarizeTicket]):
+        # outside the lock: cache lookups and pickling
+        for ticket in dropped:
+            if self._events:
+                self._events.put_doc(TICKET, ticket.doc)
+
+        for ticket_id, ticket, proc in taken:
+            # retries are not looked up: the cached answer could only be the one that failed
+            if self.cache and not ticket.attempts and (cached := self.cache.get(ticket.post)) is not None:
+                # post-processed by collect_worker() as any other result
+                ts = time.time()
+                self._results.put((ticket_id, TicketCall(ticket.post.model, [{**cached, "cache_hit": True}], ts, ts)))
+                continue
+
+            proc.requests.put((ticket_id, payload_by_reference(ticket.post)))
+
+    def put(self, ticket: SummarizeTicket) -> None:
+        with self._lock:
+            self._scheduler.push(ticket)
+            fed = self._feed()
+        self._send(*fed)
+
+    def put_later(self, ticket: SummarizeTicket, delay_s: float) -> None:
+        timer = threading.Timer(delay_s, self.put, (ticket,))
+        timer.daemon = True
+        timer.start()
+
+    def done(self, ticket_id: int) -> Optional[SummarizeTicket]:
+        """
+        Frees the slot of a ticket whose result came back
+        :return: None for a ticket of a process which died meanwhile, it was retried already
+        """
+        with self._lock:
+            ticket = self._tickets.pop(ticket_id, None)
+            if proc := self._owners.pop(ticket_id, None):
+                proc.tickets.discard(ticket_id)
+            fed = self._feed()
+
+        self._send(*fed)
+        return ticket
+
+    def check_processes(self) -> None:
+        """
+        Replaces summarizer processes which died, their in-flight tickets are retried
+        """
+        lost = []
+        with self._lock:
+            if self._stopped:
+                return
+            for idx, proc in enumerate(self._procs):
+                if proc.process.is_alive():
+                    continue
+
+                warn(
+                    f"summarizer process {proc.process.pid} died (exit code {proc.process.exitcode}) "
+                    f"with {len(proc.tickets)} tickets in flight, restarting it"
+                )
+                for ticket_id in proc.tickets:
+                    lost.append(self._tickets.pop(ticket_id))
+                    del self._owners[ticket_id]
+                self._procs[idx] = self._start()
+            fed = self._feed()
+
+        self._send(*fed)
+        for ticket in lost:
+            retry_ticket(self, ticket, TRANSPORT, "summarizer process died")
+            if self._events:
+                self._events.put_doc(TICKET, ticket.doc)
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+            procs = list(self._procs)
+        for proc in procs:
+            proc.requests.put(None)
+
+    def qsize(self) -> int:
+        return len(self._scheduler)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._tickets)
+
+
+async def run_call(
+        results: multiprocessing.Queue,
+        ticket_id: int,
+        post: CompletionPayload,
+        router: ModelRouter,
+        limiters: RateLimiters,
+        slots: asyncio.Semaphore,
+):
+    try:
+        call = await call_ticket(post, router, limiters, None)
+    except Exception as e:
+        warn(f"Failed to call {post.model}: {e}")
+        call = TicketCall(post.model, [{"error": str(e)}], 0., 0.)
+    finally:
+        slots.release()
+
+    results.put((ticket_id, call))
+
+
+async def process_loop(
+        requests: multiprocessing.Queue,
+        results: multiprocessing.Queue,
+        model_list: List[ModelInfo],
+        procs: int,
+        hedge: bool,
+        route: bool,
+):
+    loop = asyncio.get_running_loop()
+    # rate limits are split evenly: processes don't talk to each other
+    limiters = RateLimiters(model_list, RATE_LIMIT_HEADROOM / procs)
+    concurrency = process_concurrency(model_list, procs)
+    model_slots = {name: asyncio.Semaphore(n) for name, n in concurrency.items()}
+    router = ModelRouter(
+        model_list, ROUTER_MODELS if route else [], limiter_admission(limiters), limiters.budget, hedge,
+        slots=model_slots
+    )
+    slots = asyncio.Semaphore(sum(concurrency.values()))
+    tasks = set()
+
+    while True:
+        await slots.acquire()
+        item = await loop.run_in_executor(None, requests.get)
+        if item is None:
+            break
+
+        task = asyncio.create_task(run_call(results, *item, router, limiters, slots))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    for task in tasks:
+        task.cancel()
+
+
+def summarizer_process(
+        requests: multiprocessing.Queue,
+        results: multiprocessing.Queue,
+        model_list: List[ModelInfo],
+        procs: int,
+        hedge: bool,
+        route: bool,
+        initializer: Optional[Callable[[], None]],
+):
+    init_logger(False)
+    if initializer:
+        initializer()
+    if any(m.provider != "fake" for m in model_list):
+        # paid once on start instead of by the first request
+        import litellm  # noqa: F401
+
+    try:
+        asyncio.run(process_loop(requests, results, model_list, procs, hedge, route))
+    except KeyboardInterrupt:
+        pass
+
+
+def collect_worker(
+        q: ProcessTicketQueue,
+        results: multiprocessing.Queue,
+        stop_event: threading.Event,
+        events: Optional[EventQueue],
+):
+    while not stop_event.is_set():
+        try:
+            ticket_id, call = results.get(timeout=1.)
+        except queue.Empty:
+            q.check_processes()
+            continue
+
+        if ticket := q.done(ticket_id):
+            finish_result(q, ticket, call, events, q.cache)
+
+
+def spawn_summarizer_procs(
+        model_list: List[ModelInfo],
+        procs: int,
+        cache: Optional[CompletionCache] = None,
+        hedge: bool = False,
+        events: Optional[EventQueue] = None,
+        scheduling: str = FAIR,
+        initializer: Optional[Callable[[], None]] = None,
+        route: bool = False,
+) -> Tuple[ProcessTicketQueue, threading.Event]:
+    """
+    Summarizer sharded across procs processes, each with its own event loop: reading and encoding pages,
+    request serialization and response parsing of model calls no longer compete for a single GIL.
+    Answers are post-processed in this process, one at a time as in the summarizer.
+    :param cache: completion cache, looked up and filled in this process only
+    :param initializer: called in each process on start, e.g. to set up fake providers
+    :param route: route and fail over between ROUTER_MODELS, else requests go to the requested model only
+    :return: (ticket queue, stop event)
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+
+    def start() -> SummarizerProcess:
+        requests = ctx.Queue()
+        process = ctx.Process(
+            target=summarizer_process,
+            args=(requests, results, model_list, procs, hedge, route, initializer),
+            daemon=True,
+        )
+        process.start()
+        return SummarizerProcess(process, requests)
+
+    slots = sum(process_concurrency(model_list, procs).values())
+    q = ProcessTicketQueue(start, procs, slots, results, scheduling, cache, events)
+    stop_event = threading.Event()
+    TICKETS_IN_FLIGHT.labels().set_function(q.in_flight)
+
+    def stop():
+        stop_event.wait()
+        q.stop()
+
+    threading.Thread(target=stop, daemon=True).start()
+    threading.Thread(target=collect_worker, args=(q, results, stop_event, events), daemon=True).start()
+    info(f"summarizer initialized: {procs} processes")
+
+    return q, stop_event
@@ -0,0 +1,103 @@
+import asyncio
+
+from collections import deque, OrderedDict
+from typing import Optional, Any, Deque, List
+
+
+__all__ = ["TicketQueue", "FIFO", "FAIR", "SJF", "SCHEDULING_POLICIES"]
+
+
+# tickets in the order they were put
+FIFO = "fifo"
+# step2 and retries first, then round-robin across documents
+FAIR = "fair"
+# as FAIR, but the document with fewest pages first instead of round-robin
+SJF = "sjf"
+
+SCHEDULING_POLICIES = [FIFO, FAIR, SJF]
+
+
+class FifoScheduler:
+    def __init__(self):
+        self._q: Deque[Any] = deque()
+
+    def push(self, ticket: Any) -> None:
+        self._q.append(ticket)
+
+    def pop(self) -> Any:
+        return self._q.popleft()
+
+    def __len__(self) -> int:
+        return len(self._q)
+
+
+class FairScheduler:
+    """
+    Tickets are taken by priority class (ticket.priority(), 0 first), within a class one document at a time:
+    round-robin, or the smallest document by page count with sjf=True. Tickets of a document stay in FIFO order.
+    Documents are compared by doc.pages_total, not by the pages split so far
+    """
+    def __init__(self, sjf: bool = False):
+        self.sjf = sjf
+        self._classes: List[OrderedDict] = [OrderedDict(), OrderedDict()]
+        self._len = 0
+
+    def push(self, ticket: Any) -> None:
+        docs = self._classes[min(ticket.priority(), len(self._classes) - 1)]
+        docs.setdefault(ticket.doc, deque()).append(ticket)
+        self._len += 1
+
+    def pop(self) -> Any:
+        docs = next(docs for docs in self._classes if docs)
+        if self.sjf:
+            doc = min(docs, key=lambda d: d.pages_total)
+        else:
+            doc = next(iter(docs))
+            docs.move_to_end(doc)
+
+        tickets = docs[doc]
+        ticket = tickets.popleft()
+        if not tickets:
+            del docs[doc]
+        self._len -= 1
+        return ticket
+
+    def __len__(self) -> int:
+        return self._len
+
+
+class TicketQueue:
+    """
+    Ticket queue consumed by the summarizer event loop, ordered by a scheduling policy.
+    put() is thread-safe, so tickets can be produced both by the main thread and by post-processors on the loop.
+    """
+    def __init__(self):
+        self._scheduler = FifoScheduler()
+        self._ready = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop, policy: str = FIFO) -> None:
+        assert policy in SCHEDULING_POLICIES, f"unknown scheduling policy {policy}"
+        self._loop = loop
+        self._scheduler = FifoScheduler() if policy == FIFO else FairScheduler(sjf=policy == SJF)
+
+    def _push(self, ticket: Any) -> None:
+        self._scheduler.push(ticket)
+        self._ready.set()
+
+    def put(self, ticket: Any) -> None:
+        assert self._loop, "TicketQueue is not bound to an event loop"
+        self._loop.call_soon_threadsafe(self._push, ticket)
+
+    def put_later(self, ticket: Any, delay_s: float) -> None:
+        assert self._loop, "TicketQueue is not bound to an event loop"
+        self._loop.call_soon_threadsafe(self._loop.call_later, delay_s, self._push, ticket)
+
+    async def get(self) -> Any:
+        while not self._scheduler:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._scheduler.pop()
+
+    def qsize(self) -> int:
+        return len(self._scheduler)
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import weakref
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple, Callable, TypeVar, Iterator
+
+from core.globals import WORK_QUEUE_BUDGET_REFRESH_S
+from core.logger import info, warn
+from core.pdf_document import PDFDocument
+from core.summarizer.rate_limiter import TokenBucket, RateLimiters
+from core.summarizer.summ_utils import SummarizeTicket, TicketCall
+from core.summarizer.ticket_queue import FIFO, SJF, SCHEDULING_POLICIES
+from llm_completion.cache import CompletionCache
+from llm_completion.completion import payload_to_dict
+from llm_completion.models import ModelInfo
+
+
+__all__ = ["WorkQueue", "SharedModelRateLimiter", "SharedRateLimiters", "RemoteTicketQueue"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    not_before REAL NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    owner TEXT,
+    lease_until REAL,
+    leases INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS tickets_state ON tickets(state, priority, rank, id);
+
+CREATE TABLE IF NOT EXISTS rate_limits (
+    model TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    level REAL NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (model, bucket)
+);
+"""
+
+T = TypeVar("T")
+
+
+class WorkQueue:
+    """
+    Tickets and rate limit buckets shared by the coordinator and summarizer workers, in a SQLite file
+    all of them can reach. A ticket is queued, leased by a worker until lease_until, then done
+    with the result of its model call until the coordinator takes it.
+    Timestamps are wall clock: nodes are expected to keep their clocks in sync.
+    """
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30.)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        info(f"work queue: {db_path}")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front: concurrent lease() calls can't pick the same ticket
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            yield self._conn
+
+    def put(self, doc: str, payload: str, priority: int, rank: int, delay_s: float = 0.) -> int:
+        """
+        :param doc: key of the ticket's document, see drop()
+        :param priority: lease order: priority first, then rank, then insertion
+        :return: ticket id
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "INSERT INTO tickets (doc, priority, rank, not_before, payload) VALUES (?, ?, ?, ?, ?)",
+                (doc, priority, rank, time.time() + delay_s, payload)
+            ).lastrowid
+
+    def lease(self, owner: str, lease_s: float) -> Optional[Tuple[int, str]]:
+        """
+        Takes the next queued ticket, or a ticket whose lease has expired
+        :return: (ticket id, payload)
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, payload, owner FROM tickets "
+                "WHERE (state = 'queued' AND not_before <= ?) OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY priority, rank, id LIMIT 1", (now, now)
+            ).fetchone()
+            if not row:
+                return None
+
+            ticket_id, payload, prev_owner = row
+            conn.execute(
+                "UPDATE tickets SET state = 'leased', owner = ?, lease_until = ?, leases = leases + 1 WHERE id = ?",
+                (owner, now + lease_s, ticket_id)
+            )
+
+        if prev_owner:
+            warn(f"ticket {ticket_id}: lease of {prev_owner} expired, leased by {owner}")
+        return ticket_id, payload
+
+    def extend(self, ticket_id: int, owner: str, lease_s: float) -> bool:
+        """
+        :return: False if the lease was lost to another worker
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE tickets SET lease_until = ? WHERE id = ? AND state = 'leased' AND owner = ?",
+                (time.time() + lease_s, ticket_id, owner)
+            ).rowcount > 0
+
+    def complete(self, ticket_id: int, owner: str, result: str) -> bool:
+        """
+        :return: False if the lease was lost to another worker, the result is dropped then
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE tickets SET state = 'done', result = ? WHERE id = ? AND state = 'leased' AND owner = ?",
+                (result, ticket_id, owner)
+            ).rowcount > 0
+
+    def take_results(self) -> List[Tuple[int, str]]:
+        """
+        Removes done tickets
+        :return: [(ticket id, result)]
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT id, result FROM tickets WHERE state = 'done' ORDER BY id").fetchall()
+            conn.executemany("DELETE FROM tickets WHERE id = ?", [(r[0],) for r in rows])
+        return rows
+
+    def drop(self, doc: str) -> List[int]:
+        """
+        Removes queued tickets of a document
+        :return: ids of removed tickets
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT id FROM tickets WHERE doc = ? AND state = 'queued'", (doc,)).fetchall()
+            conn.executemany("DELETE FROM tickets WHERE id = ?", rows)
+        return [r[0] for r in rows]
+
+    def queued(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tickets WHERE state = 'queued'").fetchone()[0]
+
+    def clear(self) -> None:
+        """
+        Drops all tickets, e.g. those left by a previous coordinator
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM tickets")
+
+    def _load_buckets(self, conn: sqlite3.Connection, model_name: str, buckets: Dict[str, TokenBucket]) -> None:
+        rows = dict(
+            (bucket, (level, ts))
+            for bucket, level, ts in conn.execute(
+                "SELECT bucket, level, ts FROM rate_limits WHERE model = ?", (model_name,)
+            )
+        )
+        for name, bucket in buckets.items():
+            bucket.level, bucket.ts = rows.get(name, (bucket.capacity, bucket.clock()))
+
+    def read_buckets(self, model_name: str, buckets: Dict[str, TokenBucket], fn: Callable[[], T]) -> T:
+        """
+        Loads shared state into buckets and applies fn to them, without writing them back
+        """
+        with self._lock:
+            self._load_buckets(self._conn, model_name, buckets)
+            return fn()
+
+    def update_buckets(self, model_name: str, buckets: Dict[str, TokenBucket], fn: Callable[[], T]) -> T:
+        """
+        Loads shared state into buckets, applies fn to them and stores them back, atomically
+        """
+        with self._transaction() as conn:
+            self._load_buckets(conn, model_name, buckets)
+            result = fn()
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_limits (model, bucket, level, ts) VALUES (?, ?, ?, ?)",
+                [(model_name, name, b.level, b.ts) for name, b in buckets.items()]
+            )
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SharedModelRateLimiter:
+    """
+    ModelRateLimiter whose token buckets are kept in the work queue: TPM / RPM of a model are shared
+    by all workers. Waiters of a worker are served in FIFO order, workers race for admission.
+    Work queue transactions run in threads: budget() answers from the last known state and refreshes it
+    in the background, reconcile() is applied in the background.
+    """
+    def __init__(self, wq: WorkQueue, model_name: str, tpm: Optional[int], rpm: Optional[int], headroom: float):
+        self.wq = wq
+        self.model_name = model_name
+        self._buckets: Dict[str, TokenBucket] = {}
+        if tpm:
+            self._buckets["tokens"] = TokenBucket(tpm * headroom, clock=time.time)
+        if rpm:
+            self._buckets["requests"] = TokenBucket(rpm * headroom, clock=time.time)
+        self._lock = asyncio.Lock()
+        # budget as of the last work queue transaction, and when it was taken
+        self._budget = 1.
+        self._budget_ts = 0.
+        self._refreshing = False
+
+    def _snapshot(self) -> None:
+        # called with shared state loaded into the buckets, under the work queue lock
+        self._budget = min(b.fill() for b in self._buckets.values())
+        self._budget_ts = time.monotonic()
+
+    def _try_acquire(self, tokens: int) -> float:
+        amounts = {"tokens": tokens, "requests": 1}
+
+        def admit() -> float:
+            wait = max((b.wait_time(amounts[name]) for name, b in self._buckets.items()), default=0.)
+            if wait <= 0:
+                for name, b in self._buckets.items():
+                    b.consume(amounts[name])
+            self._snapshot()
+            return wait
+
+        return self.wq.update_buckets(self.model_name, self._buckets, admit)
+
+    async def acquire(self, tokens: int) -> float:
+        """
+        :return: seconds spent waiting for admission
+        """
+        ts_start = time.monotonic()
+        if not self._buckets:
+            return 0.
+
+        async with self._lock:
+            while (wait := await asyncio.to_thread(self._try_acquire, tokens)) > 0:
+                await asyncio.sleep(wait)
+
+        return time.monotonic() - ts_start
+
+    def _in_background(self, fn: Callable[[], None]) -> None:
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                warn(f"rate limiter of {self.model_name}: {e}")
+
+        try:
+            asyncio.get_running_loop().run_in_executor(None, run)
+        except RuntimeError:
+            # no event loop
+            run()
+
+    def _refresh(self) -> None:
+        try:
+            self.wq.read_buckets(self.model_name, self._buckets, self._snapshot)
+        finally:
+            self._refreshing = False
+
+    def budget(self) -> float:
+        """
+        :return: share of TPM / RPM budget left, 0..1, at most WORK_QUEUE_BUDGET_REFRESH_S old
+        """
+        if not self._buckets:
+            return 1.
+        if not self._refreshing and time.monotonic() - self._budget_ts > WORK_QUEUE_BUDGET_REFRESH_S:
+            self._refreshing = True
+            self._in_background(self._refresh)
+        return self._budget
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        if "tokens" not in self._buckets or not actual:
+            return
+
+        def correct():
+            self._buckets["tokens"].level -= actual - estimated
+            self._snapshot()
+
+        self._in_background(lambda: self.wq.update_buckets(self.model_name, self._buckets, correct))
+
+
+class SharedRateLimiters(RateLimiters):
+    def __init__(self, wq: WorkQueue, model_list: List[ModelInfo], headroom: float):
+        self._limiters = {
+            m.name: SharedModelRateLimiter(wq, m.name, m.tokens_per_minute, m.request_per_minute, headroom)
+            for m in model_list
+        }
+
+
+class RemoteTicketQueue:
+    """
+    TicketQueue of the coordinator with --work_queue: tickets are serialized to the work queue for workers,
+    ticket objects (document, post-processing) stay here until the result of their model call comes back.
+    Scheduling policies become the lease order: priority class, then rank - the ticket's position among
+    tickets of its document for fair (round-robin), the document's page count for sjf, none for fifo.
+    The completion cache is kept here only: cached answers don't go through workers.
+    """
+    def __init__(self, wq: WorkQueue, policy: str = FIFO, cache: Optional[CompletionCache] = None):
+        assert policy in SCHEDULING_POLICIES, f"unknown scheduling policy {policy}"
+        self.wq = wq
+        self.policy = policy
+        self.cache = cache
+        self._tickets: Dict[int, SummarizeTicket] = {}
+        # answered from the cache, returned by the next take_results()
+        self._cached: List[Tuple[SummarizeTicket, TicketCall]] = []
+        self._ranks: weakref.WeakKeyDictionary[PDFDocument, int] = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _rank(self, ticket: SummarizeTicket) -> int:
+        if self.policy == FIFO:
+            return 0
+        if self.policy == SJF:
+            return ticket.doc.pages_total
+
+        rank = self._ranks.get(ticket.doc, 0)
+        self._ranks[ticket.doc] = rank + 1
+        return rank
+
+    def put(self, ticket: SummarizeTicket) -> None:
+        self.put_later(ticket, 0.)
+
+    def put_later(self, ticket: SummarizeTicket, delay_s: float) -> None:
+        # retries are not looked up: the cached answer could only be the one that failed
+        if self.cache and not ticket.attempts and (cached := self.cache.get(ticket.post)) is not None:
+            ts = time.time()
+            with self._lock:
+                self._cached.append((ticket, TicketCall(ticket.post.model, [{**cached, "cache_hit": True}], ts, ts)))
+            return
+
+        payload = json.dumps({
+            "post": payload_to_dict(ticket.post),
+            "ticket": ticket.describe(),
+            "doc": ticket.doc.path.name,
+        })
+        with self._lock:
+            ticket_id = self.wq.put(str(ticket.doc.path), payload, ticket.priority(), self._rank(ticket), delay_s)
+            self._tickets[ticket_id] = ticket
+
+    def take_results(self) -> List[Tuple[SummarizeTicket, TicketCall]]:
+        with self._lock:
+            results, self._cached = self._cached, []
+        for ticket_id, result in self.wq.take_results():
+            with self._lock:
+                ticket = self._tickets.pop(ticket_id, None)
+            if ticket:
+                results.append((ticket, TicketCall(**json.loads(result))))
+        return results
+
+    def drop(self, doc: PDFDocument) -> None:
+        """
+        Removes queued tickets of a failed document
+        """
+        dropped = self.wq.drop(str(doc.path))
+        with self._lock:
+            for ticket_id in dropped:
+                self._tickets.pop(ticket_id, None)
+
+    def qsize(self) -> int:
+        return self.wq.queued()
+
+    def in_flight(self) -> int:
+        """
+        Tickets sent to workers, queued or leased, whose result has not been taken yet
+        """
+        with self._lock:
+            return len(self._tickets) + len(self._cached)
@@ -1,7 +1,11 @@
-from core.globals import STEP1_DUMP_FILE, STEP2_DUMP_FILE
+import hashlib
 
+from pathlib import Path
 
-def clear_dump_files():
-    for file_path in [STEP1_DUMP_FILE, STEP2_DUMP_FILE]:
-        if file_path.exists():
-            file_path.write_text("")
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import socket
+
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Set
+
+from core.globals import (
+    BASE_DIR, SUMMARIZER_CONCURRENCY, RATE_LIMIT_HEADROOM, ROUTER_MODELS, WORK_QUEUE_LEASE_S, WORK_QUEUE_POLL_S
+)
+from core.logger import init_logger, info, warn
+from core.summarizer.summarizer import call_ticket, limiter_admission
+from core.summarizer.summ_utils import TicketCall
+from core.summarizer.work_queue import WorkQueue, SharedRateLimiters
+from llm_completion.completion import payload_from_dict
+from llm_completion.models import get_model_list
+from llm_completion.router import ModelRouter
+
+
+__all__ = ["run_worker"]
+
+
+async def keep_leased(wq: WorkQueue, ticket_id: int, worker_id: str):
+    """
+    Extends the lease of a ticket while its model call runs
+    """
+    while True:
+        await asyncio.sleep(WORK_QUEUE_LEASE_S / 3)
+        if not await asyncio.to_thread(wq.extend, ticket_id, worker_id, WORK_QUEUE_LEASE_S):
+            warn(f"ticket {ticket_id}: lease lost")
+            return
+
+
+async def run_leased(
+        wq: WorkQueue,
+        worker_id: str,
+        ticket_id: int,
+        payload: str,
+        router: ModelRouter,
+        limiters: SharedRateLimiters,
+        slots: asyncio.Semaphore,
+):
+    heartbeat = asyncio.create_task(keep_leased(wq, ticket_id, worker_id))
+    try:
+        d = json.loads(payload)
+        post = payload_from_dict(d["post"])
+        try:
+            call = await call_ticket(post, router, limiters, None)
+        except Exception as e:
+            warn(f"Failed to process {d['ticket']} of {d['doc']}: {e}")
+            call = TicketCall(post.model, [{"error": str(e)}], 0., 0.)
+
+        if not await asyncio.to_thread(wq.complete, ticket_id, worker_id, json.dumps(call.__dict__)):
+            warn(f"ticket {ticket_id}: lease lost, result dropped")
+    finally:
+        heartbeat.cancel()
+        slots.release()
+
+
+async def worker_loop(wq: WorkQueue, worker_id: str, hedge: bool, route: bool):
+    model_list = get_model_list(BASE_DIR)
+    limiters = SharedRateLimiters(wq, model_list, RATE_LIMIT_HEADROOM)
+    concurrency = {m.name: m.max_concurrency or SUMMARIZER_CONCURRENCY for m in model_list}
+    model_slots = {name: asyncio.Semaphore(n) for name, n in concurrency.items()}
+    router = ModelRouter(
+        model_list, ROUTER_MODELS if route else [], limiter_admission(limiters), limiters.budget, hedge,
+        slots=model_slots
+    )
+    # tickets are leased only when a slot is free: the others stay available to other workers
+    slots = asyncio.Semaphore(sum(concurrency.values()) or SUMMARIZER_CONCURRENCY)
+    tasks: Set[asyncio.Task] = set()
+
+    info(f"worker {worker_id} started")
+    try:
+        while True:
+            await slots.acquire()
+            leased = await asyncio.to_thread(wq.lease, worker_id, WORK_QUEUE_LEASE_S)
+            if not leased:
+                slots.release()
+                await asyncio.sleep(WORK_QUEUE_POLL_S)
+                continue
+
+            ticket_id, payload = leased
+            task = asyncio.create_task(
+                run_leased(wq, worker_id, ticket_id, payload, router, limiters, slots)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def run_worker(work_queue: Path, worker_id: str, hedge: bool = False, route: bool = False):
+    """
+    Stateless summarizer worker: leases tickets from the work queue, calls models and puts back the answers.
+    Documents, post-processing, output and the completion cache stay with the coordinator, core.main --work_queue
+    """
+    wq = WorkQueue(work_queue)
+    try:
+        asyncio.run(worker_loop(wq, worker_id, hedge, route))
+    finally:
+        wq.close()
+
+
+def main():
+    init_logger(True)
+    parser = ArgumentParser()
+    parser.add_argument("--work_queue", required=True, type=Path, help="Work queue of the coordinator")
+    parser.add_argument("--worker_id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--DEBUG", default=False, action="store_true")
+    parser.add_argument(
+        "--route", default=False, action="store_true",
+        help="Route requests away from an unhealthy model, and fail over on transport errors and rate limits"
+    )
+    parser.add_argument(
+        "--hedge", default=False, action="store_true",
+        help="Race requests slower than the model's p95 latency against another model, implies --route"
+    )
+    args = parser.parse_args()
+    init_logger(args.DEBUG)
+
+    try:
+        run_worker(args.work_queue, args.worker_id, args.hedge, args.route or args.hedge)
+    except KeyboardInterrupt:
+        info("Gracefully shutting down")
+
+
+if __name__ == "__main__":
+    main()
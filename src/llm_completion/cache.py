@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from core.logger import info, warn
+
+
+__all__ = ["CompletionCache", "payload_fingerprint"]
+
+
+def payload_fingerprint(post) -> str:
+    """
+    sha256 of everything that affects a completion: model, messages (prompts and PDF pages) and sampling params
+    """
+    payload = {
+        "model": post.model,
+        "messages": [m.as_dict(fingerprint=True) for m in post.messages],
+        "tools": post.tools,
+        "tool_choice": post.tool_choice,
+        "max_tokens": post.max_tokens,
+        "temperature": post.temperature,
+        "n": post.n,
+        "top_p": post.top_p,
+        "top_n": post.top_n,
+        "stop": post.stop,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    On-disk, content-addressed cache of completion responses.
+    Least recently used entries are evicted once the total size exceeds max_bytes.
+    Thread-safe: the index is guarded by a lock, file reads and writes happen outside it.
+    """
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        entries = sorted(
+            ((f.stat().st_mtime, f.stem, f.stat().st_size) for f in self.cache_dir.glob("*/*.json")),
+        )
+        self._entries: OrderedDict[str, int] = OrderedDict((key, size) for _, key, size in entries)
+        self._size = sum(self._entries.values())
+        self._lock = threading.Lock()
+        info(f"completion cache: {len(self._entries)} entries, {self._size / 1024 / 1024:.1f}MB at {self.cache_dir}")
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def contains(self, post) -> bool:
+        with self._lock:
+            return payload_fingerprint(post) in self._entries
+
+    def get(self, post) -> Optional[Dict[str, Any]]:
+        key = payload_fingerprint(post)
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+        path = self._path(key)
+        try:
+            response = json.loads(path.read_text())
+            os.utime(path)
+        except Exception as e:
+            warn(f"completion cache: failed to read {path}: {e}")
+            self._drop(key)
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return response
+
+    def put(self, post, response: Dict[str, Any]) -> None:
+        key = payload_fingerprint(post)
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        data = json.dumps(response).encode("utf-8")
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            evicted = self._evict()
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+
+    def _drop(self, key: str) -> None:
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        self._path(key).unlink(missing_ok=True)
+
+    def _evict(self) -> List[str]:
+        """
+        Removes least recently used entries from the index, under the lock
+        :return: keys whose files are to be deleted
+        """
+        evicted = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            evicted.append(key)
+        return evicted
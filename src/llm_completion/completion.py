@@ -1,13 +1,64 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, replace
 from typing import List, Dict, Union, Any, Optional, AsyncIterator
 
-import litellm
-
+from core.globals import CHARS_PER_TOKEN
 from core.logger import warn
+from llm_completion.cache import CompletionCache
 from llm_completion.models import ModelInfo
+from llm_completion.recording import CompletionRecording
+
+
+__all__ = [
+    "CompletionPayload", "ChatMessage", "LazyContent", "InlineContent", "estimate_tokens", "cache_breakpoints",
+    "llm_completion", "payload_to_dict", "payload_from_dict", "payload_by_reference",
+]
+
+
+class LazyContent:
+    """
+    Message content item that is materialized only when a request is serialized, e.g. a base64 PDF page
+    """
+    def as_dict(self) -> Dict[str, Any]:
+        raise NotImplementedError()
+
+    def fingerprint(self) -> str:
+        """
+        Cheap stable identity of the content, used instead of as_dict() for cache keys
+        """
+        raise NotImplementedError()
+
+    def tokens(self) -> int:
+        """
+        Rough input token estimate of the content
+        """
+        raise NotImplementedError()
+
+    def reference(self) -> "LazyContent":
+        """
+        Picklable equivalent for another process on this host, materialized only there.
+        Content that can't be referenced is materialized here
+        """
+        return InlineContent(self.as_dict(), self.fingerprint(), self.tokens())
+
 
+@dataclass
+class InlineContent(LazyContent):
+    """
+    Lazy content materialized for another process, e.g. a PDF page sent to a remote worker.
+    Keeps the fingerprint of the original, so cache keys and recordings stay the same.
+    """
+    item: Dict[str, Any]
+    fingerprint_: str
+    tokens_: int
+
+    def as_dict(self) -> Dict[str, Any]:
+        return self.item
 
-__all__ = ["CompletionPayload", "ChatMessage", "llm_completion"]
+    def fingerprint(self) -> str:
+        return self.fingerprint_
+
+    def tokens(self) -> int:
+        return self.tokens_
 
 
 @dataclass
@@ -16,11 +67,21 @@ class ChatMessage:
     content: Union[str, List[Any]]
     tool_calls: Optional[List[Dict[str, Any]]] = None
     tool_call_id: Optional[str] = None
+    # last message of the static prefix shared by many requests: providers may cache everything up to it
+    cache_breakpoint: bool = False
 
-    def as_dict(self) -> Dict[str, Any]:
+    def _content(self, fingerprint: bool) -> Union[str, List[Any]]:
+        if isinstance(self.content, str):
+            return self.content
+        return [
+            (c.fingerprint() if fingerprint else c.as_dict()) if isinstance(c, LazyContent) else c
+            for c in self.content
+        ]
+
+    def as_dict(self, fingerprint: bool = False) -> Dict[str, Any]:
         d = {
             "role": self.role,
-            "content": self.content,
+            "content": self._content(fingerprint),
             "tool_call_id": self.tool_call_id,
         }
         if self.tool_calls:
@@ -45,30 +106,151 @@ class CompletionPayload:
     stop: Optional[Union[str, List[str]]] = None
 
 
+def payload_to_dict(post: CompletionPayload) -> Dict[str, Any]:
+    """
+    JSON-serializable payload, with lazy content materialized
+    """
+    def content(m: ChatMessage) -> Union[str, List[Any]]:
+        if isinstance(m.content, str):
+            return m.content
+        return [
+            {"inline": c.as_dict(), "fingerprint": c.fingerprint(), "tokens": c.tokens()}
+            if isinstance(c, LazyContent) else c
+            for c in m.content
+        ]
+
+    return {
+        **{f.name: getattr(post, f.name) for f in fields(post) if f.name != "messages"},
+        "messages": [
+            {**{f.name: getattr(m, f.name) for f in fields(m) if f.name != "content"}, "content": content(m)}
+            for m in post.messages
+        ],
+    }
+
+
+def payload_from_dict(d: Dict[str, Any]) -> CompletionPayload:
+    def content(c: Union[str, List[Any]]) -> Union[str, List[Any]]:
+        if isinstance(c, str):
+            return c
+        return [
+            InlineContent(item["inline"], item["fingerprint"], item["tokens"])
+            if isinstance(item, dict) and "inline" in item else item
+            for item in c
+        ]
+
+    return CompletionPayload(**{
+        **d,
+        "messages": [ChatMessage(**{**m, "content": content(m["content"])}) for m in d["messages"]],
+    })
+
+
+def payload_by_reference(post: CompletionPayload) -> CompletionPayload:
+    """
+    Payload to pickle for another process on this host, lazy content is passed by reference
+    """
+    def content(m: ChatMessage) -> Union[str, List[Any]]:
+        if isinstance(m.content, str):
+            return m.content
+        return [c.reference() if isinstance(c, LazyContent) else c for c in m.content]
+
+    return replace(post, messages=[replace(m, content=content(m)) for m in post.messages])
+
+
+def estimate_tokens(messages: List[ChatMessage]) -> int:
+    tokens = 0
+    for m in messages:
+        if isinstance(m.content, str):
+            tokens += len(m.content) // CHARS_PER_TOKEN
+            continue
+
+        for item in m.content:
+            if isinstance(item, LazyContent):
+                tokens += item.tokens()
+            else:
+                tokens += len(str(item.get("content", ""))) // CHARS_PER_TOKEN
+
+    return tokens
+
+
+def cache_breakpoints(model_record: ModelInfo, post: CompletionPayload) -> List[int]:
+    """
+    Explicit prompt caching (Gemini cached content, Anthropic): the provider caches the prefix up to a message
+    marked with cache_control. Prefixes shorter than the provider minimum can't be cached and are not marked.
+    Providers with automatic prefix caching (OpenAI) only need the prefix to be stable.
+    :return: indices of messages to mark
+    """
+    if model_record.prompt_cache != "explicit":
+        return []
+
+    return [
+        idx for idx, m in enumerate(post.messages)
+        if m.cache_breakpoint and estimate_tokens(post.messages[:idx + 1]) >= model_record.prompt_cache_min_tokens
+    ]
+
+
+def _mark_cache_breakpoints(model_record: ModelInfo, post: CompletionPayload, messages: List[Dict]) -> None:
+    for idx in cache_breakpoints(model_record, post):
+        content = messages[idx]["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        content[-1] = {**content[-1], "cache_control": {"type": "ephemeral"}}
+        messages[idx]["content"] = content
+
+
 async def llm_completion(
         model_list: List[ModelInfo],
-        post: CompletionPayload
+        post: CompletionPayload,
+        cache: Optional[CompletionCache] = None,
+        recording: Optional[CompletionRecording] = None,
 ) -> AsyncIterator[Dict[str, Any]]:
-    model_record: Optional[ModelInfo] = next(model for model in model_list if model.name == post.model)
+    """
+    :param cache: looked up only: callers put answers once they were post-processed, see CompletionCache
+    :param recording: record responses, or serve recorded ones instead of calling providers
+    """
+    if recording and recording.replaying:
+        if (recorded := recording.replay(post)) is not None:
+            yield {**recorded, "replayed": True}
+        else:
+            yield {"error": f"no recorded response for {post.model}", "error_type": "ReplayMiss", "status": 404}
+        return
+
+    if cache and (cached := cache.get(post)) is not None:
+        if recording:
+            recording.record(post, cached)
+        yield {**cached, "cache_hit": True}
+        return
+
+    model_record: Optional[ModelInfo] = next((model for model in model_list if model.name == post.model), None)
     if not model_record:
         raise ValueError(f"model {post.model} not found")
-    
-    messages: List[Dict] = [m.as_dict() for m in post.messages]
 
     try:
-        response = await litellm.acompletion(
-            model=model_record.resolve_as, messages=messages, stream=False,
-            temperature=post.temperature, top_p=post.top_p,
-            max_tokens=min(model_record.max_output_tokens, post.max_tokens),
-            tools=post.tools,
-            tool_choice=post.tool_choice,
-            stop=post.stop if post.stop else None,
-            n=post.n,
-        )
-        response_dict = response.model_dump()
+        if model_record.provider == "fake":
+            from llm_completion.fake_provider import fake_provider
+            response_dict = await fake_provider.acompletion(model_record, post)
+        else:
+            # imported lazily: litellm takes seconds to import, which PDF pool processes re-importing main must not pay
+            import litellm
+
+            messages: List[Dict] = [m.as_dict() for m in post.messages]
+            _mark_cache_breakpoints(model_record, post, messages)
+
+            response = await litellm.acompletion(
+                model=model_record.resolve_as, messages=messages, stream=False,
+                temperature=post.temperature, top_p=post.top_p,
+                max_tokens=min(model_record.max_output_tokens, post.max_tokens),
+                tools=post.tools,
+                tool_choice=post.tool_choice,
+                stop=post.stop if post.stop else None,
+                n=post.n,
+            )
+            response_dict = response.model_dump()
+
+        if recording:
+            recording.record(post, response_dict)
         yield response_dict
 
     except Exception as e:
         err_msg = f"error in litellm_completion_not_stream: {e}"
         warn(err_msg)
-        yield {"error": err_msg}
+        yield {"error": err_msg, "error_type": type(e).__name__, "status": getattr(e, "status_code", None)}
@@ -0,0 +1,26 @@
+from typing import Dict, Any
+
+
+__all__ = ["RATE_LIMIT", "TRANSPORT", "FATAL", "classify_error"]
+
+
+# provider asked to slow down: retried with backoff, with a larger budget
+RATE_LIMIT = "rate_limit"
+# timeouts, connection errors, 5xx
+TRANSPORT = "transport"
+# bad request, authentication: retrying won't help
+FATAL = "fatal"
+
+
+def classify_error(r: Dict[str, Any]) -> str:
+    """
+    :param r: {"error": ...} chunk yielded by llm_completion
+    """
+    status = r.get("status")
+    error_type = r.get("error_type") or ""
+
+    if status == 429 or "RateLimit" in error_type:
+        return RATE_LIMIT
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 409):
+        return FATAL
+    return TRANSPORT
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Optional, Set
+
+from core.globals import CHARS_PER_TOKEN
+from llm_completion.completion import CompletionPayload, estimate_tokens, cache_breakpoints
+from llm_completion.models import ModelInfo
+
+
+__all__ = ["FakeProfile", "FakeProviderError", "FakeProvider", "fake_provider"]
+
+
+Responder = Callable[[CompletionPayload], str]
+
+
+@dataclass
+class FakeProfile:
+    """
+    Behaviour of a fake model: latency_s, except for a share of slow_rate requests taking slow_latency_s;
+    with latency_sigma, latencies are log-normal around them. error_rate of requests fail with a 503,
+    rate_limit_rate with a 429. With serialize, the request body is encoded as a provider client would,
+    so that its CPU cost is paid
+    """
+    latency_s: float = 0.
+    latency_sigma: float = 0.
+    slow_rate: float = 0.
+    slow_latency_s: float = 0.
+    error_rate: float = 0.
+    rate_limit_rate: float = 0.
+    serialize: bool = False
+
+
+class FakeProviderError(Exception):
+    def __init__(self, status_code: int, text: str):
+        super().__init__(text)
+        self.status_code = status_code
+
+
+class FakeProvider:
+    """
+    Offline provider for models with "provider": "fake": answers with responder(post) and reports usage
+    in OpenAI format, emulating provider side prompt caching according to the model's prompt_cache config:
+    a request prefix already seen is reported in prompt_tokens_details.cached_tokens.
+    """
+    def __init__(self, responder: Optional[Responder] = None):
+        self.responder: Responder = responder or (lambda post: "{}")
+        # model name -> behaviour, models without a profile answer right away
+        self.profiles: Dict[str, FakeProfile] = {}
+        self.rnd = random.Random(0)
+        self._lock = threading.Lock()
+        self._prefixes: Set[str] = set()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._prefixes.clear()
+
+    def _cached_tokens(self, model: ModelInfo, post: CompletionPayload) -> int:
+        if not model.prompt_cache:
+            return 0
+
+        # explicit: only prefixes up to the messages llm_completion marks with cache_control
+        breakpoints = set(cache_breakpoints(model, post)) if model.prompt_cache == "explicit" else None
+
+        h = hashlib.sha256()
+        cacheable = []
+        for idx, m in enumerate(post.messages):
+            h.update(json.dumps(m.as_dict(fingerprint=True), sort_keys=True).encode())
+            if breakpoints is not None and idx not in breakpoints:
+                continue
+            tokens = estimate_tokens(post.messages[:idx + 1])
+            if tokens >= model.prompt_cache_min_tokens:
+                cacheable.append((h.copy().hexdigest(), tokens))
+
+        with self._lock:
+            cached = max((tokens for key, tokens in cacheable if key in self._prefixes), default=0)
+            self._prefixes.update(key for key, _ in cacheable)
+
+        return cached
+
+    async def acompletion(self, model: ModelInfo, post: CompletionPayload) -> Dict[str, Any]:
+        profile = self.profiles.get(model.name, FakeProfile())
+        if profile.serialize:
+            json.dumps({"model": model.resolve_as, "messages": [m.as_dict() for m in post.messages]})
+        slow = self.rnd.random() < profile.slow_rate
+        latency_s = profile.slow_latency_s if slow else profile.latency_s
+        if profile.latency_sigma:
+            latency_s *= math.exp(self.rnd.gauss(0., profile.latency_sigma))
+        await asyncio.sleep(latency_s)
+
+        failure = self.rnd.random()
+        if failure < profile.rate_limit_rate:
+            raise FakeProviderError(429, f"{model.name}: rate limit exceeded")
+        if failure < profile.rate_limit_rate + profile.error_rate:
+            raise FakeProviderError(503, f"{model.name}: service unavailable")
+
+        n = post.n or 1
+        content = self.responder(post)
+        return {
+            "model": model.resolve_as,
+            "choices": [
+                {"index": idx, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                for idx in range(n)
+            ],
+            "usage": {
+                "prompt_tokens": estimate_tokens(post.messages),
+                "completion_tokens": len(content) // CHARS_PER_TOKEN * n,
+                "prompt_tokens_details": {"cached_tokens": self._cached_tokens(model, post)},
+            },
+        }
+
+
+fake_provider = FakeProvider()
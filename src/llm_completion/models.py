@@ -27,6 +27,12 @@ class ModelInfo:
     dollars_output: int
     tokens_per_minute: Optional[int]
     request_per_minute: Optional[int]
+    max_concurrency: Optional[int] = None
+    # provider side prompt caching: "auto" (cached by prefix, e.g. OpenAI), "explicit" (needs
+    # cache_control markers, e.g. Gemini cached content) or None
+    prompt_cache: Optional[str] = None
+    prompt_cache_min_tokens: int = 1024
+    dollars_input_cached: Optional[float] = None
 
 
 def _models_info(base_dir: Path) -> List[ModelInfo]:
@@ -46,6 +52,10 @@ def _models_info(base_dir: Path) -> List[ModelInfo]:
             dollars_output=model_info["dollars_output"],
             tokens_per_minute=model_info.get("tpm"),
             request_per_minute=model_info.get("rpm"),
+            max_concurrency=model_info.get("max_concurrency"),
+            prompt_cache=model_info.get("prompt_cache"),
+            prompt_cache_min_tokens=model_info.get("prompt_cache_min_tokens", 1024),
+            dollars_input_cached=model_info.get("dollars_input_cached"),
         )
         for model_data in models_json
         for model_name, model_info in model_data.items()
@@ -66,7 +76,10 @@ def get_model_providers(base_dir: Path) -> List[ModelProviderInfo]:
         for provider_name, provider_info in provider_data.items()
     ]
 
-def get_model_list(base_dir: Path) -> List[ModelInfo]:
+def get_model_list(base_dir: Path, check_env: bool = True) -> List[ModelInfo]:
+    """
+    :param check_env: require API key env vars of providers, not needed when replaying recorded answers
+    """
     all_models = _models_info(base_dir)
     providers = get_model_providers(base_dir)
 
@@ -76,7 +89,7 @@ def get_model_list(base_dir: Path) -> List[ModelInfo]:
             error(f"model {m.name}: provider {m.provider} not found. SKIPPING")
             quit(0)
 
-        if p.env and not os.environ.get(p.env):
+        if check_env and p.env and not os.environ.get(p.env):
             error(f"model {m.name}: provider {m.provider} env {p.env} not set. SKIPPING")
             quit(0)
 
@@ -0,0 +1,58 @@
+import gzip
+import json
+import threading
+
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Dict, Any, Optional, Deque
+
+from core.logger import info
+from llm_completion.cache import payload_fingerprint
+
+
+__all__ = ["CompletionRecording"]
+
+
+class CompletionRecording:
+    """
+    Record mode appends (request fingerprint, response) of every successful completion to a gzipped JSONL file.
+    Replay mode serves them back instead of calling providers: a request asked for more times than it was
+    recorded gets its last recorded response again.
+    """
+    def __init__(self, path: Path, replay: bool):
+        self.path = path
+        self.replaying = replay
+        self._lock = threading.Lock()
+        self._responses: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        self._f = None
+
+        if replay:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    d = json.loads(line)
+                    self._responses[d["key"]].append(d["response"])
+            info(f"replaying {sum(len(r) for r in self._responses.values())} completions from {path}")
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._f = gzip.open(path, "at")
+            info(f"recording completions to {path}")
+
+    def record(self, post, response: Dict[str, Any]) -> None:
+        line = json.dumps({"key": payload_fingerprint(post), "model": post.model, "response": response})
+        with self._lock:
+            if self._f:
+                self._f.write(line + "\n")
+
+    def replay(self, post) -> Optional[Dict[str, Any]]:
+        key = payload_fingerprint(post)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                return None
+            return responses.popleft() if len(responses) > 1 else responses[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._f:
+                self._f.close()
+                self._f = None
@@ -0,0 +1,217 @@
+import asyncio
+import dataclasses
+import time
+
+from collections import deque
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Deque, Tuple
+
+from core.globals import (
+    ROUTER_MAX_ERROR_RATE, ROUTER_MIN_BUDGET, ROUTER_SLOW_FACTOR, ROUTER_MIN_SAMPLES, ROUTER_WINDOW
+)
+from core.logger import warn, debug
+from llm_completion.cache import CompletionCache
+from llm_completion.completion import CompletionPayload, llm_completion
+from llm_completion.errors import classify_error, TRANSPORT, RATE_LIMIT
+from llm_completion.models import ModelInfo
+from llm_completion.recording import CompletionRecording
+
+
+__all__ = ["ModelStats", "ModelRouter", "RoutedCompletion", "Admit", "Budget", "Slots"]
+
+
+@dataclass
+class ModelStats:
+    """
+    Sliding window of recent outcomes of a model
+    """
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=ROUTER_WINDOW))
+    errors: Deque[bool] = field(default_factory=lambda: deque(maxlen=ROUTER_WINDOW))
+
+    def record(self, latency_s: Optional[float], error: bool) -> None:
+        self.errors.append(error)
+        if latency_s is not None:
+            self.latencies.append(latency_s)
+
+    def error_rate(self) -> float:
+        return sum(self.errors) / len(self.errors) if self.errors else 0.
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < ROUTER_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+
+def _succeeded(data: List[Dict[str, Any]]) -> bool:
+    return bool(data) and "error" not in data[0]
+
+
+@dataclass
+class RoutedCompletion:
+    model_name: str
+    data: List[Dict[str, Any]]
+    # seconds spent waiting for rate limiter admission
+    queue_wait_s: float = 0.
+    # models tried before model_name, because of transport errors
+    failovers: List[str] = field(default_factory=list)
+    # the answer came from a hedged request
+    hedged: bool = False
+
+
+# (model_name, post) -> seconds waited for admission
+Admit = Callable[[str, CompletionPayload], Awaitable[float]]
+# model_name -> share of rate limit budget left, 0..1
+Budget = Callable[[str], float]
+# model_name -> in-flight requests allowed, held by each request to the model, hedges included
+Slots = Dict[str, asyncio.Semaphore]
+
+# errors of one model another model may not have
+_FAILOVER_ERRORS = (TRANSPORT, RATE_LIMIT)
+
+
+class ModelRouter:
+    """
+    Picks a model per request among `models`, based on live error rate, p95 latency and remaining
+    rate limit budget. The requested model is kept unless it is unhealthy.
+    Transport errors and rate limits fail over to the next healthy model. With hedge=True, a request still running
+    after the model's p95 latency is raced against a second model: the first answer wins.
+    When replaying a recording, routing is skipped: the recorded answer of the requested model is served,
+    else of whichever routed model answered it when recording.
+    """
+    def __init__(
+            self,
+            model_list: List[ModelInfo],
+            models: List[str],
+            admit: Optional[Admit] = None,
+            budget: Optional[Budget] = None,
+            hedge: bool = False,
+            recording: Optional[CompletionRecording] = None,
+            slots: Optional[Slots] = None,
+    ):
+        self.model_list = model_list
+        self.models = [m for m in models if any(r.name == m for r in model_list)]
+        self.admit = admit
+        self.budget = budget
+        self.hedge = hedge
+        self.recording = recording
+        self.slots = slots or {}
+        self.stats: Dict[str, ModelStats] = {m.name: ModelStats() for m in model_list}
+
+    def healthy(self, model_name: str) -> bool:
+        stats = self.stats[model_name]
+        if stats.error_rate() > ROUTER_MAX_ERROR_RATE:
+            return False
+        if self.budget and self.budget(model_name) < ROUTER_MIN_BUDGET:
+            return False
+        return True
+
+    def _score(self, model_name: str) -> float:
+        """
+        Lower is better: expected latency, inflated by errors and a shrinking rate limit budget
+        """
+        stats = self.stats[model_name]
+        latency = stats.p95() or 1.
+        budget = max(self.budget(model_name), 0.01) if self.budget else 1.
+        return latency * (1. + 4. * stats.error_rate()) / budget
+
+    def pick(self, preferred: str, exclude: Tuple[str, ...] = ()) -> Optional[str]:
+        candidates = [m for m in self.models if m not in exclude]
+        if preferred not in exclude and (preferred not in self.stats or preferred not in candidates):
+            # not routed: requested explicitly
+            return preferred
+        if not candidates:
+            return None
+
+        alternatives = sorted((m for m in candidates if m != preferred and self.healthy(m)), key=self._score)
+        if preferred in candidates and self.healthy(preferred):
+            p95, best_p95 = self.stats[preferred].p95(), self.stats[alternatives[0]].p95() if alternatives else None
+            if not (p95 and best_p95 and p95 > ROUTER_SLOW_FACTOR * best_p95):
+                return preferred
+
+        if alternatives:
+            return alternatives[0]
+        # nothing healthy: the least bad one
+        return min(candidates, key=self._score)
+
+    async def _call(
+            self, model_name: str, post: CompletionPayload, cache: Optional[CompletionCache]
+    ) -> Tuple[List[Dict[str, Any]], float]:
+        post = dataclasses.replace(post, model=model_name)
+        cached = cache and cache.contains(post)
+        # the slot of the model actually called, for admission and the request
+        async with (None if cached else self.slots.get(model_name)) or nullcontext():
+            queue_wait_s = 0.
+            if self.admit and not cached:
+                queue_wait_s = await self.admit(model_name, post)
+
+            ts = time.monotonic()
+            data = [chunk async for chunk in llm_completion(self.model_list, post, cache, self.recording)]
+
+        error = not _succeeded(data)
+        if not (data and data[0].get("cache_hit")):
+            self.stats[model_name].record(None if error else time.monotonic() - ts, error)
+
+        return data, queue_wait_s
+
+    async def _hedged_call(
+            self, model_name: str, post: CompletionPayload, cache: Optional[CompletionCache], tried: Tuple[str, ...]
+    ) -> Tuple[str, List[Dict[str, Any]], float, bool]:
+        deadline = self.stats[model_name].p95() if self.hedge else None
+        primary = asyncio.create_task(self._call(model_name, post, cache))
+        if not deadline:
+            data, queue_wait_s = await primary
+            return model_name, data, queue_wait_s, False
+
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        hedge_model = None if done else self.pick(model_name, tried + (model_name,))
+        if not hedge_model:
+            data, queue_wait_s = await primary
+            return model_name, data, queue_wait_s, False
+
+        debug(f"hedging {model_name} with {hedge_model} after {deadline:.2f}s")
+        hedge = asyncio.create_task(self._call(hedge_model, post, cache))
+        tasks = {primary: model_name, hedge: hedge_model}
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        try:
+            # a successful answer wins, an error waits for the other request
+            task = next((t for t in done if _succeeded(t.result()[0])), next(iter(done)))
+            if not _succeeded(task.result()[0]) and pending:
+                task = pending.pop()
+                await task
+
+            data, queue_wait_s = task.result()
+            return tasks[task], data, queue_wait_s, task is hedge
+        finally:
+            # the losing request is abandoned, tokens it consumed are not accounted
+            for task in pending:
+                task.cancel()
+
+    async def _replay(self, post: CompletionPayload) -> RoutedCompletion:
+        data = []
+        for model_name in [post.model, *(m for m in self.models if m != post.model)]:
+            routed_post = dataclasses.replace(post, model=model_name)
+            data = [chunk async for chunk in llm_completion(self.model_list, routed_post, recording=self.recording)]
+            if _succeeded(data):
+                return RoutedCompletion(model_name, data)
+
+        return RoutedCompletion(post.model, data)
+
+    async def complete(self, post: CompletionPayload, cache: Optional[CompletionCache] = None) -> RoutedCompletion:
+        if self.recording and self.recording.replaying:
+            return await self._replay(post)
+
+        tried: Tuple[str, ...] = ()
+        model_name = self.pick(post.model)
+        while True:
+            model_name, data, queue_wait_s, hedged = await self._hedged_call(model_name, post, cache, tried)
+            result = RoutedCompletion(model_name, data, queue_wait_s, list(tried), hedged)
+            if data and not _succeeded(data) and classify_error(data[0]) in _FAILOVER_ERRORS:
+                tried += (model_name,)
+                if next_model := self.pick(post.model, tried):
+                    warn(f"{model_name} failed, failing over to {next_model}")
+                    model_name = next_model
+                    continue
+
+            return result
@@ -0,0 +1,94 @@
+import argparse
+import random
+import time
+
+from core.fmt_output import convert_s1_to_output
+
+
+def convert_s1_to_output_legacy(input_data):
+    # O(sections x section_ns x pages) implementation, kept as a reference
+    output = {
+        "file_name": input_data["file_name"],
+        "sections": []
+    }
+
+    for section_idx, section in enumerate(input_data["sections"]):
+        for section_n in set(p["section_n"] for p in input_data["pages"]):
+            section_pages = [
+                p["page_num"] for p in input_data["pages"]
+                if section in p["sections"] and p["section_n"] == section_n
+            ]
+
+            if section_pages:
+                section_entry = {
+                    "section": section,
+                    "section_n": section_n,
+                    "page_start": min(section_pages),
+                    "page_end": max(section_pages)
+                }
+                output["sections"].append(section_entry)
+
+    return output
+
+
+def synthetic_step1(pages_cnt: int, sections_cnt: int, rnd: random.Random):
+    """
+    step1 dump of a document: consecutive sections, some of them repeated later in the document,
+    some pages without a detected section
+    """
+    names = [f"{rnd.randint(10 ** 5, 10 ** 6 - 1)}" for _ in range(max(1, sections_cnt * 3 // 4))]
+    bounds = sorted(rnd.sample(range(1, pages_cnt), sections_cnt - 1)) if sections_cnt > 1 else []
+
+    pages = []
+    section_n = 0
+    for page_num in range(1, pages_cnt + 1):
+        if page_num - 1 in bounds:
+            section_n += 1
+        section = names[section_n % len(names)]
+        pages.append({
+            "page_num": page_num,
+            "sections": [section] if rnd.random() > 0.05 else [],
+            "section_n": section_n,
+        })
+
+    return {
+        "file_path": f"/synthetic/{pages_cnt}.pdf",
+        "file_name": f"{pages_cnt}.pdf",
+        "pages_cnt": pages_cnt,
+        "sections": list(set(s for p in pages for s in p["sections"])),
+        "pages": pages,
+    }
+
+
+def timeit(fn, docs, repeat: int) -> float:
+    ts = time.perf_counter()
+    for _ in range(repeat):
+        for d in docs:
+            fn(d)
+    return (time.perf_counter() - ts) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert_s1_to_output on synthetic documents")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--sections", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--docs", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    print(f"{args.docs} documents x {args.pages} pages")
+    print(f"{'sections':>9} {'legacy, s':>10} {'single pass, s':>15} {'speedup':>8}")
+    for sections_cnt in args.sections:
+        docs = [synthetic_step1(args.pages, sections_cnt, rnd) for _ in range(args.docs)]
+
+        for d in docs:
+            assert convert_s1_to_output(d) == convert_s1_to_output_legacy(d), "outputs differ"
+
+        t_legacy = timeit(convert_s1_to_output_legacy, docs, args.repeat)
+        t_new = timeit(convert_s1_to_output, docs, args.repeat)
+        print(f"{sections_cnt:>9} {t_legacy:>10.4f} {t_new:>15.4f} {t_legacy / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
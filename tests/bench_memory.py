@@ -0,0 +1,109 @@
+import argparse
+import base64
+import gc
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from io import BytesIO
+from pathlib import Path
+
+from utils import make_synthetic_pdf
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def peak_rss_mb() -> float:
+    # split pages are produced in PDF pool processes, pages pass through this process only
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    # Linux only; steady state after the document has been ingested
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def run_eager(pdf_path: Path):
+    # pre-PageStore behaviour: every page is held as a base64 string for the document's lifetime
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(pdf_path)
+    pages = []
+    for page in reader.pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        memory_file = BytesIO()
+        writer.write(memory_file)
+        pages.append(base64.b64encode(memory_file.getvalue()).decode("utf-8"))
+    return pages
+
+
+def run_lazy(pdf_path: Path):
+    from core.globals import SUMMARIZER_CONCURRENCY
+    from core.pdf_document import PDFDocument
+    from core.pdf_processor import spawn_pdf_pool, process_pdf, collect_pages
+    from core.prompts import load_prompts
+    from core.summarizer.step1 import create_ticket_step1
+
+    prompts = load_prompts(BASE_DIR)
+    doc = PDFDocument(pdf_path)
+    doc.usage.ts_start = time.time()
+    with spawn_pdf_pool() as pool:
+        process_pdf(doc, pool)
+        collect_pages(doc, block=True)
+    tickets = [create_ticket_step1(doc, page, prompts) for page in doc]
+
+    # requests in flight materialize their pages
+    in_flight = [[m.as_dict() for m in t.post.messages] for t in tickets[:SUMMARIZER_CONCURRENCY]]
+    return tickets, in_flight
+
+
+def child(mode: str, pdf_path: Path):
+    import core.summarizer.step1  # noqa: F401, same imports for both modes
+
+    rss_start = current_rss_mb()
+    _ = run_eager(pdf_path) if mode == "eager" else run_lazy(pdf_path)
+    gc.collect()
+    print(json.dumps({
+        "rss_start_mb": rss_start, "rss_peak_mb": peak_rss_mb(), "rss_held_mb": current_rss_mb()
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS of holding a document in memory vs page count")
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 100, 200, 400])
+    parser.add_argument("--page_kb", type=int, default=128, help="size of a single page PDF")
+    parser.add_argument("--child", choices=["eager", "lazy"], help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.pdf)
+        return
+
+    print("RSS growth over imports, MB: peak / held while the document is in flight")
+    print(f"{'pages':>6} {'PDF MB':>8} {'eager b64':>16} {'page store':>16}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for pages_cnt in args.pages:
+            pdf_path = Path(tmp_dir) / f"bench_{pages_cnt}.pdf"
+            make_synthetic_pdf(pdf_path, [("123456", pages_cnt)], noise_bytes=args.page_kb * 1024)
+
+            results = {}
+            for mode in ["eager", "lazy"]:
+                out = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, "--pdf", str(pdf_path)],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                r = json.loads(out.strip().splitlines()[-1])
+                results[mode] = f"{r['rss_peak_mb'] - r['rss_start_mb']:.1f} / {r['rss_held_mb'] - r['rss_start_mb']:.1f}"
+
+            print(f"{pages_cnt:>6} {pdf_path.stat().st_size / 1024 / 1024:>8.1f} {results['eager']:>16} {results['lazy']:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+
+from utils import make_synthetic_pdf, synthetic_step1_answers
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+SECTION_PAGES = 10
+
+
+def doc_sections(pages: int, doc_idx: int) -> List[tuple]:
+    """
+    Sections of SECTION_PAGES pages, the last one shorter
+    """
+    return [
+        (f"{doc_idx:03d}{idx:03d}", min(SECTION_PAGES, pages - start))
+        for idx, start in enumerate(range(0, pages, SECTION_PAGES))
+    ]
+
+
+def make_dataset(pdf_dir: Path, sizes: List[int], copies: int, noise_kb: int) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Writes synthetic PDFs and the answers the fake model replays for their pages
+    :return: answers, sha256 of split pages by file name
+    """
+    from core.pdf_processor import split_pages
+
+    answers, pages = {}, {}
+    for copy in range(copies):
+        for size in sizes:
+            doc_idx = len(answers)
+            sections = doc_sections(size, doc_idx)
+            name = f"doc_{doc_idx:03d}_{size}p.pdf"
+            make_synthetic_pdf(pdf_dir / name, sections, noise_bytes=noise_kb * 1024, seed=doc_idx)
+            answers[name] = synthetic_step1_answers(sections)
+            pages[name] = [hashlib.sha256(data).hexdigest() for _, data, _, _ in split_pages(pdf_dir / name, 0, size, False)]
+    return answers, pages
+
+
+def install_fake_provider(replay_file: Path):
+    """
+    The fake provider replays answers of replay_file; runs in summarizer processes too
+    """
+    from llm_completion.completion import CompletionPayload, InlineContent
+    from llm_completion.fake_provider import fake_provider, FakeProfile
+    from core.prompts import load_prompts
+    from core.summarizer.summ_utils import PDFPageContent, PDFPageRef
+
+    replay = json.loads(replay_file.read_text())
+    prompts = load_prompts(BASE_DIR)
+
+    # pages sent to workers are inline, to summarizer processes by reference: their fingerprints are looked up
+    pages_by_fingerprint = {}
+    for name, pages in replay["pages"].items():
+        for page_num, sha256 in enumerate(pages, start=1):
+            pages_by_fingerprint[f"pdf:{sha256}"] = (name, page_num)
+
+    def pages_of(post: CompletionPayload) -> List[Dict[str, Any]]:
+        found = []
+        for m in post.messages:
+            for c in m.content if isinstance(m.content, list) else []:
+                if isinstance(c, PDFPageContent):
+                    name, page_num = c.data.parent_path.name, c.data.page_num
+                elif isinstance(c, (InlineContent, PDFPageRef)):
+                    name, page_num = pages_by_fingerprint[c.fingerprint()]
+                else:
+                    continue
+                sections, parts = replay["answers"][name][page_num - 1]
+                found.append({"page_number": page_num, "sections": sections, "parts": parts})
+        return found
+
+    def responder(post: CompletionPayload) -> str:
+        system = post.messages[0].content
+        if system == prompts.SP_markdown_sections_and_parts_batch:
+            return json.dumps(pages_of(post))
+        if system == prompts.SP_markdown_sections_and_parts:
+            # the target page comes last
+            return json.dumps(pages_of(post)[-1])
+        parts = sorted({p for page in pages_of(post) for p in page["parts"]})
+        return json.dumps({
+            "section_summary": "Synthetic section.",
+            "parts": [{"part_name": p, "part_summary": "Synthetic part."} for p in parts],
+        })
+
+    fake_provider.responder = responder
+    fake_provider.profiles = {name: FakeProfile(**p) for name, p in replay["profiles"].items()}
+
+
+def child(replay_file: Path, main_args: List[str], worker: bool):
+    """
+    Runs core.main, or a core.worker with worker=True, in this process against the fake provider
+    """
+    from llm_completion.models import _models_info
+    import core.main
+    import core.worker
+
+    install_fake_provider(replay_file)
+    core.main.spawn_summarizer_procs = functools.partial(
+        core.main.spawn_summarizer_procs, initializer=functools.partial(install_fake_provider, replay_file)
+    )
+    core.main.get_model_list = core.worker.get_model_list = lambda base_dir, check_env=True: [
+        dataclasses.replace(m, provider="fake") for m in _models_info(base_dir)
+    ]
+
+    sys.argv = ["main", *main_args]
+    if worker:
+        core.worker.main()
+    else:
+        core.main.main()
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="core.main end to end over synthetic PDFs, with a fake model replaying correct answers"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 100], help="pages of documents")
+    parser.add_argument("--copies", type=int, default=3, help="documents of each size")
+    parser.add_argument("--noise_kb", type=int, default=16, help="incompressible bytes per page")
+    parser.add_argument("--latency_s", type=float, default=0.5, help="median model latency")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="log-normal spread of model latency")
+    parser.add_argument("--slow_rate", type=float, default=0.02)
+    parser.add_argument("--slow_latency_s", type=float, default=5.)
+    parser.add_argument("--error_rate", type=float, default=0.02, help="share of 503s")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.02, help="share of 429s")
+    parser.add_argument(
+        "--serialize", action="store_true", help="fake models encode request bodies, as provider clients do"
+    )
+    parser.add_argument(
+        "--main_args", type=str, default="--no_local_step1 --no_cache",
+        help="extra arguments of core.main, e.g. --main_args='--no_cache --step1_batch 8'"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0,
+        help="summarizer workers behind a work queue (core.main --work_queue), 0: summarizer in process"
+    )
+    parser.add_argument(
+        "--timeout_s", type=float, default=None, help="fail if core.main does not finish in time, e.g. for smoke runs"
+    )
+    parser.add_argument("--child", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+
+    if args.child:
+        child(args.child, rest, args.worker)
+        return
+
+    profile = {
+        "latency_s": args.latency_s,
+        "latency_sigma": args.latency_sigma,
+        "slow_rate": args.slow_rate,
+        "slow_latency_s": args.slow_latency_s,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "serialize": args.serialize,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_dir, state_dir = Path(tmp_dir) / "pdfs", Path(tmp_dir) / "state"
+        pdf_dir.mkdir()
+        state_dir.mkdir()
+
+        answers, pages_sha256 = make_dataset(pdf_dir, args.sizes, args.copies, args.noise_kb)
+        replay_file = Path(tmp_dir) / "replay.json"
+        replay_file.write_text(json.dumps({
+            "answers": answers,
+            "pages": pages_sha256,
+            "profiles": {name: profile for name in ["gemini-2.0-flash", "gpt-4o"]},
+        }))
+
+        env = {
+            **os.environ,
+            "SUMM_STATE_DIR": str(state_dir),
+            "PYTHONPATH": os.pathsep.join([str(BASE_DIR / "src"), os.environ.get("PYTHONPATH", "")]),
+            "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+        }
+        main_args = args.main_args.split()
+        workers = []
+        if args.workers:
+            work_queue = state_dir / ".work_queue.sqlite3"
+            worker_args = [a for a in main_args if a in ("--route", "--hedge")]
+            main_args += ["--work_queue", str(work_queue)]
+        cmd = [
+            sys.executable, __file__, "--child", str(replay_file),
+            "-d", str(pdf_dir), "--exit_when_done", *main_args,
+        ]
+
+        pages = sum(args.sizes) * args.copies
+        print(f"{len(answers)} documents, {pages} pages, main args: {' '.join(main_args)}, workers: {args.workers}")
+        print(f"fake models: {profile}")
+
+        ts = time.monotonic()
+        try:
+            for idx in range(args.workers):
+                workers.append(subprocess.Popen(
+                    [
+                        sys.executable, __file__, "--child", str(replay_file), "--worker",
+                        "--work_queue", str(work_queue), "--worker_id", f"worker-{idx}", *worker_args,
+                    ],
+                    env=env, stderr=subprocess.DEVNULL,
+                ))
+            subprocess.run(cmd, env=env, check=True, stderr=subprocess.DEVNULL, timeout=args.timeout_s)
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+        wall_s = time.monotonic() - ts
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        done = [json.loads(line) for line in (state_dir / ".step2.jsonl").read_text().splitlines()]
+        failed_file = state_dir / ".failed.jsonl"
+        failed = len(failed_file.read_text().splitlines()) if failed_file.is_file() else 0
+
+    latencies = [d["usage"]["finished_in_s"] for d in done]
+    # throughput from the first document start, without interpreter and model list start up
+    busy_s = max(d["usage"]["ts_end"] for d in done) - min(d["usage"]["ts_start"] for d in done)
+    calls = sum(len(d["usage"]["calls"]) for d in done)
+
+    print(f"{'docs':>5} {'failed':>7} {'calls':>6} {'docs/min':>9} {'p50, s':>7} {'p95, s':>7} "
+          f"{'wall, s':>8} {'CPU, s':>7} {'peak RSS, MB':>13}")
+    print(
+        f"{len(done):>5} {failed:>7} {calls:>6} {len(done) / busy_s * 60:>9.1f} "
+        f"{statistics.median(latencies):>7.2f} {percentile(latencies, 0.95):>7.2f} {wall_s:>8.2f} "
+        f"{usage.ru_utime + usage.ru_stime:>7.2f} {usage.ru_maxrss / 1024:>13.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
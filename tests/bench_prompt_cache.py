@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from utils import make_synthetic_pdf
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def legacy_order(messages: List) -> List:
+    # pre-caching layout: static instructions were sent after the pages
+    return [messages[0], *messages[2:], messages[1]]
+
+
+def fake_model(prompt_cache: Optional[str], min_tokens: int):
+    from llm_completion.models import ModelInfo
+
+    return ModelInfo(
+        name="fake", provider="fake", resolve_as="fake/fake",
+        context_window=128000, max_output_tokens=16384,
+        dollars_input=2.5, dollars_output=10., dollars_input_cached=1.25,
+        tokens_per_minute=None, request_per_minute=None,
+        prompt_cache=prompt_cache, prompt_cache_min_tokens=min_tokens,
+    )
+
+
+async def run(tickets, model) -> tuple:
+    from llm_completion.completion import llm_completion
+    from llm_completion.fake_provider import fake_provider
+
+    fake_provider.reset()
+    tokens_in, tokens_in_cached = 0, 0
+    for ticket in tickets:
+        async for r in llm_completion([model], ticket.post):
+            usage = r["usage"]
+            tokens_in += usage["prompt_tokens"]
+            tokens_in_cached += usage["prompt_tokens_details"]["cached_tokens"]
+
+    return tokens_in, tokens_in_cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description="provider prompt cache accounting with the offline fake provider")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--context_pages", type=int, default=1, help="pages_before / pages_after of step1 tickets")
+    parser.add_argument("--min_tokens", type=int, nargs="+", default=[256, 1024])
+    args = parser.parse_args()
+
+    from core.pdf_document import PDFDocument
+    from core.pdf_processor import process_pdf, collect_pages
+    from core.prompts import load_prompts
+    from core.summarizer.step1 import create_ticket_step1, advance_step1_heuristics, section_name
+    from core.summarizer.step2 import create_ticket_step2
+
+    prompts = load_prompts(BASE_DIR)
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = Path(tmp) / "bench.pdf"
+        sections = [(f"{100000 + i}", 5) for i in range(max(1, args.pages // 5))]
+        make_synthetic_pdf(pdf_path, sections, noise_bytes=1024)
+
+        doc = PDFDocument(pdf_path)
+        doc.usage.ts_start = time.time()
+        with ThreadPoolExecutor() as pool:
+            process_pdf(doc, pool, classify=False)
+            collect_pages(doc, block=True)
+
+        # step1 answers as the model would give them, section numbers and bounds come from the heuristics
+        for idx, page in enumerate(doc):
+            page.data_step1.sections = [sections[min(idx // 5, len(sections) - 1)][0]]
+            page.data_step1.success = True
+        section_ns = advance_step1_heuristics(doc)
+        assert doc.step1_set, "step1 heuristics did not finalize all pages"
+        tickets = {
+            "step1": [
+                create_ticket_step1(doc, page, prompts, args.context_pages, args.context_pages) for page in doc
+            ],
+            "step2": [create_ticket_step2(doc, prompts, s_n, section_name(doc, s_n)) for s_n in section_ns],
+        }
+
+        print(f"{doc.pages_cnt} pages, {len(sections)} sections")
+        print(f"{'tickets':>8} {'order':>7} {'cache':>9} {'min':>5} {'tokens_in':>10} {'cached':>8} {'input $':>9}")
+        for name, step_tickets in tickets.items():
+            for order in ["legacy", "stable"]:
+                for ticket in step_tickets:
+                    ticket.post.model = "fake"
+                    if order == "legacy":
+                        ticket.post.messages = legacy_order(ticket.post.messages)
+
+                for prompt_cache in [None, "auto", "explicit"]:
+                    for min_tokens in args.min_tokens:
+                        model = fake_model(prompt_cache, min_tokens)
+                        tokens_in, cached = asyncio.run(run(step_tickets, model))
+                        cost = ((tokens_in - cached) * model.dollars_input + cached * model.dollars_input_cached) / 1e6
+                        print(
+                            f"{name:>8} {order:>7} {str(prompt_cache):>9} {min_tokens:>5} "
+                            f"{tokens_in:>10} {cached:>8} {cost:>9.5f}"
+                        )
+
+                if order == "legacy":
+                    # back to the layout the tickets were created with
+                    for ticket in step_tickets:
+                        m = ticket.post.messages
+                        ticket.post.messages = [m[0], m[-1], *m[1:-1]]
+
+        doc.close()
+
+
+if __name__ == "__main__":
+    main()
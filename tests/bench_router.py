@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import statistics
+import time
+
+from collections import Counter
+
+
+def fake_model(name: str):
+    from llm_completion.models import ModelInfo
+
+    return ModelInfo(
+        name=name, provider="fake", resolve_as=f"fake/{name}",
+        context_window=128000, max_output_tokens=16384,
+        dollars_input=1., dollars_output=1.,
+        tokens_per_minute=None, request_per_minute=None,
+    )
+
+
+async def run(router, requests: int, concurrency: int):
+    from llm_completion.completion import CompletionPayload, ChatMessage
+
+    slots = asyncio.Semaphore(concurrency)
+    latencies, models, errors, hedged, failovers = [], Counter(), 0, 0, 0
+
+    async def one(idx: int):
+        nonlocal errors, hedged, failovers
+        async with slots:
+            post = CompletionPayload(model="primary", messages=[ChatMessage(role="user", content=f"request {idx}")])
+            ts = time.monotonic()
+            routed = await router.complete(post)
+            latencies.append(time.monotonic() - ts)
+            models[routed.model_name] += 1
+            errors += "error" in routed.data[0]
+            hedged += routed.hedged
+            failovers += len(routed.failovers)
+
+    await asyncio.gather(*[one(idx) for idx in range(requests)])
+    latencies.sort()
+    return {
+        "mean": statistics.mean(latencies),
+        "p95": latencies[int(len(latencies) * 0.95)],
+        "p99": latencies[int(len(latencies) * 0.99)],
+        "errors": errors,
+        "hedged": hedged,
+        "failovers": failovers,
+        "models": dict(models),
+    }
+
+
+def logging_off():
+    # failover warnings of every request would drown the table
+    import logging
+    logging.getLogger("SUMM").setLevel(logging.ERROR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ModelRouter failover and hedging against fake models")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--slow_rate", type=float, default=0.1, help="share of slow requests of the primary model")
+    parser.add_argument("--error_rate", type=float, default=0.1, help="share of 503s of the primary model")
+    args = parser.parse_args()
+
+    from llm_completion.fake_provider import fake_provider, FakeProfile
+    from llm_completion.router import ModelRouter
+
+    logging_off()
+    model_list = [fake_model("primary"), fake_model("secondary")]
+    fake_provider.profiles = {
+        "primary": FakeProfile(
+            latency_s=0.05, slow_rate=args.slow_rate, slow_latency_s=1., error_rate=args.error_rate
+        ),
+        "secondary": FakeProfile(latency_s=0.15, error_rate=0.01),
+    }
+
+    print(f"{args.requests} requests, {args.concurrency} in flight")
+    print(f"{'mode':>9} {'mean, s':>8} {'p95, s':>7} {'p99, s':>7} {'errors':>7} {'hedged':>7} {'failover':>9}  models")
+    for mode, models, hedge in [
+        ("primary", ["primary"], False),
+        ("failover", ["primary", "secondary"], False),
+        ("hedge", ["primary", "secondary"], True),
+    ]:
+        fake_provider.rnd.seed(0)
+        router = ModelRouter(model_list, models, hedge=hedge)
+        r = asyncio.run(run(router, args.requests, args.concurrency))
+        print(
+            f"{mode:>9} {r['mean']:>8.3f} {r['p95']:>7.3f} {r['p99']:>7.3f} {r['errors']:>7} "
+            f"{r['hedged']:>7} {r['failovers']:>9}  {r['models']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+from core.summarizer.ticket_queue import TicketQueue, SCHEDULING_POLICIES
+
+
+@dataclass(eq=False)
+class SimDoc:
+    pages_total: int
+    arrival_s: float
+    step1_left: int = 0
+    step2_left: int = 0
+    ts_arrival: float = 0.
+    ts_done: Optional[float] = None
+
+    def sections_cnt(self) -> int:
+        return max(1, self.pages_total // 10)
+
+
+@dataclass
+class SimTicket:
+    doc: SimDoc
+    step2: bool = False
+    attempts: int = 0
+
+    def priority(self) -> int:
+        return 0 if self.step2 or self.attempts else 1
+
+
+def make_workload(big_pages: int, small_docs: int, interval_s: float, rnd: random.Random) -> List[SimDoc]:
+    """
+    A big document first, then a stream of small ones
+    """
+    docs = [SimDoc(big_pages, 0.)]
+    docs += [SimDoc(rnd.randint(3, 30), (idx + 1) * interval_s) for idx in range(small_docs)]
+    return docs
+
+
+async def simulate(
+        workload: List[SimDoc], policy: str, concurrency: int, latency_s: float, error_rate: float, rnd: random.Random
+) -> float:
+    loop = asyncio.get_running_loop()
+    q = TicketQueue()
+    q.bind(loop, policy)
+    slots = asyncio.Semaphore(concurrency)
+    all_done = asyncio.Event()
+    ts_start = time.monotonic()
+
+    def arrive(doc: SimDoc):
+        doc.ts_arrival = time.monotonic()
+        doc.step1_left = doc.pages_total
+        [q.put(SimTicket(doc)) for _ in range(doc.pages_total)]
+
+    def finish(ticket: SimTicket):
+        doc = ticket.doc
+        if rnd.random() < error_rate:
+            ticket.attempts += 1
+            q.put_later(ticket, latency_s)
+            return
+
+        if not ticket.step2:
+            doc.step1_left -= 1
+            if not doc.step1_left:
+                doc.step2_left = doc.sections_cnt()
+                [q.put(SimTicket(doc, step2=True)) for _ in range(doc.step2_left)]
+            return
+
+        doc.step2_left -= 1
+        if not doc.step2_left:
+            doc.ts_done = time.monotonic()
+            if all(d.ts_done for d in workload):
+                all_done.set()
+
+    async def run(ticket: SimTicket):
+        try:
+            await asyncio.sleep(latency_s * rnd.uniform(0.5, 1.5))
+            finish(ticket)
+        finally:
+            slots.release()
+
+    async def consume():
+        tasks = set()
+        while True:
+            await slots.acquire()
+            ticket = await q.get()
+            task = asyncio.create_task(run(ticket))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    for doc in workload:
+        loop.call_later(doc.arrival_s, arrive, doc)
+
+    consumer = asyncio.create_task(consume())
+    await all_done.wait()
+    consumer.cancel()
+    return time.monotonic() - ts_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Document completion times under ticket scheduling policies")
+    parser.add_argument("--big_pages", type=int, default=500)
+    parser.add_argument("--small_docs", type=int, default=20)
+    parser.add_argument("--interval_s", type=float, default=0.01, help="arrival interval of small documents")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency_s", type=float, default=0.01, help="simulated model call latency")
+    parser.add_argument("--error_rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    print(
+        f"1 x {args.big_pages} pages + {args.small_docs} small documents, {args.concurrency} in flight, "
+        f"{args.latency_s * 1000:.0f}ms per call"
+    )
+    print(f"{'policy':>7} {'mean, s':>8} {'p95, s':>7} {'small mean, s':>14} {'big, s':>7} {'total, s':>9}")
+    for policy in SCHEDULING_POLICIES:
+        rnd = random.Random(0)
+        workload = make_workload(args.big_pages, args.small_docs, args.interval_s, rnd)
+        total = asyncio.run(simulate(workload, policy, args.concurrency, args.latency_s, args.error_rate, rnd))
+
+        times = sorted(d.ts_done - d.ts_arrival for d in workload)
+        small = [d.ts_done - d.ts_arrival for d in workload[1:]]
+        big = workload[0].ts_done - workload[0].ts_arrival
+        print(
+            f"{policy:>7} {statistics.mean(times):>8.3f} {times[int(len(times) * 0.95)]:>7.3f} "
+            f"{statistics.mean(small):>14.3f} {big:>7.3f} {total:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
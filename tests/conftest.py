@@ -0,0 +1,11 @@
+import os
+import sys
+
+from pathlib import Path
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+
+# same layout as running benchmarks from tests/ with PYTHONPATH=../src
+sys.path[:0] = [str(TESTS_DIR.parent / "src"), str(TESTS_DIR)]
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
@@ -1,22 +1,101 @@
 import argparse
 import json
+import os
+import subprocess
+import sys
+import tempfile
 
 from pathlib import Path
 from termcolor import colored
 from queue import Queue
+from typing import Dict, Any, List
 
 from utils import convert_output_format
 from my_watchdog import spawn_watchdog
+from core.globals import STEP1_DUMP_FILE
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 EXPECTED_JSON = BASE_DIR/ "tests" / "expected.json"
-STEP1_FILE = BASE_DIR / ".step1.jsonl"
+STEP1_FILE = STEP1_DUMP_FILE
+
+
+def check_step1(data: Dict[str, Any], expected: List[Dict[str, Any]]) -> bool:
+    """
+    Compares sections of a .step1.jsonl line with expected.json, prints the result
+    :return: True if every section and its pages match
+    """
+    print(f"Checking {data['file_name']}...")
+
+    expected_value = [i for i in expected if i["file_name"] == data["file_name"]][0]
+    data = convert_output_format(data)
+
+    if len(expected_value["sections"]) != len(data["sections"]):
+        print(colored(f"FAIL: number of section does not match: expected: {len(expected_value["sections"])}; got: {len(data["sections"])}", "red"))
+        return False
+
+    sections_exp = {i["section"] for i in expected_value["sections"]}
+    sections_data = {i["section"] for i in data["sections"]}
+    if sections_exp != sections_data:
+        print(colored(f"FAIL: section does not match: expected: {sections_exp}; got: {sections_data}", "red"))
+        return False
+
+    expected_value["sections"].sort(key=lambda x: x["section"])
+    data["sections"].sort(key=lambda x: x["section"])
+
+    ok = True
+    for (es, ds) in zip(expected_value["sections"], data["sections"]):
+        if es["page_start"] != ds["page_start"]:
+            print(colored(f"FAIL: SECTION {es['section']} page_start does not match: expected: {es['page_start']}; got: {ds['page_start']}", "red"))
+            ok = False
+            continue
+
+        if es["page_end"] != ds["page_end"]:
+            print(colored(f"FAIL: SECTION {es['section']} page_end does not match: expected: {es['page_end']}; got: {ds['page_end']}", "red"))
+            ok = False
+            continue
+
+        print(colored(f"OK: SECTION {es['section']}", "green"))
+
+    return ok
+
+
+def run_recorded(dataset_dir: Path, expected: List[Dict[str, Any]], recording_args: List[str]) -> bool:
+    """
+    Runs core.main once over the dataset with fresh state, then checks every document of its .step1.jsonl
+    :param recording_args: --llm_replay PATH, or --llm_record PATH for a live run
+    """
+    with tempfile.TemporaryDirectory() as state_dir:
+        env = {
+            **os.environ,
+            "SUMM_STATE_DIR": state_dir,
+            "PYTHONPATH": os.pathsep.join([str(BASE_DIR / "src"), os.environ.get("PYTHONPATH", "")]),
+        }
+        cmd = [
+            sys.executable, "-m", "core.main", "-d", str(dataset_dir),
+            "--exit_when_done", "--reprocess_all", "--no_cache", *recording_args,
+        ]
+        subprocess.run(cmd, env=env, check=True)
+
+        step1_file = Path(state_dir) / STEP1_FILE.name
+        assert step1_file.is_file(), f"Step 1 JSON file not found: {step1_file}"
+        results = [check_step1(json.loads(line), expected) for line in step1_file.read_text().splitlines()]
+
+    print(f"{sum(results)}/{len(results)} documents OK")
+    return all(results)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--target_dir", required=True, type=Path)
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        "--replay", type=Path,
+        help="Run core.main over the dataset with answers recorded by --record PATH, then check step1"
+    )
+    recording.add_argument(
+        "--record", type=Path, help="Run core.main over the dataset with live models, recording answers to PATH"
+    )
     args = parser.parse_args()
 
     target_dir: Path = args.target_dir
@@ -24,8 +103,8 @@ def main():
         target_dir = BASE_DIR / target_dir
         print(f"target dir '{args.target_dir}' -> '{target_dir}' (completed to absolute path)")
 
-    dataset_dir = args.target_dir
-    
+    dataset_dir = target_dir
+
     print("test started")
     assert EXPECTED_JSON.is_file(), f"Expected JSON file not found: {EXPECTED_JSON}"
     assert dataset_dir.is_dir(), f"Dataset directory not found: {dataset_dir}"
@@ -34,6 +113,10 @@ def main():
     assert dataset_files, f"No PDF files found in the dataset directory: {dataset_dir}"
 
     expected = json.loads(EXPECTED_JSON.read_text())
+    if args.replay or args.record:
+        recording_args = ["--llm_replay", str(args.replay)] if args.replay else ["--llm_record", str(args.record)]
+        sys.exit(0 if run_recorded(dataset_dir, expected, recording_args) else 1)
+
     # assuming core is already up and running
     # uv run src/core/main.py -d dataset
 
@@ -51,37 +134,7 @@ def main():
                     if data["file_name"] in processed_files:
                         continue
 
-                    print(f"Checking {data['file_name']}...")
-
-                    expected_value = [i for i in expected if i["file_name"] == data["file_name"]][0]
-                    data = convert_output_format(data)
-
-                    if len(expected_value["sections"]) != len(data["sections"]):
-                        print(colored(f"FAIL: number of section does not match: expected: {len(expected_value["sections"])}; got: {len(data["sections"])}", "red"))
-                        processed_files.append(data["file_name"])
-                        continue
-
-                    sections_exp = {i["section"] for i in expected_value["sections"]}
-                    sections_data = {i["section"] for i in data["sections"]}
-                    if sections_exp != sections_data:
-                        print(colored(f"FAIL: section does not match: expected: {sections_exp}; got: {sections_data}", "red"))
-                        processed_files.append(data["file_name"])
-                        continue
-
-                    expected_value["sections"].sort(key=lambda x: x["section"])
-                    data["sections"].sort(key=lambda x: x["section"])
-
-                    for (es, ds) in zip(expected_value["sections"], data["sections"]):
-                        if es["page_start"] != ds["page_start"]:
-                            print(colored(f"FAIL: SECTION {es['section']} page_start does not match: expected: {es['page_start']}; got: {ds['page_start']}", "red"))
-                            continue
-
-                        if es["page_end"] != ds["page_end"]:
-                            print(colored(f"FAIL: SECTION {es['section']} page_end does not match: expected: {es['page_end']}; got: {ds['page_end']}", "red"))
-                            continue
-
-                        print(colored(f"OK: SECTION {es['section']}", "green"))
-
+                    check_step1(data, expected)
                     processed_files.append(data["file_name"])
 
     except KeyboardInterrupt:
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+
+
+@pytest.mark.parametrize("main_args", ["--no_local_step1 --no_cache", "--no_local_step1 --no_cache --summarizer_procs 2"])
+def test_pipeline_smoke(main_args):
+    """
+    Every step1 / step2 request of the fake models is answered, in process and from summarizer processes
+    """
+    result = subprocess.run(
+        [
+            sys.executable, str(TESTS_DIR / "bench_pipeline.py"), "--sizes", "5", "12", "--copies", "1",
+            "--latency_s", "0.01", "--slow_rate", "0", "--error_rate", "0", "--rate_limit_rate", "0",
+            "--timeout_s", "120", f"--main_args={main_args}",
+        ],
+        cwd=TESTS_DIR, capture_output=True, text=True, timeout=180,
+        env={**os.environ, "PYTHONPATH": str(TESTS_DIR.parent / "src")},
+    )
+    assert result.returncode == 0, result.stderr
+
+    docs, failed, calls = map(int, result.stdout.splitlines()[-1].split()[:3])
+    assert (docs, failed) == (2, 0)
+    # a step1 call per page, a step2 call per section
+    assert calls == 17 + 3
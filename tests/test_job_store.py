@@ -0,0 +1,65 @@
+import sqlite3
+
+from pathlib import Path
+
+from core.job_store import JobStore
+from core.pdf_document import PDFDocument, PDFPage, PDFPageData, PDFDocumentDataItemStep2
+
+
+def make_doc() -> PDFDocument:
+    doc = PDFDocument(Path("test.pdf"))
+    doc.doc_id = "sha256"
+    page = PDFPage()
+    page.data = PDFPageData(None, 0, 0, "", 1, doc.path)
+    doc.insert_page(page)
+    return doc
+
+
+def test_step1_votes_survive_a_restart(tmp_path):
+    doc = make_doc()
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    store.register(doc)
+    step1 = doc[0].data_step1
+    step1.sections, step1.parts, step1.samples, step1.agreement = ["100001"], ["PART 1"], 8, 0.625
+    store.save_step1(doc, doc[0])
+    store.close()
+
+    restarted = make_doc()
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    assert store.load_step1(restarted, restarted[0])
+    step1 = restarted[0].data_step1
+    assert (step1.sections, step1.parts, step1.samples, step1.agreement) == (["100001"], ["PART 1"], 8, 0.625)
+    assert step1.success
+    store.close()
+
+
+def test_job_store_of_an_older_version_is_migrated(tmp_path):
+    conn = sqlite3.connect(tmp_path / "jobs.sqlite3")
+    conn.execute(
+        "CREATE TABLE step1 (doc_id TEXT NOT NULL, page_num INTEGER NOT NULL, sections TEXT NOT NULL, "
+        "parts TEXT NOT NULL, PRIMARY KEY (doc_id, page_num))"
+    )
+    conn.execute("INSERT INTO step1 VALUES ('sha256', 1, '[\"100001\"]', '[]')")
+    conn.commit()
+    conn.close()
+
+    doc = make_doc()
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    assert store.load_step1(doc, doc[0])
+    assert (doc[0].data_step1.samples, doc[0].data_step1.agreement) == (0, None)
+    store.close()
+
+
+def test_finished_document_is_forgotten(tmp_path):
+    doc = make_doc()
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    store.register(doc)
+    store.save_step1(doc, doc[0])
+    store.save_step2(doc, PDFDocumentDataItemStep2("100001", 0, "summary"))
+
+    store.forget(doc)
+    restarted = make_doc()
+    assert not store.load_step1(restarted, restarted[0])
+    assert store.load_step2(restarted, 0) is None
+    assert not store._execute("SELECT * FROM documents")
+    store.close()
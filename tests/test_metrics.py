@@ -0,0 +1,15 @@
+from core.metrics import Counter, Registry
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    errors = Counter("errors_total", "Errors\nby \\ reason", ("reason",), registry)
+    errors.labels('bad "quote"').inc()
+    errors.labels("line\nbreak \\ slash").inc(2)
+
+    assert registry.render().splitlines() == [
+        "# HELP errors_total Errors\\nby \\\\ reason",
+        "# TYPE errors_total counter",
+        'errors_total{reason="bad \\"quote\\""} 1',
+        'errors_total{reason="line\\nbreak \\\\ slash"} 2',
+    ]
@@ -0,0 +1,60 @@
+import io
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from core.page_classifier import extract_text_lines, classify_page
+from utils import make_synthetic_pdf
+
+
+BODY = [(650 - 14 * i, f"1.{i + 1} Lorem ipsum dolor sit amet, consectetur adipiscing elit") for i in range(10)]
+
+
+def make_page(lines):
+    """
+    Single page PDF with a text line at each (y, text), page height 792
+    """
+    writer = PdfWriter()
+    font_ref = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    page = writer.add_blank_page(612, 792)
+    content = DecodedStreamObject()
+    content.set_data("".join(f"BT /F1 10 Tf 72 {y} Td ({text}) Tj ET\n" for y, text in lines).encode("latin-1"))
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/Font"): DictionaryObject({NameObject("/F1"): font_ref}),
+    })
+    page[NameObject("/Contents")] = writer._add_object(content)
+
+    data = io.BytesIO()
+    writer.write(data)
+    return PdfReader(data).pages[0]
+
+
+def test_section_header_and_part_heading(tmp_path):
+    make_synthetic_pdf(tmp_path / "spec.pdf", sections=(("123456", 3),), noise_bytes=256)
+    lines = extract_text_lines(PdfReader(tmp_path / "spec.pdf").pages[0])
+
+    assert lines[0][1] == "SECTION 123456"
+    assert lines[0][0] > 0.95
+    assert classify_page(lines).sections == ["123456"]
+    assert classify_page(lines).parts == ["PART 1 - GENERAL"]
+
+
+def test_footer_only():
+    lines = extract_text_lines(make_page([*BODY, (30, "12 34 56 - 3")]))
+
+    result = classify_page(lines)
+    assert result.sections == ["123456"]
+    assert result.parts == []
+
+
+def test_ambiguous_pages_go_to_the_model():
+    # header and footer disagree
+    assert classify_page(extract_text_lines(make_page([(760, "SECTION 123456"), *BODY, (30, "654321 - 1")]))) is None
+    # a plain text mention is not the page's section
+    assert classify_page(extract_text_lines(make_page([*BODY, (400, "Comply with Section 123456 as applicable")]))) is None
+    # too little text, e.g. a scanned page
+    assert classify_page(extract_text_lines(make_page([(760, "SECTION 123456")]))) is None
@@ -0,0 +1,101 @@
+import asyncio
+
+from pathlib import Path
+
+from core.pdf_document import PDFDocument, PDFPage, PDFPageData
+from core.prompts import load_prompts
+from core.summarizer.step1 import create_ticket_step1, create_ticket_step1_batch
+from llm_completion.completion import (
+    CompletionPayload, llm_completion, estimate_tokens, cache_breakpoints, _mark_cache_breakpoints
+)
+from llm_completion.fake_provider import fake_provider
+from llm_completion.models import ModelInfo, get_model_list
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def fake_model(prompt_cache, min_tokens: int) -> ModelInfo:
+    return ModelInfo(
+        name="fake", provider="fake", resolve_as="fake/fake",
+        context_window=128000, max_output_tokens=16384,
+        dollars_input=1., dollars_output=1., dollars_input_cached=.5,
+        tokens_per_minute=None, request_per_minute=None,
+        prompt_cache=prompt_cache, prompt_cache_min_tokens=min_tokens,
+    )
+
+
+def make_doc(pages: int) -> PDFDocument:
+    doc = PDFDocument(Path("test.pdf"))
+    for idx in range(pages):
+        page = PDFPage()
+        page.data = PDFPageData(None, 0, 0, f"sha256-{idx}", idx + 1, doc.path)
+        doc.insert_page(page)
+    return doc
+
+
+def cached_tokens(model: ModelInfo, posts: list) -> list:
+    async def run():
+        fake_provider.reset()
+        cached = []
+        for post in posts:
+            post.model = model.name
+            async for r in llm_completion([model], post):
+                cached.append(r["usage"]["prompt_tokens_details"]["cached_tokens"])
+        return cached
+
+    return asyncio.run(run())
+
+
+def step1_posts() -> list:
+    prompts = load_prompts(BASE_DIR)
+    doc = make_doc(2)
+    return [create_ticket_step1(doc, page, prompts).post for page in doc]
+
+
+def test_marked_request_gets_cache_hit():
+    model = fake_model("explicit", 256)
+    posts = step1_posts()
+
+    breakpoints = cache_breakpoints(model, posts[0])
+    assert breakpoints == [1]
+    messages = [m.as_dict(fingerprint=True) for m in posts[0].messages]
+    _mark_cache_breakpoints(model, posts[0], messages)
+    assert messages[1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+
+    first, second = cached_tokens(model, posts)
+    assert first == 0
+    # the static prefix up to the breakpoint, not the pages after it
+    assert second == estimate_tokens(posts[1].messages[:2])
+
+
+def test_prefix_below_min_tokens_is_not_marked():
+    model = fake_model("explicit", 4096)
+    posts = step1_posts()
+
+    assert cache_breakpoints(model, posts[0]) == []
+    messages = [m.as_dict(fingerprint=True) for m in posts[0].messages]
+    _mark_cache_breakpoints(model, posts[0], messages)
+    assert not any("cache_control" in str(m["content"]) for m in messages)
+    assert cached_tokens(model, posts) == [0, 0]
+
+
+def test_explicit_models_can_cache_the_static_prefix():
+    """
+    An explicit prompt cache config whose minimum the static prefix of step1 prompts never reaches is dead
+    """
+    prompts = load_prompts(BASE_DIR)
+    doc = make_doc(2)
+    posts = [create_ticket_step1(doc, doc[0], prompts).post, create_ticket_step1_batch(doc, doc.pages, prompts).post]
+
+    for model in get_model_list(BASE_DIR, check_env=False):
+        if model.prompt_cache == "explicit":
+            for post in posts:
+                assert cache_breakpoints(model, post), f"{model.name}: static prefix below prompt_cache_min_tokens"
+
+
+def test_auto_caches_without_markers():
+    model = fake_model("auto", 256)
+    post = CompletionPayload(model="fake", messages=step1_posts()[0].messages)
+    assert cache_breakpoints(model, post) == []
+    assert cached_tokens(model, [post, post])[1] > 0
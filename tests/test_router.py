@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from core.globals import ROUTER_MIN_SAMPLES
+from llm_completion.completion import CompletionPayload, ChatMessage
+from llm_completion.fake_provider import fake_provider, FakeProfile
+from llm_completion.models import ModelInfo
+from llm_completion.router import ModelRouter
+
+
+def fake_model(name: str) -> ModelInfo:
+    return ModelInfo(
+        name=name, provider="fake", resolve_as=f"fake/{name}",
+        context_window=128000, max_output_tokens=16384,
+        dollars_input=1., dollars_output=1.,
+        tokens_per_minute=None, request_per_minute=None,
+    )
+
+
+@pytest.fixture
+def profiles():
+    yield fake_provider.profiles
+    fake_provider.profiles = {}
+
+
+def make_router(hedge: bool = False) -> ModelRouter:
+    model_list = [fake_model("primary"), fake_model("secondary")]
+    slots = {m.name: asyncio.Semaphore(1) for m in model_list}
+    return ModelRouter(model_list, ["primary", "secondary"], hedge=hedge, slots=slots)
+
+
+def post() -> CompletionPayload:
+    return CompletionPayload(model="primary", messages=[ChatMessage(role="user", content="request")])
+
+
+@pytest.mark.parametrize("failure", ["error_rate", "rate_limit_rate"])
+def test_failover_holds_the_slot_of_the_model_called(profiles, failure):
+    profiles["primary"] = FakeProfile(**{failure: 1.})
+    profiles["secondary"] = FakeProfile(latency_s=0.2)
+
+    async def run():
+        router = make_router()
+        task = asyncio.create_task(router.complete(post()))
+        await asyncio.sleep(0.1)
+        assert router.slots["secondary"].locked()
+        assert not router.slots["primary"].locked()
+        return await task
+
+    routed = asyncio.run(run())
+    assert routed.model_name == "secondary"
+    assert routed.failovers == ["primary"]
+    assert "error" not in routed.data[0]
+
+
+def test_hedge_takes_a_slot_per_leg_and_cancels_the_loser(profiles):
+    profiles["primary"] = FakeProfile(latency_s=2.)
+    profiles["secondary"] = FakeProfile(latency_s=0.2)
+
+    async def run():
+        router = make_router(hedge=True)
+        for _ in range(ROUTER_MIN_SAMPLES):
+            router.stats["primary"].record(0.05, False)
+
+        task = asyncio.create_task(router.complete(post()))
+        await asyncio.sleep(0.15)
+        assert router.slots["primary"].locked()
+        assert router.slots["secondary"].locked()
+
+        routed = await asyncio.wait_for(task, timeout=1.)
+        # the cancelled primary request gives its slot back
+        await asyncio.sleep(0.01)
+        assert not router.slots["primary"].locked()
+        assert not router.slots["secondary"].locked()
+        return routed
+
+    routed = asyncio.run(run())
+    assert routed.model_name == "secondary"
+    assert routed.hedged
+
+
+def test_without_routing_errors_stay_with_the_requested_model(profiles):
+    profiles["primary"] = FakeProfile(rate_limit_rate=1.)
+    model_list = [fake_model("primary"), fake_model("secondary")]
+
+    routed = asyncio.run(ModelRouter(model_list, []).complete(post()))
+    assert routed.model_name == "primary"
+    assert routed.failovers == []
+    assert "error" in routed.data[0]
@@ -0,0 +1,198 @@
+import json
+import random
+import re
+
+import pytest
+
+from pathlib import Path
+
+from core.globals import STEP1_N_INITIAL
+from core.pdf_document import PDFDocument, PDFPage, PDFPageData
+from core.prompts import load_prompts
+from core.summarizer import step1
+from core.summarizer.step1 import (
+    SummarizeStep1Ticket, SummarizeStep1BatchTicket, pp, pp_batch, create_tickets_step1, create_ticket_step1_batch,
+    step1_heuristics, advance_step1_heuristics,
+)
+from llm_completion.completion import CompletionPayload
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+class RecordingQueue:
+    def __init__(self):
+        self.put_tickets = []
+        self.later_tickets = []
+
+    def put(self, ticket):
+        self.put_tickets.append(ticket)
+
+    def put_later(self, ticket, delay_s):
+        self.later_tickets.append(ticket)
+
+
+def make_ticket() -> SummarizeStep1Ticket:
+    doc = PDFDocument(Path("test.pdf"))
+    page = PDFPage()
+    page.data = PDFPageData(None, 0, 0, "", 1, doc.path)
+    doc.insert_page(page)
+    post = CompletionPayload(model="fake", messages=[], n=STEP1_N_INITIAL)
+    return SummarizeStep1Ticket(pp, post, doc, page)
+
+
+def response(*contents: str):
+    return [{"choices": [{"message": {"content": c}} for c in contents]}]
+
+
+def answer(section: str) -> str:
+    return json.dumps({"page_number": 1, "sections": [section], "parts": []})
+
+
+def test_disagreement_escalates():
+    ticket, q = make_ticket(), RecordingQueue()
+    pp(ticket, response(answer("100001"), answer("100002"), answer("100003")), q)
+
+    assert q.put_tickets == [ticket]
+    assert len(ticket.samples) == 3
+    assert not ticket.page.data_step1.success
+
+
+def test_unparseable_escalation_takes_vote_from_collected_samples():
+    ticket, q = make_ticket(), RecordingQueue()
+    pp(ticket, response(answer("100001"), answer("100001"), answer("100002")), q)
+    assert q.put_tickets == [ticket]
+
+    # the same unusable answer forever, e.g. served from the completion cache
+    pp(ticket, response("not json", "not json"), q)
+
+    assert q.put_tickets == [ticket]
+    assert not q.later_tickets
+    assert ticket.page.data_step1.success
+    assert ticket.page.data_step1.sections == ["100001"]
+    assert ticket.page.data_step1.samples == 3
+
+
+def test_unparseable_first_round_is_retried():
+    ticket, q = make_ticket(), RecordingQueue()
+    pp(ticket, response("not json"), q)
+
+    assert q.later_tickets == [ticket]
+    assert ticket.attempts == 1
+    assert not ticket.page.data_step1.success
+
+
+def ticket_pages(tickets) -> list:
+    return [
+        [p.data.page_num for p in t.pages] if isinstance(t, SummarizeStep1BatchTicket) else [t.page.data.page_num]
+        for t in tickets
+    ]
+
+
+def test_batches_span_split_chunks():
+    prompts = load_prompts(BASE_DIR)
+    doc = PDFDocument(Path("test.pdf"))
+    tickets = []
+    for chunk_start in range(0, 24, 8):
+        chunk = []
+        for page_num in range(chunk_start + 1, chunk_start + 9):
+            page = PDFPage()
+            page.data = PDFPageData(None, 0, 0, "", page_num, doc.path)
+            doc.insert_page(page)
+            chunk.append(page)
+        doc.ingested = chunk_start + 8 == 24
+        tickets.extend(create_tickets_step1(doc, chunk, prompts, batch_size=10))
+
+    assert ticket_pages(tickets) == [list(range(1, 11)), list(range(11, 21)), list(range(21, 25))]
+    assert not doc.step1_pending
+
+
+def test_batch_stores_the_agreement_of_each_page(monkeypatch):
+    monkeypatch.setattr(step1, "STEP1_AGREEMENT_THRESHOLD", 0.5)
+    doc = PDFDocument(Path("test.pdf"))
+    pages = []
+    for page_num in (1, 2):
+        page = PDFPage()
+        page.data = PDFPageData(None, 0, 0, "", page_num, doc.path)
+        doc.insert_page(page)
+        pages.append(page)
+    ticket = create_ticket_step1_batch(doc, pages, load_prompts(BASE_DIR))
+
+    def batch_answer(section: str) -> str:
+        return json.dumps([
+            {"page_number": 1, "sections": ["100001"], "parts": []},
+            {"page_number": 2, "sections": [section], "parts": []},
+        ])
+
+    q = RecordingQueue()
+    pp_batch(ticket, response(batch_answer("100002"), batch_answer("100002"), batch_answer("100003")), q)
+
+    assert not q.put_tickets
+    assert pages[0].data_step1.agreement == 1.
+    assert pages[1].data_step1.agreement == pytest.approx(2 / 3)
+    assert pages[1].data_step1.sections == ["100002"]
+
+
+def reference_heuristics(raw):
+    """
+    Step1 heuristics as passes over the whole document, as they were before Step1Heuristics
+    """
+    sections = [list(s) for s, _ in raw]
+    parts = [list(p) for _, p in raw]
+
+    for i in range(1, len(raw)):
+        if sections[i - 1] != sections[i]:
+            if any(re.search(r'part\s+(?:[2-9]|[1-9]\d+)', p, re.IGNORECASE) for p in parts[i]):
+                sections[i] = []
+
+    for i in range(len(raw)):
+        sections[i] = list(set(sections[i]))
+        parts[i] = list(set(parts[i]))
+        if not sections[i] and i > 0:
+            sections[i] = sections[i - 1]
+
+    for i in range(1, len(raw) - 1):
+        if set(sections[i - 1]) == set(sections[i + 1]) != set(sections[i]):
+            sections[i] = sections[i - 1]
+
+    section_n = 0
+    numbers = []
+    for i in range(len(raw)):
+        if i == 0:
+            pass
+        elif any(re.search(r"part\s+1\b", p, re.IGNORECASE) for p in parts[i]):
+            section_n += 1
+        elif sections[i - 1] != sections[i]:
+            section_n += 1
+        numbers.append(section_n)
+
+    return list(zip(sections, parts, numbers))
+
+
+def test_incremental_heuristics_match_whole_document_passes():
+    rnd = random.Random(0)
+    for _ in range(200):
+        raw = [
+            (rnd.choice([[], ["100001"], ["100002"], ["100003"]]), rnd.choice([[], ["Part 1"], ["Part 2"], ["Part 12"]]))
+            for _ in range(rnd.randint(0, 30))
+        ]
+        expected = reference_heuristics(raw)
+        assert step1_heuristics(raw) == expected
+
+        # pages resolved out of order, the document split in chunks
+        doc = PDFDocument(Path("test.pdf"))
+        order = list(range(len(raw)))
+        rnd.shuffle(order)
+        for idx in range(len(raw)):
+            page = PDFPage()
+            page.data = PDFPageData(None, 0, 0, "", idx + 1, doc.path)
+            doc.insert_page(page)
+        for idx in order:
+            page = doc[idx]
+            page.data_step1.sections, page.data_step1.parts = list(raw[idx][0]), list(raw[idx][1])
+            doc.mark_step1_done(page)
+            advance_step1_heuristics(doc)
+        doc.ingested = True
+        advance_step1_heuristics(doc)
+
+        assert doc.step1_set
+        assert [(p.data_step1.sections, p.data_step1.parts, p.data_step1.section_n) for p in doc] == expected
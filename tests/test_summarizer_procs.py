@@ -0,0 +1,151 @@
+import dataclasses
+import pickle
+import queue
+import time
+
+from pathlib import Path
+
+from core.events import EventQueue, TICKET
+from core.page_store import PageStore
+from core.pdf_document import PDFDocument, PDFPage, PDFPageData, PDFError
+from core.prompts import load_prompts
+from core.summarizer.retry import retry_ticket, PARSE
+from core.summarizer.step1 import create_ticket_step1
+from core.summarizer.summarizer import finish_ticket, finish_result
+from core.summarizer.summ_utils import TicketCall, PDFPageContent, PDFPageRef
+from core.summarizer.summarizer_procs import ProcessTicketQueue, SummarizerProcess
+from llm_completion.cache import CompletionCache, payload_fingerprint
+from llm_completion.completion import payload_by_reference
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def make_doc() -> PDFDocument:
+    doc = PDFDocument(Path("test.pdf"))
+    doc.page_store = PageStore()
+    for idx in range(2):
+        data = f"%PDF page {idx}".encode()
+        offset, length = doc.page_store.write(data)
+        page = PDFPage()
+        page.data = PDFPageData(doc.page_store, offset, length, f"sha256-{idx}", idx + 1, doc.path)
+        doc.insert_page(page)
+    return doc
+
+
+class FakeProcess:
+    def __init__(self):
+        self.pid = 1
+        self.exitcode = None
+
+    def is_alive(self) -> bool:
+        return self.exitcode is None
+
+
+def start_fake() -> SummarizerProcess:
+    return SummarizerProcess(FakeProcess(), queue.Queue())
+
+
+def test_pages_are_sent_by_reference():
+    doc = make_doc()
+    post = create_ticket_step1(doc, doc[1], load_prompts(BASE_DIR)).post
+
+    sent = pickle.loads(pickle.dumps(payload_by_reference(post)))
+    refs = [c for m in sent.messages if not isinstance(m.content, str) for c in m.content if isinstance(c, PDFPageRef)]
+    assert len(refs) == 1
+    assert len(pickle.dumps(refs[0])) < 300
+    assert refs[0].as_dict() == PDFPageContent(doc[1].data).as_dict()
+    assert payload_fingerprint(sent) == payload_fingerprint(post)
+    doc.page_store.close()
+
+
+def accept(ticket, res, q):
+    pass
+
+
+def reject(ticket, res, q):
+    retry_ticket(q, ticket, PARSE, "invalid answer")
+
+
+def test_cache_is_looked_up_and_filled_by_the_coordinator(tmp_path):
+    doc = make_doc()
+    cache = CompletionCache(tmp_path, 1024 * 1024)
+    results = queue.Queue()
+    q = ProcessTicketQueue(start_fake, 1, 2, results, cache=cache)
+    requests = q._procs[0].requests
+    ticket = dataclasses.replace(create_ticket_step1(doc, doc[0], load_prompts(BASE_DIR)), pp=accept)
+
+    q.put(ticket)
+    ticket_id, _ = requests.get_nowait()
+    response = {"choices": [{"message": {"content": "{}"}}], "usage": {}}
+    assert q.done(ticket_id) is ticket
+    finish_result(q, ticket, TicketCall(ticket.post.model, [response], time.time(), time.time()), None, cache)
+    assert cache.get(ticket.post) == response
+
+    # the same request again is answered from the cache, without a summarizer process
+    q.put(ticket)
+    assert requests.empty()
+    ticket_id, call = results.get_nowait()
+    assert call.cache_hit()
+    assert q.done(ticket_id) is ticket
+
+    # a retry is not: the cached answer is the one it retries on
+    ticket.attempts = 1
+    q.put(ticket)
+    assert results.empty()
+    ticket_id, _ = requests.get_nowait()
+    assert q.done(ticket_id) is ticket
+    assert q.in_flight() == 0
+    doc.page_store.close()
+
+
+def test_answers_failing_post_processing_are_not_cached(tmp_path):
+    doc = make_doc()
+    cache = CompletionCache(tmp_path, 1024 * 1024)
+    q = ProcessTicketQueue(start_fake, 1, 2, queue.Queue(), cache=cache)
+    ticket = dataclasses.replace(create_ticket_step1(doc, doc[0], load_prompts(BASE_DIR)), pp=reject)
+    response = {"choices": [{"message": {"content": "{}"}}], "usage": {}}
+
+    finish_ticket(q, ticket, TicketCall(ticket.post.model, [response], time.time(), time.time()), cache)
+    assert ticket.attempts == 1
+    assert cache.get(ticket.post) is None
+    doc.page_store.close()
+
+
+def test_tickets_of_failed_documents_are_dropped_with_an_event():
+    doc = make_doc()
+    events = EventQueue()
+    q = ProcessTicketQueue(start_fake, 1, 2, queue.Queue(), events=events)
+    doc.errors.append(PDFError("failed", False))
+
+    q.put(create_ticket_step1(doc, doc[0], load_prompts(BASE_DIR)))
+    assert q._procs[0].requests.empty()
+    assert q.in_flight() == 0
+    event = events.get_nowait()
+    assert (event.kind, event.doc) == (TICKET, doc)
+    doc.page_store.close()
+
+
+def test_tickets_of_a_dead_process_are_retried():
+    doc = make_doc()
+    events = EventQueue()
+    q = ProcessTicketQueue(start_fake, 2, 1, queue.Queue(), events=events)
+    tickets = [create_ticket_step1(doc, page, load_prompts(BASE_DIR)) for page in doc]
+    for ticket in tickets:
+        q.put(ticket)
+    dead = q._procs[0]
+    dead_id, _ = dead.requests.get_nowait()
+    live_id, _ = q._procs[1].requests.get_nowait()
+    dead.process.exitcode = -9
+
+    q.check_processes()
+    assert q._procs[0] is not dead
+    assert q.in_flight() == 1
+    assert [t.attempts for t in tickets] == [1, 0]
+    assert events.get_nowait().kind == TICKET
+
+    # a late result of the lost ticket is ignored, the other one is post-processed as usual
+    assert q.done(dead_id) is None
+    assert q.done(live_id) is tickets[1]
+    assert q.in_flight() == 0
+    doc.page_store.close()
@@ -0,0 +1,32 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from core.summarizer.ticket_queue import FairScheduler
+
+
+@dataclass(eq=False)
+class Doc:
+    pages_total: int
+    pages: List[int] = field(default_factory=list)
+
+    @property
+    def pages_cnt(self) -> int:
+        return len(self.pages)
+
+
+@dataclass
+class Ticket:
+    doc: Doc
+
+    def priority(self) -> int:
+        return 1
+
+
+def test_sjf_orders_by_total_pages_while_splitting():
+    big, small = Doc(pages_total=500, pages=list(range(8))), Doc(pages_total=20, pages=list(range(20)))
+    scheduler = FairScheduler(sjf=True)
+    for doc in [big, small, big]:
+        scheduler.push(Ticket(doc))
+
+    # the big document has fewer pages split so far, yet comes last
+    assert [scheduler.pop().doc for _ in range(3)] == [small, big, big]
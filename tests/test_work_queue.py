@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from test_summarizer_procs import BASE_DIR, make_doc
+from core.prompts import load_prompts
+from core.summarizer.step1 import create_ticket_step1
+from core.summarizer.work_queue import WorkQueue, SharedModelRateLimiter, RemoteTicketQueue
+from llm_completion.cache import CompletionCache
+
+
+def test_budget_and_reconcile_do_not_block_the_event_loop(tmp_path):
+    wq = WorkQueue(tmp_path / "wq.sqlite3")
+    limiter = SharedModelRateLimiter(wq, "fake", tpm=1000, rpm=None, headroom=1.)
+
+    async def run():
+        await limiter.acquire(500)
+        assert limiter.budget() == pytest.approx(0.5, abs=0.01)
+
+        # another thread in a long work queue transaction, e.g. waiting on a busy SQLite file
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with wq._lock:
+                locked.set()
+                release.wait(5.)
+
+        threading.Thread(target=hold_lock).start()
+        locked.wait()
+        try:
+            ts_start = time.monotonic()
+            limiter._budget_ts = 0.
+            assert limiter.budget() == pytest.approx(0.5, abs=0.01)
+            limiter.reconcile(500, 800)
+            assert time.monotonic() - ts_start < 0.1
+        finally:
+            release.set()
+
+        # both applied in the background once the lock is free
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if limiter._budget < 0.5:
+                break
+        return wq.read_buckets("fake", limiter._buckets, lambda: limiter._buckets["tokens"].level)
+
+    level = asyncio.run(run())
+    assert 200 <= level < 210
+    assert limiter.budget() < 0.25
+    wq.close()
+
+
+def test_cached_tickets_are_answered_by_the_coordinator(tmp_path):
+    doc = make_doc()
+    wq = WorkQueue(tmp_path / "wq.sqlite3")
+    cache = CompletionCache(tmp_path / "cache", 1024 * 1024)
+    q = RemoteTicketQueue(wq, cache=cache)
+    ticket = create_ticket_step1(doc, doc[0], load_prompts(BASE_DIR))
+    response = {"choices": [{"message": {"content": "{}"}}], "usage": {}}
+    cache.put(ticket.post, response)
+
+    q.put(ticket)
+    assert wq.queued() == 0
+    [(taken, call)] = q.take_results()
+    assert taken is ticket and call.cache_hit()
+    assert q.in_flight() == 0
+
+    # retries go to workers
+    ticket.attempts = 1
+    q.put(ticket)
+    assert wq.queued() == 1
+    wq.close()
+    doc.page_store.close()
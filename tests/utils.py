@@ -1,22 +1,87 @@
+from core.fmt_output import convert_s1_to_output
+
+
 def convert_output_format(input_data):
-    output = {
-        "file_name": input_data["file_name"],
-        "sections": []
-    }
-
-    for section_idx, section in enumerate(input_data["sections"]):
-        for section_n in set(p["section_n"] for p in input_data["pages"]):
-            section_pages = [
-                p["page_num"] for p in input_data["pages"]
-                if section in p["sections"] and p["section_n"] == section_n
-            ]
-
-            if section_pages:
-                section_entry = {
-                    "section": section,
-                    "page_start": min(section_pages),
-                    "page_end": max(section_pages)
-                }
-                output["sections"].append(section_entry)
-
-    return output
\ No newline at end of file
+    output = convert_s1_to_output(input_data)
+    for section in output["sections"]:
+        del section["section_n"]
+
+    return output
+
+
+def make_synthetic_pdf(
+        path,
+        sections=(("123456", 5),),
+        noise_bytes: int = 64 * 1024,
+        seed: int = 0,
+):
+    """
+    Writes a COXIT-like PDF: each section spans N pages with "SECTION XXXXXX" header, "PART N" headings
+    and "XXXXXX - page" footers. Every page carries an incompressible image of noise_bytes,
+    to resemble the size of real scanned / font-heavy spec pages.
+    """
+    import random
+
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+    rnd = random.Random(seed)
+    writer = PdfWriter()
+    font_ref = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+
+    for section, pages_cnt in sections:
+        for idx in range(pages_cnt):
+            lines = [(760, f"SECTION {section}")]
+            part = idx * 3 // pages_cnt + 1
+            if idx == 0 or (idx - 1) * 3 // pages_cnt + 1 != part:
+                lines.append((700, f"PART {part} - {['GENERAL', 'PRODUCTS', 'EXECUTION'][part - 1]}"))
+            lines.extend((650 - 14 * i, f"{part}.{i + 1} Lorem ipsum dolor sit amet {rnd.randint(0, 10 ** 6)}") for i in range(20))
+            if idx == pages_cnt - 1:
+                lines.append((80, "END OF SECTION"))
+            lines.append((30, f"{section} - {idx + 1}"))
+
+            page = writer.add_blank_page(612, 792)
+            width = 256
+            image = DecodedStreamObject()
+            image.set_data(rnd.randbytes(noise_bytes // width * width))
+            image.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Image"),
+                NameObject("/Width"): NumberObject(width),
+                NameObject("/Height"): NumberObject(noise_bytes // width),
+                NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+                NameObject("/BitsPerComponent"): NumberObject(8),
+            })
+
+            text = "".join(f"BT /F1 10 Tf 72 {y} Td ({line}) Tj ET\n" for y, line in lines)
+            content = DecodedStreamObject()
+            content.set_data(f"{text}q 100 0 0 100 450 650 cm /Im1 Do Q\n".encode("latin-1"))
+
+            page[NameObject("/Resources")] = DictionaryObject({
+                NameObject("/Font"): DictionaryObject({NameObject("/F1"): font_ref}),
+                NameObject("/XObject"): DictionaryObject({NameObject("/Im1"): writer._add_object(image)}),
+            })
+            page[NameObject("/Contents")] = writer._add_object(content)
+
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def synthetic_step1_answers(sections=(("123456", 5),)):
+    """
+    Correct step1 (sections, parts) of each page of make_synthetic_pdf(path, sections)
+    """
+    answers = []
+    for section, pages_cnt in sections:
+        for idx in range(pages_cnt):
+            part = idx * 3 // pages_cnt + 1
+            parts = []
+            if idx == 0 or (idx - 1) * 3 // pages_cnt + 1 != part:
+                parts.append(f"PART {part} - {['GENERAL', 'PRODUCTS', 'EXECUTION'][part - 1]}")
+            answers.append(([section], parts))
+
+    return answers